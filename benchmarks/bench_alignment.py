@@ -0,0 +1,87 @@
+"""
+Speed and accuracy of the PET/CT alignment (splitter_of_mice/alignment.py) on synthetic hotel phantoms.
+
+Each case projects a PET and a CT phantom of the same layout, with their own matrix and pixel size, places the CT at
+a known random offset and estimates it back. The error of each estimate and the time from the two projections to the
+offset are reported; the run fails if any error exceeds the tolerance.
+
+    python benchmarks/bench_alignment.py
+    python benchmarks/bench_alignment.py --trials 50 --max-offset 8 --tolerance 0.5
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+# the package uses flat imports, as in the container (see Dockerfile)
+sys.path[:0] = [os.path.join(REPO_DIR, 'splitter_of_mice'), os.path.join(REPO_DIR, 'splitter_of_mice', 'splitter_of_mice')]
+
+import phantoms
+import alignment
+from geometry import Geometry
+
+# field of view of the phantoms in mm
+FOV = 100.
+
+CASES = [
+    dict(animals=4, pet_matrix=128, ct_matrix=256, slices=64),
+    dict(animals=4, pet_matrix=128, ct_matrix=512, slices=32),
+    dict(animals=2, pet_matrix=128, ct_matrix=256, slices=64),
+    dict(animals=1, pet_matrix=128, ct_matrix=256, slices=64),
+]
+
+
+def projections(case, seed):
+    pet = phantoms.hotel_volume(case['animals'], case['pet_matrix'], case['slices'], seed=seed)
+    ct = phantoms.hotel_volume(case['animals'], case['ct_matrix'], case['slices'], ct=True, seed=seed)
+    return pet.sum(axis=(0, 3), dtype='float64'), ct.sum(axis=(0, 3), dtype='float64')
+
+
+def run_case(case, trials, max_offset, rng):
+    errors, times = [], []
+    for trial in range(trials):
+        pet, ct = projections(case, seed=trial)
+        pet_geometry = Geometry(pet.shape, (FOV / pet.shape[0],) * 2)
+        offset = rng.uniform(-max_offset, max_offset, 2)
+        # what is at m mm in the PET is at m + offset mm in the CT
+        ct_geometry = Geometry(ct.shape, (FOV / ct.shape[0],) * 2).shifted(offset)
+
+        start = time.perf_counter()
+        estimate, _ = alignment.estimate_offset(pet, pet_geometry, ct, ct_geometry)
+        times.append(time.perf_counter() - start)
+        errors.append(np.inf if estimate is None else float(np.linalg.norm(estimate - offset)))
+    return np.array(errors), np.array(times)
+
+
+def main():
+    p = argparse.ArgumentParser(description='Benchmark the speed and accuracy of the PET/CT alignment')
+    p.add_argument('--trials', metavar='<int>', type=int, default=20, help='offsets per case [20]')
+    p.add_argument('--max-offset', metavar='<float>', type=float, default=5.,
+                   help='largest offset along each axis in mm [5]')
+    p.add_argument('--tolerance', metavar='<float>', type=float, default=0.5,
+                   help='largest error allowed in mm [0.5]')
+    p.add_argument('--seed', metavar='<int>', type=int, default=0, help='seed of the offsets [0]')
+    a = p.parse_args()
+
+    rng = np.random.default_rng(a.seed)
+    failed = False
+    print(f"{'case':<32} {'mean err mm':>12} {'max err mm':>11} {'median ms':>10} {'max ms':>8}")
+    for case in CASES:
+        errors, times = run_case(case, a.trials, a.max_offset, rng)
+        name = f"{case['animals']}x PET {case['pet_matrix']} / CT {case['ct_matrix']}"
+        print(f'{name:<32} {errors.mean():>12.3f} {errors.max():>11.3f} {np.median(times) * 1e3:>10.2f} '
+              f'{times.max() * 1e3:>8.2f}')
+        failed |= bool(errors.max() > a.tolerance)
+
+    if failed:
+        print(f'Alignment error above the tolerance of {a.tolerance} mm')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,300 @@
+"""
+End to end benchmark of the splitter on synthetic hotel phantoms.
+
+Each case generates a phantom, splits it with SoM (zipped cuts and QC images, as run.py does) and records the wall
+and CPU time of each stage and the peak resident memory of the process. Cases run in separate processes so that
+peak memory is measured per case. Results are appended to a JSON Lines history file, one line per benchmark run,
+and compared with the previous run of the same case to show regressions across commits.
+
+    python benchmarks/bench_split.py                  # default suite
+    python benchmarks/bench_split.py --quick          # small phantoms, for a smoke test
+    python benchmarks/bench_split.py --format dicom --modality CT --animals 2 --matrix 256 --slices 128
+"""
+import argparse
+import functools
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from datetime import datetime
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+# the package uses flat imports, as in the container (see Dockerfile)
+sys.path[:0] = [os.path.join(REPO_DIR, 'splitter_of_mice'), os.path.join(REPO_DIR, 'splitter_of_mice', 'splitter_of_mice')]
+
+import phantoms
+
+DEFAULT_HISTORY = os.path.join(BENCHMARK_DIR, 'history.jsonl')
+
+DEFAULT_SUITE = [
+    dict(format='inveon', modality='PET', animals=4, matrix=128, slices=159, frames=1, data_type=4),
+    dict(format='inveon', modality='PET', animals=2, matrix=128, slices=159, frames=4, data_type=4),
+    dict(format='inveon', modality='CT', animals=4, matrix=256, slices=256, frames=1, data_type=2),
+    dict(format='dicom', modality='PET', animals=4, matrix=128, slices=159, frames=1, data_type=None),
+    dict(format='dicom', modality='CT', animals=4, matrix=256, slices=256, frames=1, data_type=None),
+]
+
+QUICK_SUITE = [
+    dict(format='inveon', modality='PET', animals=4, matrix=64, slices=32, frames=1, data_type=4),
+    dict(format='inveon', modality='CT', animals=4, matrix=256, slices=64, frames=1, data_type=2),
+    dict(format='dicom', modality='PET', animals=2, matrix=64, slices=32, frames=1, data_type=None),
+    dict(format='dicom', modality='CT', animals=2, matrix=256, slices=64, frames=1, data_type=None),
+]
+
+
+def case_name(case):
+    name = f"{case['format']}-{case['modality']}-{case['animals']}x-{case['matrix']}x{case['matrix']}x{case['slices']}"
+    if case['frames'] > 1:
+        name += f"x{case['frames']}f"
+    if case['data_type']:
+        name += f"-dt{case['data_type']}"
+    return name
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+
+class StageTimer:
+    """
+    Accumulates wall time, CPU time and call counts per stage by wrapping the functions that implement each stage.
+    Stages may nest (e.g. zip inside save_cut); each reports its inclusive time.
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    def wrap(self, stage, owner, name):
+        attribute = owner.__dict__[name] if isinstance(owner, type) else getattr(owner, name)
+        is_static = isinstance(attribute, staticmethod)
+        function = attribute.__func__ if is_static else attribute
+
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            wall, cpu = time.perf_counter(), time.process_time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record = self.stages.setdefault(stage, {'calls': 0, 'wall': 0., 'cpu': 0.})
+                record['calls'] += 1
+                record['wall'] += time.perf_counter() - wall
+                record['cpu'] += time.process_time() - cpu
+                record['peak_rss_mb'] = round(peak_rss_mb(), 1)
+
+        setattr(owner, name, staticmethod(timed) if is_static else timed)
+
+    def report(self):
+        return {stage: {**record, 'wall': round(record['wall'], 4), 'cpu': round(record['cpu'], 4)}
+                for stage, record in self.stages.items()}
+
+
+def instrument(timer):
+    import splitter
+    from image_classes import BaseImage, DicomImage
+    from splitter import SoM
+
+    timer.wrap('load', SoM, 'load_image')
+    timer.wrap('projection', SoM, 'z_compress_pet')
+    timer.wrap('projection', SoM, 'z_compress_ct')
+    timer.wrap('thresholding', splitter.filters, 'threshold_otsu')
+    timer.wrap('thresholding', splitter.filters, 'threshold_li')
+    timer.wrap('bed_removal', SoM, 'remove_bed')
+    timer.wrap('labelling', SoM, 'detect_animals')
+    timer.wrap('labelling', SoM, 'get_valid_regs')
+    timer.wrap('split_coords', SoM, 'split_coords')
+    timer.wrap('add_cuts', SoM, 'add_cuts_to_image')
+    timer.wrap('save_cut', BaseImage, 'save_cut')
+    timer.wrap('save_cut', DicomImage, 'save_cut')
+    timer.wrap('zip', zipfile.ZipFile, 'write')
+    timer.wrap('zip', zipfile.ZipFile, 'writestr')
+    timer.wrap('qc', SoM, 'qc_image')
+
+
+def hotel_metadata(animals):
+    """
+    Per position subject metadata, as run.py builds from the hotel scan record
+    """
+    positions = {1: ['ctr'], 2: ['l', 'r'], 3: ['l', 'ctr', 'r'], 4: ['lt', 'rt', 'lb', 'rb']}[animals]
+    return {position: {'PatientID': f'mouse_{position}', 'PatientName': f'mouse_{position}', 'PatientWeight': 0.02}
+            for position in positions}
+
+
+def write_phantom(case, workdir):
+    ct = case['modality'] == 'CT'
+    if case['format'] == 'dicom':
+        return phantoms.write_dicom(os.path.join(workdir, 'input'), case['animals'], case['matrix'],
+                                    case['slices'], ct=ct)
+    return phantoms.write_inveon(os.path.join(workdir, 'input.img'), case['animals'], case['matrix'],
+                                 case['slices'], case['frames'], ct=ct, data_type=case['data_type'])
+
+
+def run_case(case, image, workdir):
+    """
+    Split the phantom of a case and return the measurements. Runs in a fresh process.
+    """
+    from splitter import SoM
+    SoM.desc_map = {'l': 'l', 'r': 'r', 'ctr': 'ctr', 'lb': 'lb', 'rb': 'rb', 'lt': 'lt', 'rt': 'rt'}
+
+    input_bytes = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(workdir) for f in files)
+
+    timer = StageTimer()
+    instrument(timer)
+    rss_before = peak_rss_mb()
+
+    wall, cpu = time.perf_counter(), time.process_time()
+    splitter = SoM(image, dicom=case['format'] == 'dicom')
+    splitter.outdir = os.path.join(workdir, 'output')
+    os.makedirs(splitter.outdir)
+    exit_code = splitter.split_mice(num_anim=case['animals'], remove_bed=True, zip=True,
+                                    dicom_metadata=hotel_metadata(case['animals']), output_qc=True)
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+
+    if exit_code != 0:
+        raise RuntimeError(f'Split failed with exit code {exit_code}')
+
+    cuts = len(splitter.pi.cuts)
+    splitter.pi.unload_image()
+
+    return {
+        'case': case_name(case),
+        'params': case,
+        'cuts': cuts,
+        'input_mb': round(input_bytes / 1024 ** 2, 2),
+        'wall': round(wall, 4),
+        'cpu': round(cpu, 4),
+        'throughput_mb_s': round(input_bytes / 1024 ** 2 / wall, 2),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'baseline_rss_mb': round(rss_before, 1),
+        'stages': timer.report(),
+    }
+
+
+def run_case_in_subprocess(case, repeat):
+    results = []
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory(prefix='som_bench_') as workdir:
+            image = write_phantom(case, workdir)
+            process = subprocess.run([sys.executable, os.path.abspath(__file__), '--case', json.dumps(case),
+                                      '--image', image, '--workdir', workdir], capture_output=True, text=True)
+        if process.returncode != 0:
+            sys.stderr.write(process.stderr)
+            raise RuntimeError(f'Benchmark case {case_name(case)} failed')
+        results.append(json.loads(process.stdout.strip().splitlines()[-1]))
+
+    # keep the fastest repetition, which is the least disturbed by other load on the machine
+    return min(results, key=lambda r: r['wall'])
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def read_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(results, history, tolerance):
+    """
+    Print each case against its last recorded run and return the names of the cases that regressed
+    """
+    previous = {}
+    for entry in history:
+        for result in entry['results']:
+            previous[result['case']] = result
+
+    regressions = []
+    print(f"{'case':<45} {'wall s':>8} {'prev':>8} {'RSS MB':>8} {'prev':>8}")
+    for result in results:
+        prev = previous.get(result['case'])
+        flag = ''
+        if prev is not None:
+            slower = result['wall'] > prev['wall'] * (1 + tolerance)
+            bigger = result['peak_rss_mb'] > prev['peak_rss_mb'] * (1 + tolerance)
+            if slower or bigger:
+                regressions.append(result['case'])
+                flag = '  REGRESSION' + (' time' if slower else '') + (' memory' if bigger else '')
+        print(f"{result['case']:<45} {result['wall']:>8.2f} {prev['wall'] if prev else float('nan'):>8.2f} "
+              f"{result['peak_rss_mb']:>8.1f} {prev['peak_rss_mb'] if prev else float('nan'):>8.1f}{flag}")
+
+        for stage, record in result['stages'].items():
+            print(f"    {stage:<20} {record['wall']:>8.3f} s  cpu {record['cpu']:>8.3f} s  calls {record['calls']}")
+
+    return regressions
+
+
+def main():
+    p = argparse.ArgumentParser(description='Benchmark the splitter on synthetic hotel phantoms')
+    p.add_argument('--quick', action='store_true', help='run the small phantom suite')
+    p.add_argument('--format', choices=['inveon', 'dicom'], help='run a single case in this format')
+    p.add_argument('--modality', choices=['PET', 'CT'], default='PET')
+    p.add_argument('--animals', type=int, default=4, choices=[1, 2, 3, 4])
+    p.add_argument('--matrix', type=int, default=128, help='transaxial matrix size')
+    p.add_argument('--slices', type=int, default=159)
+    p.add_argument('--frames', type=int, default=1, help='number of frames (Inveon only)')
+    p.add_argument('--data-type', type=int, choices=sorted(phantoms.INVEON_DTYPES),
+                   help='Inveon data_type [2 for CT, 4 for PET]')
+    p.add_argument('--repeat', type=int, default=1, help='repetitions per case; the fastest is kept')
+    p.add_argument('--history', default=DEFAULT_HISTORY, help='JSON Lines history file [benchmarks/history.jsonl]')
+    p.add_argument('--no-save', action='store_true', help='do not append the results to the history')
+    p.add_argument('--tolerance', type=float, default=0.1,
+                   help='fractional increase in time or memory reported as a regression [0.1]')
+    p.add_argument('--fail-on-regression', action='store_true', help='exit with status 1 if a case regressed')
+    p.add_argument('--case', help=argparse.SUPPRESS)
+    p.add_argument('--image', help=argparse.SUPPRESS)
+    p.add_argument('--workdir', help=argparse.SUPPRESS)
+    args = p.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(json.loads(args.case), args.image, args.workdir)))
+        return
+
+    if args.format:
+        suite = [dict(format=args.format, modality=args.modality, animals=args.animals, matrix=args.matrix,
+                      slices=args.slices, frames=args.frames if args.format == 'inveon' else 1,
+                      data_type=args.data_type if args.format == 'inveon' else None)]
+    else:
+        suite = QUICK_SUITE if args.quick else DEFAULT_SUITE
+
+    results = []
+    for case in suite:
+        print(f'Running {case_name(case)}', file=sys.stderr)
+        results.append(run_case_in_subprocess(case, args.repeat))
+
+    history = read_history(args.history)
+    regressions = compare(results, history, args.tolerance)
+
+    if not args.no_save:
+        import numpy
+        entry = {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'host': platform.node(),
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'results': results,
+        }
+        with open(args.history, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
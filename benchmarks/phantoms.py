@@ -0,0 +1,152 @@
+"""
+Synthetic hotel phantoms for benchmarking the splitter without real animal data.
+
+A phantom is a volume of 1-4 mouse-shaped blobs (an ellipsoidal body and a smaller head, lying along the axial
+axis) laid out like the animals in a mouse hotel, with a bed under the animals in CT and noise in both modalities.
+It can be written as an Inveon .img/.hdr pair or as a directory of single-slice DICOM files.
+"""
+import os
+
+import numpy as np
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+# (row, column) centre of each animal as a fraction of the transaxial field of view, for 1-4 animals
+LAYOUTS = {
+    1: [(0.5, 0.5)],
+    2: [(0.5, 0.3), (0.5, 0.7)],
+    3: [(0.5, 0.2), (0.5, 0.5), (0.5, 0.8)],
+    4: [(0.3, 0.3), (0.3, 0.7), (0.7, 0.3), (0.7, 0.7)],
+}
+
+# Inveon data_type codes and the numpy dtype of each
+INVEON_DTYPES = {1: 'i1', 2: '<i2', 3: '<i4', 4: '<f4', 6: '<u2'}
+
+PET_SOP_CLASS_UID = '1.2.840.10008.5.1.4.1.1.128'
+CT_SOP_CLASS_UID = '1.2.840.10008.5.1.4.1.1.2'
+
+
+def hotel_volume(animals=4, matrix=128, slices=64, frames=1, ct=False, seed=0):
+    """
+    Phantom volume of shape (slices, matrix, matrix, frames), as float32
+    """
+    if animals not in LAYOUTS:
+        raise ValueError(f'Phantoms hold 1 to 4 animals, not {animals}')
+
+    rng = np.random.default_rng(seed)
+    z, y, x = np.ogrid[0:slices, 0:matrix, 0:matrix]
+    z = (z + 0.5) / slices
+    y = (y + 0.5) / matrix
+    x = (x + 0.5) / matrix
+
+    # animals shrink with the number of columns in the layout so that they do not touch
+    columns = len({c for _, c in LAYOUTS[animals]})
+    radius = 0.14 if columns < 3 else 0.1
+
+    volume = np.zeros((slices, matrix, matrix), np.float32)
+    for row, column in LAYOUTS[animals]:
+        body = ((x - column) / radius) ** 2 + ((y - row) / radius) ** 2 + ((z - 0.45) / 0.3) ** 2 < 1
+        head = ((x - column) / (0.6 * radius)) ** 2 + ((y - row) / (0.6 * radius)) ** 2 + ((z - 0.82) / 0.1) ** 2 < 1
+        volume[body | head] = 1000. if ct else 50.
+
+        if ct:
+            # bed: a thin plate just under each row of animals
+            bed_y = slice(int((row + radius * 1.1) * matrix), int((row + radius * 1.3) * matrix) + 1)
+            bed_x = slice(int((column - 1.5 * radius) * matrix), int((column + 1.5 * radius) * matrix))
+            volume[:, bed_y, bed_x] = 800.
+        else:
+            # hot spot in each animal, e.g. the bladder
+            bladder = ((x - column) / (0.3 * radius)) ** 2 + ((y - row) / (0.3 * radius)) ** 2 + \
+                      ((z - 0.2) / 0.05) ** 2 < 1
+            volume[np.broadcast_to(bladder, volume.shape)] = 400.
+
+    if ct:
+        volume += rng.normal(0, 5, volume.shape).astype(np.float32)
+    else:
+        volume += np.abs(rng.normal(0, 1, volume.shape)).astype(np.float32)
+
+    # later frames of a dynamic scan are brighter, as the tracer accumulates
+    return np.stack([volume * (1 + 0.25 * frame) for frame in range(frames)], axis=-1)
+
+
+def write_inveon(path, animals=4, matrix=128, slices=64, frames=1, ct=False, data_type=None, seed=0):
+    """
+    Write a phantom as an Inveon image (path) and header (path + '.hdr'). data_type defaults to 2 (16 bit int) for
+    CT and 4 (32 bit float) for PET.
+    """
+    data_type = data_type or (2 if ct else 4)
+    if data_type not in INVEON_DTYPES:
+        raise ValueError(f'Unsupported Inveon data_type {data_type}')
+
+    volume = hotel_volume(animals, matrix, slices, frames, ct, seed)
+    # frames are stored one after another, each as z, y, x
+    np.moveaxis(volume, -1, 0).astype(INVEON_DTYPES[data_type]).tofile(path)
+
+    lines = ['# Synthetic hotel phantom',
+             f'data_type {data_type}',
+             f'z_dimension {slices}',
+             f'x_dimension {matrix}',
+             f'y_dimension {matrix}',
+             f'pixel_size {0.2 if ct else 0.8}',
+             f'total_frames {frames}',
+             'subject_identifier hotel',
+             'subject_weight 0',
+             'subject_orientation 0',
+             'acquisition_notes',
+             'scan_time Wed Jan 10 10:00:00 2024']
+    if not ct:
+        lines += ['axial_blocks 4',
+                  'axial_crystals_per_block 20',
+                  'axial_crystal_pitch 1.6',
+                  'calibration_factor 1.0',
+                  'isotope_branching_fraction 1.0',
+                  'dose 0',
+                  'injection_time Wed Jan 10 09:00:00 2024']
+    for frame in range(frames):
+        lines += [f'frame {frame}', 'scale_factor 1.0', 'frame_duration 60']
+
+    with open(path + '.hdr', 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    return path
+
+
+def write_dicom(directory, animals=4, matrix=128, slices=64, ct=False, seed=0):
+    """
+    Write a single frame phantom as one DICOM file per slice
+    """
+    os.makedirs(directory, exist_ok=True)
+    volume = hotel_volume(animals, matrix, slices, 1, ct, seed)[..., 0].astype('<i2' if ct else '<u2')
+
+    study_uid, series_uid = generate_uid(), generate_uid()
+    spacing = 0.2 if ct else 0.8
+    for index, pixels in enumerate(volume):
+        meta = FileMetaDataset()
+        meta.MediaStorageSOPClassUID = CT_SOP_CLASS_UID if ct else PET_SOP_CLASS_UID
+        meta.MediaStorageSOPInstanceUID = generate_uid()
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+        ds = FileDataset(None, {}, file_meta=meta, preamble=b'\0' * 128)
+        ds.SOPClassUID = meta.MediaStorageSOPClassUID
+        ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+        ds.Modality = 'CT' if ct else 'PT'
+        ds.PatientID = 'hotel'
+        ds.PatientName = 'hotel'
+        ds.StudyInstanceUID = study_uid
+        ds.SeriesInstanceUID = series_uid
+        ds.InstanceNumber = index + 1
+        ds.AcquisitionDate = '20240110'
+        ds.Rows, ds.Columns = pixels.shape
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 1 if ct else 0
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.PixelSpacing = [spacing, spacing]
+        ds.SliceThickness = spacing
+        ds.ImagePositionPatient = [0, 0, index * spacing]
+        ds.PixelData = pixels.tobytes()
+        ds.save_as(os.path.join(directory, f'{index:04d}.dcm'), enforce_file_format=True)
+
+    return directory
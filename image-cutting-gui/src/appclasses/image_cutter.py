@@ -102,7 +102,7 @@ class ImageCutter(tk.Frame):
     def undo_click(self):
         if self.controller.current_cut:
             self.controller.current_cut.pop(-1)
-            self.reset()
+            self.controller.update_overlay()
 
     def reset_process(self):
         self.controller.apply_process()
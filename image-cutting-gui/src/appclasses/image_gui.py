@@ -24,7 +24,6 @@ class ImageGUI(tk.Tk,ImageEditor):
         self.filepath = None
         self.nmice = None
         self.folder = folder.strip('/').strip('\\').strip()
-        self.tempdirs = []
 
         # default exposure scale
         self.escale = 1.0
@@ -163,9 +162,7 @@ class ImageGUI(tk.Tk,ImageEditor):
         self.deiconify()
 
     def load_image(self):
-        tdir = tempfile.mkdtemp()
-        log_temp_dir(tdir)
-        self.image.tempdir = tdir
+        self.image.get_scratch()
         self.image.load_image()
         
         # calc crossx len for static cutter
@@ -178,7 +175,6 @@ class ImageGUI(tk.Tk,ImageEditor):
         loadscreen = self.make_splash(SplashObj=SplashScreen,text='Loading...')       
         self.image = img
         self.load_image()
-        self.tempdirs.append(self.image.tempdir)
         self.stop_splash(loadscreen)
         self.show_frame("ImageRotator")
 
@@ -256,7 +252,9 @@ class ImageGUI(tk.Tk,ImageEditor):
 
                 message = 'Cutter coords: (x={0},y={1})'.format(self.cx,self.cy)
                 print(message)
-                self.show_frame(self.raised_frame.__name__)
+
+                # only the crosshairs change; they are blitted over the cached figure
+                self.update_overlay()
 
         canvas.mpl_connect('button_press_event', onClick)
 
@@ -290,7 +288,6 @@ class ImageGUI(tk.Tk,ImageEditor):
         loadscreen = self.make_splash(SplashObj=SplashScreen,text='Loading...')       
         self.image = img
         self.load_image()
-        self.tempdirs.append(self.image.tempdir)
         self.stop_splash(loadscreen)
 
         # do rotations
@@ -332,14 +329,8 @@ class ImageGUI(tk.Tk,ImageEditor):
 
 
     def clean_up_data(self):
+        # also removes the scratch space of the image
         self.clean_memmaps()
-        for directory in self.tempdirs:
-            try:
-                shutil.rmtree(directory)
-                print('Removed tempdir: {}'.format(directory))
-                self.tempdirs.remove(directory)
-            except Exception as e:
-                print('Failed to remove tempdir: {0}\n{1}'.format(directory,e))
         
     def clean_memmaps(self):
         if self.image is not None:
@@ -352,6 +343,7 @@ class ImageGUI(tk.Tk,ImageEditor):
             fp = os.path.join(self.image.tempdir,fn)
             if os.path.exists(fp):
                 os.remove(fp)
+            self.image.unload_image()
             self.image = None
         gc.collect()
 
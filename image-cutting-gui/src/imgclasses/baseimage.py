@@ -5,10 +5,9 @@ import numpy as np
 import gc
 import copy
 import ntpath
-import shutil
-import tempfile
 import warnings
 import inspect
+from .scratch import ScratchSpace
 
 class Params:
     def __init__(self,**kwargs):
@@ -39,9 +38,11 @@ class BaseImage:
         self.scale_factor = None
         self.scaled = None
         self.bpp = None # bytes per pixel
+        self.scratch = None # ScratchSpace of the memmaps of the image
         self.tempdir = None
         self.data_lim = 10**7  # 10 MB
         self.rotation_history = []
+        self.data_version = 0 # changes whenever img_data is loaded, rotated or unloaded
 
         # color map for distinguishing cuts
         self.all_colors = [
@@ -78,9 +79,24 @@ class BaseImage:
         return fillmat
 
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.unload_image()
+
+    def get_scratch(self):
+        '''
+        scratch space of the image, created on first use
+        '''
+        if self.scratch is None:
+            self.scratch = ScratchSpace()
+            self.tempdir = self.scratch.path
+        return self.scratch
+
     def submemmap(self, ix, data):
-        if self.tempdir is None:
-            raise ValueError('self.tempdir is None in self.sub_memmap.')
+        if self.scratch is None:
+            raise ValueError('self.scratch is None in self.sub_memmap.')
 
         
         found_filename = False
@@ -92,7 +108,7 @@ class BaseImage:
             found_filename = not os.path.exists(img_temp_name)
             ix+=1
 
-        dfile = np.memmap(img_temp_name, mode='w+', dtype='float32', shape=self.img_data.shape)
+        dfile = self.scratch.memmap(os.path.basename(img_temp_name), 'float32', self.img_data.shape)
 
         # center cut on parent image dimensions
         dz,dy,dx,df = data.shape
@@ -207,8 +223,7 @@ class BaseImage:
         print('File dimensions: ({},{},{},{})'.format(x,y,z,fs))
         ps = self.params
 
-        if self.tempdir is None:
-            self.tempdir = tempfile.mkdtemp()
+        self.get_scratch()
 
         if plane_range is None:
             if ps.z_dimension > 1:
@@ -316,7 +331,7 @@ class BaseImage:
 
         # make tempfile for whole image
         img_temp_name = os.path.join(self.tempdir,'{}.dat'.format(self.filename.split('.')[0]))
-        imgmat = np.memmap(img_temp_name,mode='w+',dtype='float32',shape=(nframes,matsize))
+        imgmat = self.scratch.memmap(os.path.basename(img_temp_name),'float32',(nframes,matsize))
         
         for ifr in frames:  
             fr_offset = ifr*(ps.x_dimension*ps.y_dimension*ps.z_dimension)
@@ -486,6 +501,8 @@ class BaseImage:
             
             del cut
              
+            if self.tempdir is None:
+                continue
             fp = os.path.join(self.tempdir,fn)
             if os.path.exists(fp):
                 try_rmfile(fp)
@@ -497,9 +514,11 @@ class BaseImage:
     def unload_image(self):
         self.clean_cuts()
         self.img_data = None
+        self.data_version += 1
         gc.collect()
-        if self.tempdir:
-            shutil.rmtree(self.tempdir)
+        if self.scratch is not None:
+            self.scratch.close()
+        self.scratch = None
         self.tempdir = None
 
 
@@ -561,6 +580,7 @@ class BaseImage:
         axes_to_flip.remove(axis)
         self.img_data = np.flip(self.img_data,axes_to_flip[0])
         self.img_data = np.flip(self.img_data,axes_to_flip[1])
+        self.data_version += 1
 
     def split_on_axis(self,matrix,axis):
         axis = self.get_axis(axis)
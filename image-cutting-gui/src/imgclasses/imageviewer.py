@@ -28,6 +28,18 @@ class ImageEditor:
 		# cut coords to be used and displayed on ImageCutter
 		self.queued_cuts = []
 
+		# cached projections and display matrices of the image (see get_projections)
+		self.projections = {}
+		self.frame_projections = {}
+		self.display_mats = {}
+		self.projection_image = None
+		self.projection_version = None
+		self.display_escale = None
+
+		# artists drawn over the static cutter by blitting (see static_cutter)
+		self.overlay = []
+		self.crosshairs = None
+		self.overlay_background = None
 
 		# for displaying cut (deprecated)
 		self.cutter = 'cross'
@@ -106,25 +118,81 @@ class ImageEditor:
 	def swap_x(self,frames):	
 		return [f.swapaxes(0,1) for f in frames]
 
+	def check_projection_cache(self):
+		'''
+		drops the cached projections if the image has been changed, reloaded or rotated since
+		they were made, and the display matrices if the exposure scale has changed too
+		'''
+		if self.projection_image is not self.image or self.projection_version != self.image.data_version:
+			self.projections = {}
+			self.frame_projections = {}
+			self.display_mats = {}
+			self.projection_image = self.image
+			self.projection_version = self.image.data_version
+		if self.display_escale != self.escale:
+			self.display_mats = {}
+			self.display_escale = self.escale
+
+	def get_projections(self, axes, frame_range=None):
+		'''
+		image collapsed over frames and then over each of axes, with self.collapse; 
+		cached by (collapse method, axis, frame range) until the image is rotated, so
+		redrawing a page does not collapse the whole image again
+		'''
+		self.check_projection_cache()
+		axes = [self.image.get_axis(axis) for axis in axes]
+		fr = None if frame_range is None else tuple(frame_range)
+		missing = [axis for axis in axes if (self.collapse,axis,fr) not in self.projections]
+
+		if missing:
+			if frame_range is None:
+				# collapse over frames using sum or max
+				frame = self.image.collapse_over_frames(method=self.collapse)
+			else:
+				fs = range(frame_range[0],frame_range[1]+1)
+				frames = np.stack([self.image.get_frame(k) for k in fs],axis=-1)
+				frame = self.image.collapse_over_frames(method=self.collapse,matrix=frames)
+			for axis in missing:
+				self.projections[(self.collapse,axis,fr)] = getattr(frame,self.collapse)(axis=axis)
+			frame = None
+
+		return [self.projections[(self.collapse,axis,fr)] for axis in axes]
+
+	def get_frame_projections(self, axis):
+		'''
+		image collapsed over axis only, keeping the frames; cached like get_projections
+		'''
+		self.check_projection_cache()
+		axis = self.image.get_axis(axis)
+		key = (self.collapse,axis)
+		if key not in self.frame_projections:
+			self.frame_projections[key] = getattr(self.image.img_data,self.collapse)(axis=axis)
+		return self.frame_projections[key]
+
+	def get_display_matrix(self, axis, frame_range=None):
+		'''
+		normalized projection on axis scaled by the exposure scale, with the x axis view 
+		swapped; cached like get_projections and for the current exposure scale
+		'''
+		self.check_projection_cache()
+		axis = self.image.get_axis(axis)
+		key = (self.collapse,axis,None if frame_range is None else tuple(frame_range))
+		if key not in self.display_mats:
+			mat = self.get_projections([axis],frame_range)[0]
+			mat = normalize(mat)*(self.escale)
+			if axis == self.image.get_axis('x'):
+				mat = mat.swapaxes(0,1)
+			self.display_mats[key] = mat
+		return self.display_mats[key]
+
 	def view_axis(self, figure, axis, frame_range=None):
 
-		if frame_range is None:
-			# collapse over frames using sum or max
-			frame = self.image.collapse_over_frames(method=self.collapse)
-		else:
-			fs = range(frame_range[0],frame_range[1]+1)
-			frames = np.stack([self.image.get_frame(k) for k in fs],axis=-1)
-			frame = self.image.collapse_over_frames(method=self.collapse,matrix=frames)
-		
 		if axis not in ['x','y','z',0,1,2]:
 			raise ValueError('Bad axis {}'.format(axis))
 
 		axis = self.image.get_axis(axis)
 
-		mat = getattr(frame,self.collapse)(axis=axis)
-		mat = normalize(mat)*(self.escale)
-		if axis in ['x',self.image.get_axis('x')]:
-			mat = mat.swapaxes(0,1)
+		mat = self.get_display_matrix(axis,frame_range)
 
 
 		ax = figure.add_subplot(111)
@@ -140,21 +208,10 @@ class ImageEditor:
 	def view_each_axis(self, figure, frame_range=None):
 		if figure is None:
 			raise ValueError('Need to include figure in argument')
-		if frame_range is None:
-			# collapse over frames using sum or max
-			frame = self.image.collapse_over_frames(method=self.collapse)
-		else:
-			fs = range(frame_range[0],frame_range[1]+1)
-			frames = np.stack([self.image.get_frame(k) for k in fs],axis=-1)
-			frame = self.image.collapse_over_frames(method=self.collapse,matrix=frames)
-		
-		# collapse and scale frame
-		xmat = getattr(frame,self.collapse)(axis=self.image.get_axis('x')).swapaxes(0,1)
-		ymat = getattr(frame,self.collapse)(axis=self.image.get_axis('y'))
-		zmat = getattr(frame,self.collapse)(axis=self.image.get_axis('z'))
-		xmat = normalize(xmat)*(self.escale)
-		ymat = normalize(ymat)*(self.escale)
-		zmat = normalize(zmat)*(self.escale)
+
+		# collapse all axes in one pass over the frames, then scale
+		self.get_projections(['x','y','z'],frame_range)
+		xmat,ymat,zmat = [self.get_display_matrix(axis,frame_range) for axis in ['x','y','z']]
 
 		ax_title = {0:'x axis', 1:'y axis', 2:'z axis'}
 		ax1 = figure.add_subplot(221)
@@ -175,47 +232,25 @@ class ImageEditor:
 
 	def static_cutter(self, figure, frame_range=None):
 
-		def add_lines(ax):
-			for cut in self.image.cuts:
-				coords = cut.cut_coords
-				xs = coords[0]
-				ys = coords[1]
-				xmax,xmin = max(xs),min(xs)
-				ymax,ymin = max(ys),min(ys)
-				ax.plot((xmin,xmax),(ymax,ymax),color=cut.linecolor)
-				ax.plot((xmin,xmin),(ymin,ymax),color=cut.linecolor)
-				ax.plot((xmin,xmax),(ymin,ymin),color=cut.linecolor)
-				ax.plot((xmax,xmax),(ymin,ymax),color=cut.linecolor)
-
-			for x,y in self.current_cut:
-				d = self.cxlen
-				ax.plot((x,x),(y-d,y+d),'r-')
-				ax.plot((x-d,x+d),(y,y),'r-')
-
-
 		axis = 'z'
-
-		if frame_range is None:
-			# collapse over frames using sum or max
-			frame = self.image.collapse_over_frames(method=self.collapse)
-		else:
-			fs = range(frame_range[0],frame_range[1]+1)
-			frames = np.stack([self.image.get_frame(k) for k in fs],axis=-1)
-			frame = self.image.collapse_over_frames(method=self.collapse,matrix=frames)
-		
 		axis = self.image.get_axis(axis)
 
-		mat = getattr(frame,self.collapse)(axis=axis)
-		mat = normalize(mat)*(self.escale)
-		if axis in ['x',self.image.get_axis('x')]:
-			mat = mat.swapaxes(0,1)
+		mat = self.get_display_matrix(axis,frame_range)
 
 
 		ax = figure.add_subplot(111)
 		ax.set_title('{} axis'.format(self.image.inv_ax_map[axis]))
 		ax.imshow(mat,cmap="gray",clim=(0,1))
 		
-		add_lines(ax)
+		# the cut boxes and crosshairs are animated artists, left out of the figure 
+		# and blitted over a copy of it, so a click does not redraw the image
+		self.overlay = [ax.plot(*box_lines(cut.cut_coords),color=cut.linecolor,animated=True)[0] 
+						for cut in self.image.cuts]
+		self.crosshairs = ax.plot([],[],'r-',animated=True)[0]
+		self.overlay.append(self.crosshairs)
+		self.overlay_background = None
+		self.set_crosshairs()
+		figure.canvas.mpl_connect('draw_event',self.on_cutter_draw)
 
 		ax.set_xlim(0,mat.shape[1])
 		ax.set_ylim(0,mat.shape[0])
@@ -223,26 +258,55 @@ class ImageEditor:
 
 		return
 
+	def set_crosshairs(self):
+		xs,ys = [],[]
+		d = self.cxlen
+		for x,y in self.current_cut:
+			xs += [x,x,np.nan,x-d,x+d,np.nan]
+			ys += [y-d,y+d,np.nan,y,y,np.nan]
+		self.crosshairs.set_data(xs,ys)
+
+	def on_cutter_draw(self, event):
+		'''
+		keeps a copy of the figure without the overlay after each full draw, then
+		draws the overlay on it
+		'''
+		canvas = event.canvas
+		self.overlay_background = canvas.copy_from_bbox(canvas.figure.bbox)
+		for artist in self.overlay:
+			canvas.figure.draw_artist(artist)
+
+	def update_overlay(self):
+		'''
+		redraws the crosshairs of the clicks of the current cut over the static cutter
+		'''
+		if self.crosshairs is None:
+			return
+		self.set_crosshairs()
+		canvas = self.crosshairs.figure.canvas
+		if self.overlay_background is None or not canvas.supports_blit:
+			canvas.draw_idle()
+			return
+		canvas.restore_region(self.overlay_background)
+		for artist in self.overlay:
+			canvas.figure.draw_artist(artist)
+		canvas.blit(canvas.figure.bbox)
+
 
 
 
 	def show_cut(self, figure, ix):
 		print('Showing cut {}'.format(ix))
 		cut = self.image.cuts[ix]
-		(xmin,xmax),(ymin,ymax) = cut.cut_coords
 		axis = 'z'
 		axis = self.image.get_axis(axis)
 
 		ax1 = figure.add_subplot(121)
 		ax2 = figure.add_subplot(122)
 
-		# cut image
-		cutframe = cut.collapse_over_frames(method=self.collapse)
-		cutmat = getattr(cutframe,self.collapse)(axis=axis)
-
-		# original image
-		frame = self.image.collapse_over_frames(method=self.collapse)
-		mat = getattr(frame,self.collapse)(axis=axis)
+		# original image, and the cut image sliced from it
+		mat = self.get_projections([axis])[0]
+		cutmat = centered_cut(mat,cut.cut_coords)
 
 		# normalize both the same
 		maxval = mat.max()
@@ -256,10 +320,7 @@ class ImageEditor:
 		ax1.set_ylim(0,mat.shape[0])
 
 		# draw box around cut mouse
-		ax1.plot((xmin,xmax),(ymax,ymax),color=cut.linecolor)
-		ax1.plot((xmin,xmin),(ymin,ymax),color=cut.linecolor)
-		ax1.plot((xmin,xmax),(ymin,ymin),color=cut.linecolor)
-		ax1.plot((xmax,xmax),(ymin,ymax),color=cut.linecolor)
+		ax1.plot(*box_lines(cut.cut_coords),color=cut.linecolor)
 
 		# plot cut image
 		ax2.imshow(cutmat,cmap="gray",clim=(0,1))
@@ -280,29 +341,20 @@ class ImageEditor:
 		ncols = 2
 		nrows = math.ceil(len(cuts)/2.0)
 
-		for i,cut in enumerate(cuts):
-
-			(xmin,xmax),(ymin,ymax) = cut.cut_coords
-			axis = 'z'
-			axis = self.image.get_axis(axis)
-
-			ax = figure.add_subplot("{}{}{}".format(nrows,ncols,i+1))
+		# original image, the same for every cut
+		axis = 'z'
+		mat = self.get_display_matrix(axis)
 
-			# original image
-			frame = self.image.collapse_over_frames(method=self.collapse)
-			mat = getattr(frame,self.collapse)(axis=axis)
-			mat = normalize(mat)*self.escale
+		for i,cut in enumerate(cuts):
 
+			ax = figure.add_subplot(nrows,ncols,i+1)
 			
 			ax.imshow(mat,cmap="gray",clim=(0,1))
 			ax.set_xlim(0,mat.shape[1])
 			ax.set_ylim(0,mat.shape[0])
 
 			# draw red box around cut mouse
-			ax.plot((xmin,xmax),(ymax,ymax),color=cut.linecolor)
-			ax.plot((xmin,xmin),(ymin,ymax),color=cut.linecolor)
-			ax.plot((xmin,xmax),(ymin,ymin),color=cut.linecolor)
-			ax.plot((xmax,xmax),(ymin,ymax),color=cut.linecolor)
+			ax.plot(*box_lines(cut.cut_coords),color=cut.linecolor)
 
 
 
@@ -538,27 +590,25 @@ class ImageEditor:
 		# for splitting collapsed data into frames
 		split_frames = lambda x: self.image.split_on_axis(x,2)
 		
-		# get the data
-		fdata = self.image.img_data	# free this
+		# get the data, cached
 		axis = self.image.get_axis(view_ax)
-		fdata = getattr(fdata,self.collapse)(axis=axis)
+		fdata = self.get_frame_projections(axis)
 
 		# always careful division
 		max_val = fdata.max()
 		scale = self.escale/max_val if not_zero(max_val) else self.escale
-		fdata = fdata*scale
 
-		fmats = split_frames(fdata)
-		nframes = len(fmats)
-		fdata = None # freed
-		
-
-		cuts = self.image.cuts # free this
-		cuts = [cut.img_data for cut in cuts]
+		# cuts span the whole z axis, so their z views are sliced from that of the original image
+		if axis == self.image.get_axis('z'):
+			cuts = [centered_cut(fdata,cut.cut_coords)*scale for cut in self.image.cuts]
+		else:
+			cuts = [getattr(cut.img_data,self.collapse)(axis=axis)*scale for cut in self.image.cuts]
+		cuts = [split_frames(img_data) for img_data in cuts]
 		ncuts = len(cuts)
 
-		cuts = [getattr(img_data,self.collapse)(axis=axis)*scale for img_data in cuts]  # freed
-		cuts = [split_frames(img_data) for img_data in cuts]
+		fmats = split_frames(fdata*scale)
+		nframes = len(fmats)
+		fdata = None # freed
 		
 		if len(fmats) == 1:
 			fmats = fmats + fmats
@@ -674,6 +724,30 @@ class ImageEditor:
 def not_zero(val):
 	return abs(val)>10**-100
 
+def box_lines(cut_coords):
+	'''
+	xs and ys of the outline of the box of cut_coords, for one plot call
+	'''
+	xs,ys = cut_coords
+	xmax,xmin = max(xs),min(xs)
+	ymax,ymin = max(ys),min(ys)
+	return (xmin,xmax,xmax,xmin,xmin),(ymin,ymin,ymax,ymax,ymin)
+
+def centered_cut(mat, cut_coords):
+	'''
+	part of a z axis projection (y, x, ...) inside the box of cut_coords, centered in zeros 
+	of the shape of the projection as BaseImage.submemmap centers the image of a cut
+	'''
+	(xmin,xmax),(ymin,ymax) = cut_coords
+	part = mat[ymin:ymax,xmin:xmax]
+	index = []
+	for k in range(2):
+		start = round(mat.shape[k]/2) - round(part.shape[k]/2)
+		index.append(slice(start,start+part.shape[k]))
+	cutmat = np.zeros(mat.shape,dtype=mat.dtype)
+	cutmat[tuple(index)] = part
+	return cutmat
+
 def normalize(nparray):
 	max_val = nparray.max()
 	if not_zero(max_val):
@@ -0,0 +1,145 @@
+"""
+Scratch space for the memmaps of loaded images and cuts.
+
+A ScratchSpace is a directory under the scratch root (the system temp directory, or $SOM_SCRATCH_DIR) that is
+removed when the space is closed or at exit. A memmap made with ScratchSpace.memmap() is deleted once no array uses
+it. Each directory records the process that owns it, and directories of processes that are no longer running are
+swept when the first space is created.
+"""
+import os
+import errno
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import weakref
+import numpy as np
+
+PREFIX = 'som_'
+OWNER_FILE = '.owner'
+MIN_FREE = 2**28  # 256 MB left free on the scratch disk
+
+scratch_root = os.environ.get('SOM_SCRATCH_DIR') or None
+live_spaces = weakref.WeakSet()
+installed = False
+
+
+def get_scratch_root():
+    return scratch_root or tempfile.gettempdir()
+
+
+def is_running(pid):
+    if os.name == 'nt':
+        # os.kill would terminate the process on Windows
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return False
+        exit_code = ctypes.c_ulong()
+        kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))
+        kernel32.CloseHandle(handle)
+        return exit_code.value == 259  # STILL_ACTIVE
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def sweep(root=None):
+    '''
+    remove the scratch directories left under root by processes of this computer that are no longer running
+    '''
+    root = root or get_scratch_root()
+    host = socket.gethostname()
+    if not os.path.isdir(root):
+        return
+    for entry in os.listdir(root):
+        path = os.path.join(root,entry)
+        if not entry.startswith(PREFIX) or not os.path.isdir(path):
+            continue
+        try:
+            with open(os.path.join(path,OWNER_FILE)) as f:
+                owner_host, pid = f.read().split()
+        except (OSError, ValueError):
+            continue
+        if owner_host == host and not is_running(int(pid)):
+            shutil.rmtree(path, ignore_errors=True)
+            print('Removed tempdir: {}'.format(path))
+
+
+def close_all():
+    for space in list(live_spaces):
+        space.close()
+
+
+def on_sigterm(signum, frame):
+    close_all()
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
+
+
+def install_cleanup():
+    global installed
+    if installed:
+        return
+    installed = True
+    if threading.current_thread() is threading.main_thread() and signal.getsignal(signal.SIGTERM) in (signal.SIG_DFL, None):
+        signal.signal(signal.SIGTERM, on_sigterm)
+    sweep()
+
+
+class ScratchSpace:
+
+    def __init__(self, root=None):
+        install_cleanup()
+        root = root or get_scratch_root()
+        os.makedirs(root, exist_ok=True)
+        self.path = tempfile.mkdtemp(prefix=PREFIX, dir=root)
+        with open(os.path.join(self.path,OWNER_FILE),'w') as f:
+            f.write('{} {}'.format(socket.gethostname(),os.getpid()))
+        self.closed = False
+        # also removes the directory if the space is garbage collected or still open at exit
+        self.finalizer = weakref.finalize(self, shutil.rmtree, self.path, ignore_errors=True)
+        live_spaces.add(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def memmap(self, name, dtype, shape):
+        '''
+        new memmap in the space, deleted once no array uses it any more
+        '''
+        if self.closed:
+            raise ValueError('Scratch space {} is closed'.format(self.path))
+        nbytes = int(np.prod(shape))*np.dtype(dtype).itemsize
+        free = shutil.disk_usage(self.path).free
+        if free - nbytes < MIN_FREE:
+            raise OSError(errno.ENOSPC, 'Not enough free space in {} for a {} MB image ({} MB free)'.format(
+                self.path, nbytes//2**20, free//2**20))
+
+        path = os.path.join(self.path,name)
+        mm = np.memmap(path, mode='w+', dtype=dtype, shape=tuple(shape))
+        weakref.finalize(mm, try_remove, path)
+        return mm
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.finalizer()
+        live_spaces.discard(self)
+
+
+def try_remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass  # removed with the space, or still mapped on Windows
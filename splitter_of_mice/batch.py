@@ -0,0 +1,312 @@
+"""
+Batch mode for the hotel splitter wrapper (run.py): split and upload many hotel image sessions in one long-lived
+process instead of starting a new container per session.
+
+Sessions are read from a JSON Lines manifest, or picked up from a spool directory in which each session is a
+.json file. Each line / file is a JSON object with the run.py arguments for one session:
+
+    {"project": "PROJ", "experiment": "Hotel_01", "input_dir": "/input/Hotel_01", "margin": 6}
+
+output_dir is optional and defaults to <output_root>/<project>/<experiment>. The XNAT credentials and server are
+shared by every session and given on the command line.
+
+Sessions are split by a pool of worker processes. Each worker imports the splitter once and keeps a single
+authenticated HTTP session for all of the hotel sessions it handles. A JSON result record is written per session
+to the results directory; sessions that already have a complete record are skipped, so an interrupted batch can
+simply be started again.
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import signal
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+
+
+from run import run
+from xnat_client import pooled_session
+
+logger = logging.getLogger(__name__)
+
+# Per worker process HTTP session, reused for every hotel session the worker splits
+worker_session = None
+
+
+def init_worker(username: str, password: str, log_level: str, xnat_workers: int = 4):
+    global worker_session
+
+    logging.basicConfig(handlers=[logging.StreamHandler(sys.stdout)],
+                        level=logging.getLevelName(log_level),
+                        format='%(asctime)s - %(levelname)s - %(process)d - %(name)s - %(message)s')
+
+    # Leave graceful shutdown to the parent process; a worker always finishes its current session
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    # One session per worker, with its connection pool mounted once and reused by every session split
+    worker_session = pooled_session((username, password), max_workers=xnat_workers)
+
+
+def result_path(results_dir: str, job: dict):
+    return os.path.join(results_dir, f"{job['project']}_{job['experiment']}.json")
+
+
+def is_complete(results_dir: str, job: dict):
+    try:
+        with open(result_path(results_dir, job)) as f:
+            return json.load(f).get('status') == 'complete'
+    except (FileNotFoundError, ValueError):
+        return False
+
+
+def write_result(results_dir: str, job: dict, result: dict):
+    path = result_path(results_dir, job)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(result, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def split_session(job: dict, server: str, output_root: str, results_dir: str, options: dict):
+    """
+    Split and upload one hotel session in a worker process and record the outcome
+    """
+    output_dir = job.get('output_dir') or os.path.join(output_root, job['project'], job['experiment'])
+    os.makedirs(output_dir, exist_ok=True)
+
+    result = {
+        'project': job['project'],
+        'experiment': job['experiment'],
+        'input_dir': job['input_dir'],
+        'output_dir': output_dir,
+        'status': 'running',
+        'error': None,
+        'started': datetime.now().isoformat(),
+    }
+
+    start = time.perf_counter()
+    try:
+        run(username=None, password=None, server=server, project=job['project'], experiment=job['experiment'],
+            input_dir=job['input_dir'], output_dir=output_dir, margin=job.get('margin'),
+            session=worker_session, **options)
+        result['status'] = 'complete'
+    except BaseException as e:
+        # run() reports failures with sys.exit, which must not take the worker down with it
+        if isinstance(e, KeyboardInterrupt):
+            raise
+        logger.exception(f"Failed to split {job['project']}/{job['experiment']}")
+        result['status'] = 'failed'
+        result['error'] = str(e)
+
+    result['finished'] = datetime.now().isoformat()
+    result['duration'] = round(time.perf_counter() - start, 3)
+    write_result(results_dir, job, result)
+
+    return result
+
+
+def read_manifest(manifest: str):
+    jobs = []
+    with open(manifest) as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            job = json.loads(line)
+            missing = [k for k in ('project', 'experiment', 'input_dir') if not job.get(k)]
+            if missing:
+                raise ValueError(f'{manifest}:{line_number} is missing {", ".join(missing)}')
+            jobs.append(job)
+    return jobs
+
+
+def claim_spool_jobs(spool_dir: str):
+    """
+    Claim new job files in the spool directory by renaming them to .claimed, so that several batch processes can
+    share one spool directory without splitting a session twice
+    """
+    jobs = []
+    for path in sorted(glob.glob(os.path.join(spool_dir, '*.json'))):
+        claimed_path = path[:-len('.json')] + '.claimed'
+        try:
+            os.rename(path, claimed_path)
+        except FileNotFoundError:
+            continue  # claimed by another process
+
+        try:
+            with open(claimed_path) as f:
+                job = json.load(f)
+        except ValueError as e:
+            logger.error(f'Ignoring unreadable job file {path}: {e}')
+            os.rename(claimed_path, path[:-len('.json')] + '.invalid')
+            continue
+
+        job['spool_file'] = claimed_path
+        jobs.append(job)
+    return jobs
+
+
+def finish_spool_job(job: dict, result: dict):
+    path = job.get('spool_file')
+    if path and os.path.exists(path):
+        os.rename(path, path[:-len('.claimed')] + ('.done' if result['status'] == 'complete' else '.failed'))
+
+
+def run_batch(username: str, password: str, server: str, output_root: str, results_dir: str,
+              manifest: str = None, spool_dir: str = None, workers: int = 1, poll_interval: float = 10,
+              log_level: str = 'INFO', **options):
+    """
+    Split every session in the manifest, or keep splitting sessions dropped in the spool directory until
+    interrupted. Returns the number of failed sessions.
+    """
+    os.makedirs(results_dir, exist_ok=True)
+    os.makedirs(output_root, exist_ok=True)
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        logger.info('Stopping after the sessions in progress have finished')
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    queued = read_manifest(manifest) if manifest else []
+    failed = 0
+    running = {}
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(username, password, log_level, options.get('xnat_workers', 4))) as pool:
+        while True:
+            if spool_dir and not stopping:
+                queued.extend(claim_spool_jobs(spool_dir))
+
+            while queued and not stopping and len(running) < workers:
+                job = queued.pop(0)
+                if is_complete(results_dir, job):
+                    logger.info(f"Skipping {job['project']}/{job['experiment']}, already split")
+                    continue
+                logger.info(f"Splitting {job['project']}/{job['experiment']}")
+                future = pool.submit(split_session, job, server, output_root, results_dir, options)
+                running[future] = job
+
+            if not running:
+                if stopping or not spool_dir:
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            done, _ = wait(running, timeout=poll_interval if spool_dir else None, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # the worker itself died (e.g. out of memory)
+                    logger.error(f"Worker failed while splitting {job['project']}/{job['experiment']}: {e}")
+                    result = {'project': job['project'], 'experiment': job['experiment'],
+                              'input_dir': job['input_dir'], 'status': 'failed', 'error': str(e)}
+                    write_result(results_dir, job, result)
+
+                if result['status'] != 'complete':
+                    failed += 1
+                logger.info(f"{job['project']}/{job['experiment']}: {result['status']}")
+                finish_spool_job(job, result)
+
+    return failed
+
+
+if __name__ == "__main__":
+
+    # parse arguments
+    p = argparse.ArgumentParser(description='Split many DICOM or Inveon PET/CT hotel image sessions in one '
+                                            'process and upload them to XNAT')
+    source = p.add_mutually_exclusive_group(required=True)
+    source.add_argument('--manifest', metavar='<str>', type=str,
+                        help='JSON Lines file with one session per line (project, experiment, input_dir and '
+                             'optionally output_dir and margin)')
+    source.add_argument('--spool-dir', metavar='<str>', type=str,
+                        help='directory to watch for session .json files; runs until interrupted')
+    p.add_argument('output_root', type=str, help='output directory; each session is written to '
+                                                 '<output_root>/<project>/<experiment> unless given in the job')
+    p.add_argument('--results-dir', metavar='<str>', type=str,
+                   help='directory of per-session result records [<output_root>/results]')
+    p.add_argument('-w', '--workers', metavar='<int>', type=int, default=1,
+                   help='number of sessions split in parallel [1]')
+    p.add_argument('--poll-interval', metavar='<float>', type=float, default=10,
+                   help='seconds between checks of the spool directory [10]')
+    p.add_argument('-l', '--log-level', metavar='<str>', type=str, default='INFO', help='logging level')
+    p.add_argument('-u', '--username', metavar='<str>', type=str, help='XNAT username')
+    p.add_argument('-p', '--password', metavar='<str>', type=str, help='XNAT password')
+    p.add_argument('-s', '--server', metavar='<str>', type=str, help='XNAT server')
+    p.add_argument('--stream', action='store_true',
+                   help='upload each subject as soon as all of its split images are written')
+    p.add_argument('--cache-dir', metavar='<str>', type=str, help='directory of cached detection results')
+    p.add_argument('--cache-size', metavar='<int>', type=int, default=2048,
+                   help='maximum size of the detection cache in MB [2048]')
+    p.add_argument('--xnat-workers', metavar='<int>', type=int, default=4,
+                   help='number of XNAT requests allowed in flight at once per session [4]')
+    p.add_argument('--state-db', metavar='<str>', type=str,
+                   help='SQLite file recording the progress of each session, so failed sessions resume where they '
+                        'stopped when the batch is run again')
+    p.add_argument('--metrics-dir', metavar='<str>', type=str,
+                   help='directory for a JSON stage report per session [no report]')
+    p.add_argument('--prometheus', action='store_true',
+                   help='also write each stage report as a Prometheus textfile in the metrics directory')
+    p.add_argument('--output-formats', metavar='<str>', type=str, nargs='+', choices=('nii', 'nii.gz', 'npz'),
+                   help='also write each split image as NIfTI (nii, nii.gz) and/or a compressed NumPy archive (npz)')
+    p.add_argument('--background-qc', action='store_true',
+                   help='render the QC snapshots on a background thread while the split images are uploaded')
+    p.add_argument('--qc-bundle', action='store_true',
+                   help='upload the QC snapshots of each session as a single bundle of WebP images at thumbnail, '
+                        'medium and full resolution with a manifest.json of the cut boxes')
+    p.add_argument('--align-pet-ct', action='store_true',
+                   help='correct the in-plane offset between the PET and CT images of each session before their '
+                        'cuts are coregistered')
+    p.add_argument('--reference-detection', action='store_true',
+                   help='detect the animals once per session, on the CT, and cut all other scans with the same boxes')
+    p.add_argument('--keep-dicom-files', action='store_true',
+                   help='also write the .dcm files of each split DICOM image next to its zip file')
+    p.add_argument('--max-memory', metavar='<size>', type=str,
+                   help='memory budget of each worker process, e.g. 4G (a plain number is MB). Also read from '
+                        '$SOM_MAX_MEMORY. [no limit]')
+    p.add_argument('--scratch-dir', metavar='<str>', type=str,
+                   help='directory for the tempfiles of the loaded images. Also read from $SOM_SCRATCH_DIR. '
+                        '[system temp directory]')
+    p.add_argument('--scratch-quota', metavar='<size>', type=str,
+                   help='maximum size of the tempfiles of each worker process, e.g. 20G. Also read from '
+                        '$SOM_SCRATCH_QUOTA. [no limit]')
+    p.add_argument('--volume-store-dir', metavar='<str>', type=str,
+                   help='directory of loaded image volumes shared by the workers, so that sessions split again are '
+                        'not decoded again. Also read from $SOM_VOLUME_STORE. [no store]')
+    p.add_argument('--volume-store-size', metavar='<size>', type=str,
+                   help='maximum size of the volume store, e.g. 50G. Also read from $SOM_VOLUME_STORE_SIZE. '
+                        '[no limit]')
+    p.add_argument('--profile', action='store_true',
+                   help='profile each session; artifacts are saved in <output_dir>/profile of the session')
+    p.add_argument('--profile-upload', action='store_true',
+                   help='attach each profile to the hotel scan record in XNAT')
+
+    kwargs = vars(p.parse_args())
+    kwargs['spool_dir'] = kwargs['spool_dir'] and os.path.abspath(kwargs['spool_dir'])
+    kwargs['results_dir'] = kwargs['results_dir'] or os.path.join(kwargs['output_root'], 'results')
+
+    # setup logging
+    logging.basicConfig(handlers=[logging.StreamHandler(sys.stdout)],
+                        level=logging.getLevelName(kwargs['log_level']),
+                        format='%(asctime)s - %(levelname)s - %(process)d - %(name)s - %(message)s')
+
+    logging.info('Starting xnat_run_splitter_of_mice batch program')
+
+    try:
+        failures = run_batch(**kwargs)
+    except Exception as e:
+        logging.error(f'Exception: {e}')
+        sys.exit(1)
+
+    sys.exit(1 if failures else 0)
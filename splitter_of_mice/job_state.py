@@ -0,0 +1,114 @@
+"""
+Persistent record of the progress of a split, so that a split interrupted by a crash or an XNAT error can resume
+from the last completed stage instead of starting again from the raw images.
+"""
+import json
+import logging
+import sqlite3
+import threading
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Stages of splitting one hotel image session, in order
+STAGES = ('discovered', 'loaded', 'detected', 'coregistered', 'written', 'zipped', 'uploaded', 'qc_published')
+
+
+class JobStateStore:
+    """
+    SQLite database of the completed stages of each hotel image session, keyed by project and experiment.
+
+    A stage may be completed for the whole session (item '') or for individual items such as a subject or a scan,
+    and carries a JSON detail dictionary, e.g. the zip files written for a subject. Several processes can share one
+    database file. Use ':memory:' for a store that is not persisted.
+    """
+
+    def __init__(self, path=':memory:'):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS stages (
+                    project TEXT NOT NULL,
+                    experiment TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    item TEXT NOT NULL DEFAULT '',
+                    detail TEXT,
+                    completed TEXT NOT NULL,
+                    PRIMARY KEY (project, experiment, stage, item)
+                )''')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def job(self, project, experiment):
+        return JobState(self, project, experiment)
+
+    def execute(self, sql, parameters=()):
+        with self.lock, self.connection:
+            return self.connection.execute(sql, parameters).fetchall()
+
+
+class JobState:
+    """
+    Completed stages of one hotel image session
+    """
+
+    def __init__(self, store, project, experiment):
+        self.store = store
+        self.project = project
+        self.experiment = experiment
+
+    def complete(self, stage, item='', **detail):
+        if stage not in STAGES:
+            raise ValueError(f'Unknown stage {stage}')
+
+        logger.debug(f'{self.project}/{self.experiment}: {stage} {item}'.rstrip())
+        self.store.execute('INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?, ?)',
+                           (self.project, self.experiment, stage, str(item), json.dumps(detail),
+                            datetime.now().isoformat()))
+
+    def is_complete(self, stage, item=''):
+        return self.detail(stage, item) is not None
+
+    def detail(self, stage, item=''):
+        """
+        Detail dictionary of a completed stage, or None if the stage has not been completed
+        """
+        rows = self.store.execute('SELECT detail FROM stages WHERE project=? AND experiment=? AND stage=? AND item=?',
+                                  (self.project, self.experiment, stage, str(item)))
+        return json.loads(rows[0][0]) if rows else None
+
+    def items(self, stage):
+        """
+        Items completed for a stage, with their detail dictionaries
+        """
+        rows = self.store.execute("SELECT item, detail FROM stages WHERE project=? AND experiment=? AND stage=? "
+                                  "AND item != '' ORDER BY completed", (self.project, self.experiment, stage))
+        return {item: json.loads(detail) for item, detail in rows}
+
+    def last_stage(self):
+        """
+        Latest stage completed for the whole session, or None
+        """
+        rows = self.store.execute("SELECT stage FROM stages WHERE project=? AND experiment=? AND item=''",
+                                  (self.project, self.experiment))
+        completed = {stage for stage, in rows}
+        return next((stage for stage in reversed(STAGES) if stage in completed), None)
+
+    def reset(self, from_stage=STAGES[0]):
+        """
+        Forget from_stage and every later stage
+        """
+        stages = STAGES[STAGES.index(from_stage):]
+        self.store.execute(f'DELETE FROM stages WHERE project=? AND experiment=? '
+                           f'AND stage IN ({",".join("?" * len(stages))})',
+                           (self.project, self.experiment, *stages))
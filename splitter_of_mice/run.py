@@ -4,7 +4,6 @@ import glob
 import json
 import logging
 import os
-import requests
 import sys
 import uuid
 import time
@@ -15,7 +14,18 @@ import numpy as np
 from collections import defaultdict
 from requests import Session
 from splitter_of_mice.splitter import SoM
-from splitter_of_mice.rectangle import Rect
+from splitter_of_mice import alignment
+from splitter_of_mice.coregistration import coregister_cuts
+from splitter_of_mice.geometry import boxes, session_geometries
+from splitter_of_mice.result_cache import ResultCache
+from xnat_client import AsyncXnatClient, pooled_session
+from instrumentation import StageReport, add_hook, remove_hook
+from profiling import Profiler
+import memory_budget
+import qc_renderer
+import scratch
+import volume_store
+from job_state import JobStateStore, JobState
 
 # Setup splitter of mice descriptor map
 SoM.desc_map = {'l': 'l', 'r': 'r', 'ctr': 'ctr', 'lb': 'lb', 'rb': 'rb', 'lt': 'lt', 'rt': 'rt'}
@@ -24,18 +34,63 @@ SoM.desc_map = {'l': 'l', 'r': 'r', 'ctr': 'ctr', 'lb': 'lb', 'rb': 'rb', 'lt':
 def run(username: str, password: str, server: str,
         project: str, experiment: str,
         input_dir: str, output_dir: str, margin: int, 
-        **kwargs):
-
-    # Create a session
-    session = requests.Session()
-    session.auth = (username, password)
+        xnat_workers: int = 4, stream: bool = False, cache_dir: str = None, cache_size: int = 2048,
+        state_db: str = None, metrics_dir: str = None, prometheus: bool = False,
+        profile: bool = False, profile_dir: str = None, profile_lines: bool = False, profile_upload: bool = False,
+        max_memory: str = None, scratch_dir: str = None, scratch_quota: str = None, output_formats: list = None,
+        keep_dicom_files: bool = False, background_qc: bool = False, qc_bundle: bool = False,
+        align_pet_ct: bool = False, reference_detection: bool = False,
+        volume_store_dir: str = None, volume_store_size: str = None, session: Session = None, **kwargs):
+
+    # Bound the memory used by loading, splitting and writing the images
+    if max_memory is not None:
+        memory_budget.set_max_memory(max_memory)
+    slow_paths_before = len(memory_budget.slow_paths)
+
+    # Where the tempfiles of the loaded images go
+    if scratch_dir is not None:
+        scratch.set_scratch_root(scratch_dir)
+    if scratch_quota is not None:
+        scratch.set_scratch_quota(scratch_quota)
+
+    # Reuse the loaded volumes of earlier runs on the same images
+    if volume_store_dir is not None:
+        volume_store.set_store_dir(volume_store_dir, volume_store_size)
+
+    # Profile the split, saving the artifacts next to the split images
+    profiler = None
+    if profile or profile_dir:
+        profile_dir = profile_dir or os.path.join(output_dir, 'profile')
+        profiler = Profiler(profile_dir, line_trace=profile_lines)
+        profiler.start()
+
+    # Record the time and memory used by each stage of the split
+    report = None
+    if metrics_dir:
+        report = StageReport()
+        add_hook(report)
+
+    # Create a session, unless an authenticated one is being reused (batch mode)
+    if session is None:
+        session = pooled_session((username, password), max_workers=xnat_workers)
+
+    # XNAT calls run in the background so they overlap with loading and splitting the images
+    xnat = AsyncXnatClient(session, server, max_workers=xnat_workers)
+    loaded_splitters = []
+
+    # Progress of the split, kept across runs when a state database is given
+    state_store = JobStateStore(state_db or ':memory:')
+    state = state_store.job(project, experiment)
 
     try:
         logging.debug(f'''run(username={username}, password=*****, server={server}, 
                        project={project}, experiment={experiment}, 
                        input_dir={input_dir}, output_dir={output_dir})''')
 
-        update_scan_record_status(session, server, project, experiment, status="Splitting In Progress")
+        xnat.submit_status(update_scan_record_status, project, experiment, status="Splitting In Progress")
+
+        # Prefetch the hotel scan record while the images are found and loaded
+        hotel_scan_record_future = xnat.submit(get_hotel_scan_record, project, experiment)
 
         logging.debug(f"Find subdirectories with DICOM files in {input_dir}")
 
@@ -59,148 +114,382 @@ def run(username: str, password: str, server: str,
 
         if len(files) == 0:
             logging.error(f'No DICOM or Inveon .img files found in {input_dir}. Exiting.')
-            update_scan_record_status(session, server, project, experiment, "Error: No DICOM or Inveon images files found")
+            xnat.submit_status(update_scan_record_status, project, experiment,
+                               "Error: No DICOM or Inveon images files found").result()
             sys.exit(f'No DICOM or Inveon images files found in {input_dir}')
 
-        #if we have more than two scans, we need to pair them up for coregistration. 
-        #we've decided to use scan time for this so we need to get the scan time for each scan
-        start_times_for_scans = {}
-        if len(files) > 2:
-            start_times_for_scans = get_start_times_for_scans(session, server, project, experiment, files)
-
-        #Create splitter and output directory for each subdirectory and prep them for coregistration if applicable
-        splitters_pet = []
-        splitters_ct = []
-        for dicom_dir in files.keys():
-            spltr = SoM(dicom_dir, dicom=isDicomSession)
-            output_directory = os.path.join(output_dir, os.path.relpath(dicom_dir, input_dir))
-            os.makedirs(output_directory, exist_ok=True)
-            spltr.outdir = os.path.join(output_dir, os.path.relpath(dicom_dir, input_dir))
-            if dicom_dir in start_times_for_scans:
-                spltr.scan_time = start_times_for_scans[dicom_dir]
-
-            #connect corresponding pet and ct scans for coregistration
-            if spltr.modality == 'CT':
-                splitters_ct.append(spltr)
-            else:
-                splitters_pet.append(spltr)
-        coregister_cuts = False
-        if (len(splitters_pet) == len(splitters_ct)):
-            coregister_cuts = True
-            splitters_pet = sorted(splitters_pet, key=lambda x: x.scan_time)
-            splitters_ct = sorted(splitters_ct, key=lambda x: x.scan_time)
-            splitters = list(zip(splitters_pet, splitters_ct))
+        # Start again if the images, output directory or margin changed, or the last run finished
+        discovered = state.detail('discovered')
+        if discovered is not None and (state.is_complete('uploaded') or
+                                       discovered != dict(input_dir=input_dir, output_dir=output_dir, margin=margin)):
+            state.reset()
+        state.complete('discovered', input_dir=input_dir, output_dir=output_dir, margin=margin)
+
+        # Reuse the zip files of an interrupted run if they are all still on disk
+        zipped = state.detail('zipped')
+        subject_zip_files = {subject: detail['zip_files'] for subject, detail in state.items('zipped').items()}
+        if zipped is not None and not all(os.path.exists(f) for zips in subject_zip_files.values() for f in zips):
+            logging.warning('Split images of an earlier run are missing. Splitting again.')
+            state.reset('loaded')
+            zipped = None
+
+        if zipped is not None:
+            logging.info(f'Resuming an earlier run of {experiment} after stage: {state.last_stage()}')
+            hotel_scan_record = hotel_scan_record_future.result()
+            uploader = SubjectUploader(xnat, state, project, experiment, output_dir, isDicomSession,
+                                       num_splitters=0)
+            for subject, zip_files in subject_zip_files.items():
+                uploader.subject_zip_files[subject] = [Path(zip_file) for zip_file in zip_files]
+            qc_outputs = zipped['qc_outputs']
+            qc_rendering = {}
         else:
-            splitters = splitters_pet + splitters_ct
-
-        # Get hotel scan record
-        hotel_scan_record = get_hotel_scan_record(session, server, project, experiment)
-        num_anim = sum(1 for subj in hotel_scan_record['hotelSubjects'] if subj.get('subjectId'))
-
-        # Convert hotel scan record to metadata dictionary format expected by splitter of mice
-        metadata = convert_hotel_scan_record(hotel_scan_record, dicom=isDicomSession, mpet=not isDicomSession)
-
-        # Get Technicians Perspective and rotate image if needed
-        technicians_perspective = hotel_scan_record.get('technicianPerspective', 'Front')
-        technicians_perspective = technicians_perspective.lower()
-
-        pet_cuts_for_coregister = None
-        pet_img_shape_for_coregister = None
-
-        for splitter in splitters:
-            if coregister_cuts:
-                splitter_pet = splitter[0]
-                splitter_ct = splitter[1]
-                if technicians_perspective == 'back':
-                    splitter_pet.pi.rotate_on_axis('y')
-                    splitter_ct.pi.rotate_on_axis('y')
-                run_splitter(splitter_pet, num_anim, metadata, coregister_cuts=True, margin=margin)
-                run_splitter(splitter_ct, num_anim, metadata, coregister_cuts=True, margin=margin)
+            #if we have more than two scans, we need to pair them up for coregistration. 
+            #we've decided to use scan time for this so we need to get the scan time for each scan
+            start_times_future = None
+            if len(files) > 2:
+                start_times_future = xnat.submit(get_start_times_for_scans, project, experiment, files)
+
+            # Reuse detection results from earlier runs on the same images
+            cache = ResultCache(cache_dir, max_size=cache_size * 1024 ** 2) if cache_dir else None
+
+            #Create splitter and output directory for each subdirectory and prep them for coregistration if applicable
+            splitters_pet = []
+            splitters_ct = []
+            for dicom_dir in files.keys():
+                spltr = SoM(dicom_dir, dicom=isDicomSession)
+                loaded_splitters.append(spltr)
+                output_directory = os.path.join(output_dir, os.path.relpath(dicom_dir, input_dir))
+                os.makedirs(output_directory, exist_ok=True)
+                spltr.outdir = os.path.join(output_dir, os.path.relpath(dicom_dir, input_dir))
+                spltr.cache = cache
+                spltr.output_formats = tuple(output_formats or ())
+                spltr.background_qc = background_qc
+                spltr.qc_bundle = qc_bundle
+                if isDicomSession and spltr.pi is not None:
+                    spltr.pi.loose_files = keep_dicom_files
+
+                #connect corresponding pet and ct scans for coregistration
+                if spltr.modality == 'CT':
+                    splitters_ct.append(spltr)
+                else:
+                    splitters_pet.append(spltr)
+            state.complete('loaded')
+
+            start_times_for_scans = start_times_future.result() if start_times_future is not None else {}
+            for spltr in splitters_pet + splitters_ct:
+                if spltr.filename in start_times_for_scans:
+                    spltr.scan_time = start_times_for_scans[spltr.filename]
+
+            coregister_cuts = False
+            if (len(splitters_pet) == len(splitters_ct)):
+                coregister_cuts = True
+                splitters_pet = sorted(splitters_pet, key=lambda x: x.scan_time)
+                splitters_ct = sorted(splitters_ct, key=lambda x: x.scan_time)
+                splitters = list(zip(splitters_pet, splitters_ct))
             else:
+                splitters = splitters_pet + splitters_ct
+
+            # Get hotel scan record
+            hotel_scan_record = hotel_scan_record_future.result()
+            num_anim = sum(1 for subj in hotel_scan_record['hotelSubjects'] if subj.get('subjectId'))
+
+            # Convert hotel scan record to metadata dictionary format expected by splitter of mice
+            metadata = convert_hotel_scan_record(hotel_scan_record, dicom=isDicomSession, mpet=not isDicomSession)
+
+            # Get Technicians Perspective and rotate image if needed
+            technicians_perspective = hotel_scan_record.get('technicianPerspective', 'Front')
+            technicians_perspective = technicians_perspective.lower()
+
+            # Send all scans for a subject together so the prearchive doesn't accidentally archive one scan before the other.
+            # When streaming, a subject is uploaded as soon as every splitter has written its zips for that subject.
+            all_splitters = [item for sublist in splitters for item in sublist] if coregister_cuts else splitters
+            uploader = SubjectUploader(xnat, state, project, experiment, output_dir, isDicomSession,
+                                       num_splitters=len(all_splitters), stream=stream)
+            if stream:
+                for splitter in all_splitters:
+                    splitter.on_cuts_added = uploader.expect
+                    splitter.on_cut_written = uploader.add
+
+            # Detect on one scan only and map its cuts to the others, which are then cut right away
+            reference = None
+            if reference_detection and len(all_splitters) > 1:
                 if technicians_perspective == 'back':
-                    splitter.pi.rotate_on_axis('y')
-                if splitter.modality == 'CT':
-                    run_splitter(splitter, num_anim, metadata, margin=margin)
+                    for splitter in all_splitters:
+                        splitter.pi.rotate_on_axis('y', log=True)
+                reference = split_with_reference(all_splitters, num_anim, metadata, margin)
+                for splitter in all_splitters:
+                    state.complete('detected', splitter.filename)
+                    if coregister_cuts:
+                        state.complete('coregistered', splitter.filename)
+
+            for splitter in splitters if reference is None else []:
+                if coregister_cuts:
+                    splitter_pet = splitter[0]
+                    splitter_ct = splitter[1]
+                    if technicians_perspective == 'back':
+                        splitter_pet.pi.rotate_on_axis('y', log=True)
+                        splitter_ct.pi.rotate_on_axis('y', log=True)
+                    run_splitter(splitter_pet, num_anim, metadata, coregister_cuts=True, margin=margin)
+                    run_splitter(splitter_ct, num_anim, metadata, coregister_cuts=True, margin=margin)
+                    state.complete('detected', splitter_pet.filename)
+                    state.complete('detected', splitter_ct.filename)
+                    harmonize_pet_and_ct_cuts(splitter_pet, splitter_ct, metadata, num_anim, align=align_pet_ct,
+                                              write=not stream)
+                    state.complete('coregistered', splitter_pet.filename)
+                    state.complete('coregistered', splitter_ct.filename)
                 else:
-                    run_splitter(splitter, num_anim, metadata, margin=margin)
-        if coregister_cuts:
-            for splitter in splitters:
-                harmonize_pet_and_ct_cuts(splitter[0], splitter[1], metadata, num_anim)
+                    if technicians_perspective == 'back':
+                        splitter.pi.rotate_on_axis('y', log=True)
+                    if splitter.modality == 'CT':
+                        run_splitter(splitter, num_anim, metadata, margin=margin)
+                    else:
+                        run_splitter(splitter, num_anim, metadata, margin=margin)
+                    state.complete('detected', splitter.filename)
+            if coregister_cuts and stream and reference is None:
+                # every pair is coregistered; write all of them one subject at a time, so that the first subjects
+                # are uploaded while the others are written
+                SoM.complete_cut_processes(all_splitters, metadata, True)
             #flatten out lists now that we're done with coregistration
-            splitters_flattened = [item for sublist in splitters for item in sublist]
-            splitters = splitters_flattened
-
-        # Upload each cut to XNAT
-        # Send all scans for a subject together so the prearchive doesn't accidentally archive one scan before the other.
-        subject_zip_files = defaultdict(list)
-        for splitter in splitters:
-            for zip_outputs in splitter.pi.zip_outputs:
-                subject, zip_file_path = zip_outputs
-                zip_file_path = Path(zip_file_path)
-                subject_zip_files[subject].append(zip_file_path)
-
-        if not isDicomSession:
-            # Merge the zip files for each subject into a single zip file
-            # The DICOM zip importer can handle multiple zip files for a single session but not the Inveon importer
-            for subject, zip_files in subject_zip_files.items():
-                if len(zip_files) > 1:
-                    # Create a new zip file for the subject
-                    merged_zip_file_path = os.path.join(output_dir, f'{subject}_merged.zip')
-                    with zipfile.ZipFile(merged_zip_file_path, 'w') as merged_zip_file:
-                        for zip_file_path in zip_files:
-                            # Open each zip file and extract all files into the new zip file
-                            with zipfile.ZipFile(zip_file_path, 'r') as zip_file:
-                                for file in zip_file.namelist():
-                                    merged_zip_file.writestr(file, zip_file.read(file))
-
-                    # Delete the old zip files
-                    for zip_file_path in zip_files:
-                        os.remove(zip_file_path)
-
-                    # Replace the list of zip files for the subject with the new merged zip file
-                    subject_zip_files[subject] = [Path(merged_zip_file_path)]
-
-        for subject, zip_files in subject_zip_files.items():
-            for zip_file_path in zip_files:
-                if subject:  # skip empty subjects
-                    send_split_images(session, server, project, subject, experiment, zip_file_path, isDicomSession)
-
-        delete_old_qc_images(session, server, project, experiment)
-        for splitter in splitters:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            modality = splitter.modality if splitter.modality else ""
-            send_qc_image(session, server, project, experiment,
-                          splitter.pi.qc_outputs, resource_name=f"QC_SNAPSHOTS_{timestamp}_{splitter.modality}")
+            splitters = all_splitters
+            state.complete('detected')
+            if coregister_cuts:
+                state.complete('coregistered')
+            state.complete('written')
+            # Upload each cut to XNAT
+            if not stream:
+                for splitter in splitters:
+                    for subject, zip_file_path in splitter.pi.zip_outputs:
+                        uploader.add(subject, zip_file_path)
+            qc_outputs = [(splitter.modality, splitter.pi.qc_outputs) for splitter in splitters]
+            qc_rendering = {splitter.pi.qc_outputs: splitter.qc_future for splitter in splitters
+                            if splitter.qc_future is not None}
+
+        # Subjects already uploaded by an interrupted run are skipped
+        uploads = uploader.flush()
+        state.complete('zipped', qc_outputs=qc_outputs)
+
+        # QC snapshots are published while the subject uploads are in flight
+        if not state.is_complete('qc_published'):
+            uploads.append(xnat.submit(publish_qc_images, state, project, experiment, qc_outputs, qc_rendering))
+
+        xnat.wait_all(uploads)
 
         # update hotel scan record
-        update_scan_record(session, server, experiment, hotel_scan_record)
+        xnat.submit(update_scan_record, experiment, hotel_scan_record).result()
 
         # update hotel scan record status
-        update_scan_record_status(session, server, project, experiment, status="Split Complete")
+        xnat.submit_status(update_scan_record_status, project, experiment, status="Split Complete").result()
+
+        # The session is finished; running it again starts from the beginning
+        state.complete('uploaded')
 
     except Exception as e:
         logging.exception("Fatal error while splitting hotel scan: " + str(e))
-        update_scan_record_status(session, server, project, experiment, "Error: Not Split")
+        xnat.submit_status(update_scan_record_status, project, experiment, "Error: Not Split").result()
         sys.exit("Fatal error while splitting hotel scan " + str(e))
 
+    finally:
+        xnat.close()
+
+        # Release the memmaps and temp directories of the loaded images
+        for splitter in loaded_splitters:
+            if splitter.pi is not None:
+                splitter.pi.unload_image()
+
+        slow_paths = memory_budget.slow_paths[slow_paths_before:]
+        if slow_paths:
+            logging.warning(f'The memory budget forced {len(slow_paths)} slower, disk backed path(s): '
+                            f'{", ".join(what for what, _ in slow_paths)}')
+
+        if report is not None:
+            remove_hook(report)
+            write_stage_report(report, metrics_dir, project, experiment, prometheus, slow_paths)
+
+        if profiler is not None:
+            profiler.stop()
+            if profile_upload:
+                try:
+                    send_profile(session, server, project, experiment, profile_dir)
+                except Exception as e:
+                    logging.warning(f'Unable to upload profile to XNAT: {e}')
+
+        # Closed last: nothing above records a stage once the XNAT client has been drained
+        state_store.close()
+
     return
 
 
+def write_stage_report(report: StageReport, metrics_dir: str, project: str, experiment: str, prometheus: bool,
+                       slow_paths: list = ()):
+    path = os.path.join(metrics_dir, f'{project}_{experiment}')
+    budget = {'max_memory_bytes': memory_budget.max_memory,
+              'slow_paths': [{'what': what, 'bytes': nbytes} for what, nbytes in slow_paths]}
+    try:
+        report.write_json(path + '.json', project=project, experiment=experiment, memory_budget=budget)
+        if prometheus:
+            report.write_prometheus(path + '.prom', project=project, experiment=experiment)
+        logging.info(f'Stage report written to {path}.json')
+    except OSError as e:
+        logging.warning(f'Unable to write stage report to {metrics_dir}: {e}')
+
+
 def run_splitter(splitter, num_anim, metadata, coregister_cuts=False, margin=None):
     #as CT scans are usually bigger, we're going to scale the margin for those cuts
     if margin is not None and splitter.modality == "CT":
         margin = margin*5
     exit_code = splitter.split_mice(num_anim=num_anim, remove_bed=True,
         zip=True, dicom_metadata=metadata, output_qc=True,
-        coregister_cuts=coregister_cuts, margin=margin)
+        coregister_cuts=coregister_cuts, margin=margin, output_formats=splitter.output_formats)
     if exit_code != 0:
         raise Exception(f'Error splitting subdirectory {os.path.dirname(splitter.filename)}')
 
 
-def harmonize_pet_and_ct_cuts(splitter_pet, splitter_ct, metadata, num_anim):
+class SubjectUploader:
+    """
+    Collects the zip files written for each subject and hands them to the XNAT client for upload.
+
+    All of a subject's zip files are uploaded together. In streaming mode each of the num_splitters splitters of
+    the session reports the subjects of its cuts (expect) before writing them, and a subject is uploaded as soon as
+    all splitters have reported and one zip file has been added for each of its cuts; any other subject is uploaded
+    by flush(). The zip files of each subject and the subjects uploaded successfully are recorded in the job state,
+    and subjects already uploaded by an earlier run are skipped.
+    """
+
+    def __init__(self, xnat: AsyncXnatClient, state: JobState, project: str, experiment: str, output_dir: str,
+                 dicom: bool, num_splitters: int, stream: bool = False):
+        self.xnat = xnat
+        self.state = state
+        self.project = project
+        self.experiment = experiment
+        self.output_dir = output_dir
+        self.dicom = dicom
+        self.num_splitters = num_splitters
+        self.stream = stream
+        self.subject_zip_files = defaultdict(list)
+        # number of zip files expected for each subject, from the splitters that have reported their cuts
+        self.expected_zips = defaultdict(int)
+        self.reported = 0
+        self.uploaded = set()
+        self.uploads = []
+
+    def expect(self, subjects):
+        """
+        Record the subjects of the cuts of one splitter, one entry per cut, before they are written
+        """
+        for subject in subjects:
+            self.expected_zips[subject] += 1
+        self.reported += 1
+        for subject in list(self.subject_zip_files.keys()):
+            self.upload_if_complete(subject)
+
+    def add(self, subject, zip_file_path):
+        self.subject_zip_files[subject].append(Path(zip_file_path))
+        self.upload_if_complete(subject)
+
+    def upload_if_complete(self, subject):
+        if (self.stream and subject not in self.uploaded and self.reported >= self.num_splitters and
+                len(self.subject_zip_files[subject]) >= self.expected_zips[subject]):
+            logging.info(f'All {len(self.subject_zip_files[subject])} zip files written for subject {subject}. '
+                         f'Starting upload.')
+            self.upload(subject)
+
+    def flush(self):
+        """
+        Upload every subject not uploaded yet and return the futures of all uploads
+        """
+        for subject in list(self.subject_zip_files.keys()):
+            if subject not in self.uploaded:
+                self.upload(subject)
+        return self.uploads
+
+    def upload(self, subject):
+        self.uploaded.add(subject)
+        if not subject:  # skip empty subjects
+            return
+
+        zip_files = self.subject_zip_files[subject]
+        if not self.dicom and len(zip_files) > 1:
+            # The DICOM zip importer can handle multiple zip files for a single session but not the Inveon importer
+            zip_files = [merge_subject_zip_files(self.output_dir, subject, zip_files)]
+            self.subject_zip_files[subject] = zip_files
+        self.state.complete('zipped', subject, zip_files=[str(zip_file) for zip_file in zip_files])
+
+        if self.state.is_complete('uploaded', subject):
+            logging.info(f'Subject {subject} was uploaded by an earlier run. Skipping upload.')
+            return
+
+        # Subjects are uploaded concurrently, each subject's zip files one after another
+        self.uploads.append(self.xnat.submit_upload(subject, self.send_subject, subject, zip_files))
+
+    def send_subject(self, session: Session, server: str, subject: str, zip_files: list):
+        for zip_file_path in zip_files:
+            send_split_images(session, server, self.project, subject, self.experiment, zip_file_path, self.dicom)
+
+        # Recorded by the upload itself so the stage is stored before the upload future completes
+        self.state.complete('uploaded', subject)
+
+
+def merge_subject_zip_files(output_dir: str, subject: str, zip_files: list):
+    # Create a new zip file for the subject
+    merged_zip_file_path = os.path.join(output_dir, f'{subject}_merged.zip')
+    with zipfile.ZipFile(merged_zip_file_path, 'w') as merged_zip_file:
+        for zip_file_path in zip_files:
+            # Open each zip file and extract all files into the new zip file
+            with zipfile.ZipFile(zip_file_path, 'r') as zip_file:
+                for file in zip_file.namelist():
+                    merged_zip_file.writestr(file, zip_file.read(file))
+
+    # Delete the old zip files
+    for zip_file_path in zip_files:
+        os.remove(zip_file_path)
+
+    return Path(merged_zip_file_path)
+
+
+def split_with_reference(splitters, num_anim, metadata, margin=None):
+    """
+    Detect the animals on one scan of the session and map its cuts through mm in the scanner frame to all other
+    scans, which skip detection and are cut straight away. The reference is the first scan, CT before PET, on which
+    all animals are found. A scan whose mapped cuts fail the sanity check of SoM.use_reference_cuts is detected on its
+    own. Returns the reference splitter.
+    """
+    reference = None
+    for candidate in sorted(splitters, key=lambda s: s.modality != 'CT'):
+        logging.info(f'Detecting on {candidate.filename} as the reference scan')
+        run_splitter(candidate, num_anim, metadata, coregister_cuts=True, margin=margin)
+        if len(candidate.cuts) >= max(num_anim, 1):
+            reference = candidate
+            break
+        logging.warning(f'Only {len(candidate.cuts)} of {num_anim} animals found on {candidate.filename}')
+    if reference is None:
+        raise Exception(f'No scan of the session to detect all {num_anim} animals on')
+
+    geometries = session_geometries(*[splitter.pi for splitter in splitters])
+    reference_geometry = geometries[splitters.index(reference)]
+    reference_boxes = reference_geometry.to_mm(boxes([cut['rect'] for cut in reference.cuts]))
+    for splitter, geometry in zip(splitters, geometries):
+        if splitter is reference:
+            continue
+        cuts = [{'desc': cut['desc'], 'rect': geometry.to_rect(box, label=cut['rect'].label)}
+                for cut, box in zip(reference.cuts, reference_boxes)]
+        # zipped as run_splitter would
+        if not splitter.use_reference_cuts(cuts, zip=True):
+            logging.warning(f'Detecting on {splitter.filename} instead')
+            run_splitter(splitter, num_anim, metadata, coregister_cuts=True, margin=margin)
+
+    SoM.complete_cut_processes(splitters, metadata, True)
+    return reference
+
+
+def harmonize_pet_and_ct_cuts(splitter_pet, splitter_ct, metadata, num_anim, align=False, write=True):
     pet_cuts, ct_cuts = splitter_pet.cuts, splitter_ct.cuts
-    pet_shape, ct_shape = splitter_pet.pi.img_data.shape, splitter_ct.pi.img_data.shape
-    x_scale, y_scale = (ct_shape[1]/pet_shape[1]), (ct_shape[2]/pet_shape[2])
+    # PET and CT boxes are mapped through mm in the scanner frame, from the pixel size and position in each header
+    pet_geometry, ct_geometry = session_geometries(splitter_pet.pi, splitter_ct.pi)
+    if align:
+        # correct the header geometry by the in-plane offset between the PET and CT projections; the PET detection
+        # projection is already the sum over z, the CT one is a single slice
+        pet_geometry = alignment.align(splitter_pet.pi, pet_geometry, splitter_ct.pi, ct_geometry,
+                                       pet_projection=splitter_pet.projection)
 
     if (len(pet_cuts) == 1 or splitter_pet.original_number_cuts > 2*num_anim) and len(ct_cuts) == 1 and num_anim > 1:
         #Sometimes users will upload an already cut image and try to split it again. In this case, we should alert them.
@@ -221,116 +510,26 @@ def harmonize_pet_and_ct_cuts(splitter_pet, splitter_ct, metadata, num_anim):
         #as such, we're going to default to the CT scan which does splitting in a less naive way
         replacement_pet_cuts = []
         for cut in ct_cuts:
-            cut_rect = cut['rect']
-            new_bb = [round(cut_rect.xlt/x_scale), round(cut_rect.ylt/y_scale), round(cut_rect.xrb/x_scale), round(cut_rect.yrb/y_scale)]
-            new_rect_one = Rect(bb=new_bb, label=cut_rect.label)
-            replacement_pet_cuts += [{'desc': cut['desc'], 'rect': new_rect_one}]
+            box = ct_geometry.to_mm(boxes([cut['rect']])[0])
+            replacement_pet_cuts += [{'desc': cut['desc'], 'rect': pet_geometry.to_rect(box, label=cut['rect'].label)}]
         #because we don't trust the pet cuts, we will not be changing the ct data in any way.
-        #simply replace the pet cuts with the scaled versions of the ct cuts
+        #simply replace the pet cuts with the ct cuts mapped to the pet image
         splitter_pet.cuts = replacement_pet_cuts
     elif len(splitter_ct.cuts) < num_anim:
         #the ct splitter wasn't able to find enough cuts. defaulting to the pet cuts.
         replacement_ct_cuts = []
         for cut in pet_cuts:
-            cut_rect = cut['rect']
-            new_bb = [round(cut_rect.xlt*x_scale), round(cut_rect.ylt*y_scale), round(cut_rect.xrb*x_scale), round(cut_rect.yrb*y_scale)]
-            new_rect_one = Rect(bb=new_bb, label=cut_rect.label)
-            replacement_ct_cuts += [{'desc': cut['desc'], 'rect': new_rect_one}]
+            box = pet_geometry.to_mm(boxes([cut['rect']])[0])
+            replacement_ct_cuts += [{'desc': cut['desc'], 'rect': ct_geometry.to_rect(box, label=cut['rect'].label)}]
         splitter_ct.cuts = replacement_ct_cuts
     else:
         #in this case, we have both PET and CT data that we are happy with. 
         #thus, we're performing coregistration
-        coregistered_cuts_ct = []
-        coregistered_cuts_pet = []
-        for cut in pet_cuts:
-            cut_rect = cut['rect']
-            bb = [cut_rect.xlt*x_scale, cut_rect.ylt*y_scale, cut_rect.xrb*x_scale, cut_rect.yrb*y_scale]
-            scaled_pet_rect = Rect(bb=bb, label=cut_rect.label)
-
-            filtered_cuts = list(filter(lambda x: x['desc'] == cut['desc'], ct_cuts))
-            connected_ct_cut = filtered_cuts[0]
-
-            if len(filtered_cuts) == 1:
-                #one to one relationship between pet and ct cuts. we can simply combine them without other processing.
-                ct_cuts.remove(connected_ct_cut)
-            elif len(filtered_cuts) == 2:
-                #two cuts were both mapped to within the same portion of the image. 
-                #combine them into one to try to get all relavent data into the same cut
-                combined_ct_rect, __ = combine_two_rects(filtered_cuts[0]['rect'], filtered_cuts[1]['rect'], [1.0, 1.0], [1.0, 1.0], None, False)
-                connected_ct_cut = {'desc': filtered_cuts[0]['desc'], 'rect': combined_ct_rect}
-                ct_cuts.remove(filtered_cuts[0])
-                ct_cuts.remove(filtered_cuts[1])
-            else:
-                #if we have more than 2 cuts in a given region we have a real problem so the splitter should throw an error
-                logging.error(f"Too many sessions within the region {cut['desc']}. Could not combine them.")
-                raise Exception(f"Too many sessions within the region {cut['desc']}")
-            
-            connected_ct_cut_rect = connected_ct_cut['rect']
-
-            new_ct_rect, new_pet_rect = combine_two_rects(connected_ct_cut_rect, scaled_pet_rect, [1.0,1.0], [x_scale, y_scale], ct_shape, True)
-
-            coregistered_cuts_ct += [{'desc': connected_ct_cut['desc'], 'rect': new_ct_rect}]
-            coregistered_cuts_pet += [{'desc': cut['desc'], 'rect': new_pet_rect}]
-        splitter_ct.cuts = coregistered_cuts_ct
-        splitter_pet.cuts = coregistered_cuts_pet
-
-    splitter_ct.complete_cut_process(metadata, True)
-    splitter_pet.complete_cut_process(metadata, True)
-
-
-def combine_two_rects(rect_one, rect_two, scale_for_rect_one, scale_for_rect_two, image_shape, adjust_size):
-    #first, we want to make sure that the two rectangles are of the same size. 
-    #expand the smaller of the two (in each dimension) so that they are now of equal size.
-    x_dimesion_max_size = max(rect_one.wid(), rect_two.wid())
-    y_dimension_max_size = max(rect_one.ht(), rect_two.ht())
-    rect_one.adjust_to_size([x_dimesion_max_size, y_dimension_max_size])
-    rect_two.adjust_to_size([x_dimesion_max_size, y_dimension_max_size])
-
-    new_rect_params = [(rect_one.xlt+rect_two.xlt)/2, (rect_one.ylt+rect_two.ylt)/2, (rect_one.xrb+rect_two.xrb)/2, (rect_one.yrb+rect_two.yrb)/2]
-    if adjust_size:
-        #to avoid the risk of the coregistration losing parts of the mouse, we are going to do a slight adjustment to expand the size of the cuts
-        #any adjustment must add an equal amount to both durections (within a single dimension) so as to retain the coregistration of data
-        rect_before_adjustment = Rect(bb=new_rect_params, label="pre_adjustment_rect")
-        dist_rect_one_x = (rect_before_adjustment.ctr()[0] - rect_one.ctr()[0])
-        dist_rect_one_y = (rect_before_adjustment.ctr()[1] - rect_one.ctr()[1])
-        dist_rect_two_x = (rect_before_adjustment.ctr()[0] - rect_two.ctr()[0])
-        dist_rect_two_y = (rect_before_adjustment.ctr()[1] - rect_two.ctr()[1])
-        max_distance_x = max(abs(dist_rect_one_x), abs(dist_rect_two_x))
-        max_distance_y = max(abs(dist_rect_one_y), abs(dist_rect_two_y))
-
-        #sometimes the cut coordinates are flipped at this point. 
-        #if so, we want to make sure that we're expanding and not contracting
-        x_flip = 1
-        if new_rect_params[0] > new_rect_params[2]:
-            x_flip = -1
-        y_flip = 1
-        if new_rect_params[1] > new_rect_params[3]:
-            y_flip = -1
-
-        if (max_distance_x/image_shape[1]) < .02:
-            #the size of the adjustment is small enough that we don't need to cap truncate it
-            new_rect_params[0] -= (max_distance_x*x_flip)
-            new_rect_params[2] += (max_distance_x*x_flip)
-        else:
-            #the distance of the changes has resulted in us hitting the top amount of expansion we want 
-            #so, as to avoid expanding into other quadrants of the image, we'll cap the expansion
-            new_rect_params[0] -= ((image_shape[1]*.02)*x_flip)
-            new_rect_params[2] += ((image_shape[1]*.02)*x_flip)
-
-        #repeat for the y dimension
-        if (max_distance_y/image_shape[2]) < .02:
-            new_rect_params[1] -= (max_distance_y*y_flip)
-            new_rect_params[3] += (max_distance_y*y_flip)
-        else:
-            new_rect_params[1] -= ((image_shape[2]*.02)*y_flip)
-            new_rect_params[3] += ((image_shape[2]*.02)*y_flip)
+        splitter_pet.cuts, splitter_ct.cuts, mapping = coregister_cuts(pet_cuts, ct_cuts, pet_geometry, ct_geometry)
+        logging.debug(f'PET/CT cut mapping: {mapping}')
 
-
-    new_rect_one_bb = [round((new_rect_params[0]/scale_for_rect_one[0])), round((new_rect_params[1]/scale_for_rect_one[1])), round((new_rect_params[2]/scale_for_rect_one[0])), round((new_rect_params[3]/scale_for_rect_one[1]))]
-    new_rect_one = Rect(bb=new_rect_one_bb, label=rect_one.label)
-    new_rect_two_bb = [round((new_rect_params[0]/scale_for_rect_two[0])), round((new_rect_params[1]/scale_for_rect_two[1])), round((new_rect_params[2]/scale_for_rect_two[0])), round((new_rect_params[3]/scale_for_rect_two[1]))]
-    new_rect_two = Rect(bb=new_rect_two_bb, label=rect_two.label)
-    return new_rect_one, new_rect_two
+    if write:
+        SoM.complete_cut_processes([splitter_pet, splitter_ct], metadata, True)
 
 
 def convert_hotel_scan_record(hotel_scan_record: dict, dicom: bool = False, mpet: bool = False):
@@ -517,6 +716,22 @@ def send_qc_image(session: Session, server: str, project: str, experiment: str,
             f'Failed to create QC image resource for project: {project} , session: {experiment}, status code: {r.status_code}')
         return False
 
+    # a QC bundle is uploaded once and extracted into the resource by XNAT
+    bundle = os.path.join(qc_image_path, qc_renderer.BUNDLE_NAME)
+    if os.path.exists(bundle):
+        url = (f"{server}/data/projects/{project}/experiments/{experiment}_scan_record"
+               f"/resources/{resource_name}/files/{qc_renderer.BUNDLE_NAME}?inbody=true&extract=true")
+
+        with open(bundle, 'rb') as f:
+            r = session.put(url, data=f)
+
+        if r.ok:
+            logging.info(f'QC bundle uploaded to project: {project} , session: {experiment}')
+            return True
+        logging.warning(
+            f'Failed to upload QC bundle to project: {project} , session: {experiment}, status code: {r.status_code}')
+        return False
+
     # put image files into scan record resource
     # glob png files from qc image path and all subdirectories
     qc_images = glob.glob(f'{qc_image_path}/**/*.png', recursive=True)
@@ -537,6 +752,57 @@ def send_qc_image(session: Session, server: str, project: str, experiment: str,
                     f'Failed to upload QC image {qc_image_name} to project: {project} , session: {experiment}, status code: {r.status_code}')
                 return False
 
+def send_profile(session: Session, server: str, project: str, experiment: str, profile_dir: str):
+    # attach the profile to the scan record in a resource of its own
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    resource_name = f"PROFILE_{timestamp}"
+    url = f"{server}/data/projects/{project}/experiments/{experiment}_scan_record/resources/{resource_name}?format=PROFILE&content=RAW"
+
+    r = session.put(url)
+    if not r.ok and r.status_code != 409:
+        raise Exception(f'Failed to create profile resource for project: {project} , session: {experiment}, '
+                        f'status code: {r.status_code}')
+
+    for profile_file in sorted(glob.glob(f'{profile_dir}/*')):
+        url = (f"{server}/data/projects/{project}/experiments/{experiment}_scan_record"
+               f"/resources/{resource_name}/files/{os.path.basename(profile_file)}?inbody=true")
+
+        with open(profile_file, 'rb') as f:
+            r = session.put(url, data=f)
+
+        if not r.ok:
+            raise Exception(f'Failed to upload {profile_file} to project: {project} , session: {experiment}, '
+                            f'status code: {r.status_code}')
+
+    logging.info(f'Profile uploaded to project: {project} , session: {experiment}, resource: {resource_name}')
+
+
+def send_qc_images(session: Session, server: str, project: str, experiment: str, qc_outputs: list,
+                   qc_rendering: dict = None):
+    # replace the QC snapshots of a previous run with one resource per (modality, qc output directory)
+    delete_old_qc_images(session, server, project, experiment)
+    for modality, qc_output in qc_outputs:
+        # snapshots still being rendered in the background are waited for; QC is informational, so a failed
+        # rendering does not fail the split
+        rendering = (qc_rendering or {}).get(qc_output)
+        if rendering is not None:
+            try:
+                rendering.result()
+            except Exception as e:
+                logging.warning(f'QC snapshots in {qc_output} could not be rendered: {e}')
+                continue
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        send_qc_image(session, server, project, experiment,
+                      qc_output, resource_name=f"QC_SNAPSHOTS_{timestamp}_{modality}")
+
+
+def publish_qc_images(session: Session, server: str, state, project: str, experiment: str, qc_outputs: list,
+                      qc_rendering: dict = None):
+    # the stage is recorded by the upload itself so it is stored before the upload future completes
+    send_qc_images(session, server, project, experiment, qc_outputs, qc_rendering)
+    state.complete('qc_published')
+
+
 def delete_old_qc_images(session: Session, server: str, project: str, experiment: str):
     url = f"{server}/data/projects/{project}/experiments/{experiment}_scan_record/resources/"
 
@@ -680,6 +946,70 @@ if __name__ == "__main__":
                                                                             experiment.
                                                                         """)
     p.add_argument('-m', '--margin', metavar='<int>', type=int, help="Optional input margin. Should be used if initial split is unsucessful because of too large/too small cuts.")
+    p.add_argument('--stream', action='store_true',
+                   help='upload each subject as soon as all of its split images are written instead of after the '
+                        'whole session has been split')
+    p.add_argument('--cache-dir', metavar='<str>', type=str,
+                   help='directory of cached detection results. Re-running a split on the same images and detection '
+                        'parameters (e.g. with only a new margin) skips animal detection. [no cache]')
+    p.add_argument('--cache-size', metavar='<int>', type=int, default=2048,
+                   help='maximum size of the detection cache in MB; least recently used entries are evicted [2048]')
+    p.add_argument('--xnat-workers', metavar='<int>', type=int, default=4,
+                   help='number of XNAT requests (status updates, uploads, QC) allowed in flight at once [4]')
+    p.add_argument('--state-db', metavar='<str>', type=str,
+                   help='SQLite file recording the progress of the split. A failed run started again with the same '
+                        'arguments resumes from the split images already written and skips subjects already '
+                        'uploaded. [not recorded]')
+    p.add_argument('--metrics-dir', metavar='<str>', type=str,
+                   help='directory for a JSON report of the wall time, CPU time, bytes read and written and peak '
+                        'memory of each stage of the split (<project>_<experiment>.json) [no report]')
+    p.add_argument('--prometheus', action='store_true',
+                   help='also write the stage report as a Prometheus textfile (<project>_<experiment>.prom) in the '
+                        'metrics directory, e.g. for the node exporter textfile collector')
+    p.add_argument('--output-formats', metavar='<str>', type=str, nargs='+', choices=('nii', 'nii.gz', 'npz'),
+                   help='also write each split image as NIfTI (nii, nii.gz) and/or a compressed NumPy archive (npz) '
+                        'in the output directory. These are not uploaded.')
+    p.add_argument('--background-qc', action='store_true',
+                   help='render the QC snapshots on a background thread while the split images are uploaded')
+    p.add_argument('--qc-bundle', action='store_true',
+                   help='write the QC snapshots as a single qc_bundle.zip of WebP images at thumbnail, medium and full '
+                        'resolution with a manifest.json of the cut boxes, uploaded and extracted in one request')
+    p.add_argument('--align-pet-ct', action='store_true',
+                   help='correct the in-plane offset between the PET and CT images, estimated by phase correlation '
+                        'of their axial projections, before their cuts are coregistered')
+    p.add_argument('--reference-detection', action='store_true',
+                   help='detect the animals once, on the CT (or the first scan), and cut all other scans of the '
+                        'session with the same boxes in mm, checking only that each box holds its animal')
+    p.add_argument('--keep-dicom-files', action='store_true',
+                   help='also write the .dcm files of each split DICOM image to <output_dir>/<index>; by default they '
+                        'are only written to the zip file')
+    p.add_argument('--max-memory', metavar='<size>', type=str,
+                   help='memory budget of the split, e.g. 4G or 1500M (a plain number is MB). I/O is chunked to fit '
+                        'and arrays that do not fit are kept in memmaps on disk. Also read from $SOM_MAX_MEMORY. '
+                        '[no limit]')
+    p.add_argument('--scratch-dir', metavar='<str>', type=str,
+                   help='directory for the tempfiles of the loaded images, e.g. on a local NVMe disk or tmpfs. Also '
+                        'read from $SOM_SCRATCH_DIR. [system temp directory]')
+    p.add_argument('--scratch-quota', metavar='<size>', type=str,
+                   help='maximum size of the tempfiles of the split, e.g. 20G. Also read from $SOM_SCRATCH_QUOTA. '
+                        '[no limit]')
+    p.add_argument('--volume-store-dir', metavar='<str>', type=str,
+                   help='directory of loaded image volumes, stored compressed by input checksum so that splitting '
+                        'the same images again does not decode them again. Also read from $SOM_VOLUME_STORE. '
+                        '[no store]')
+    p.add_argument('--volume-store-size', metavar='<size>', type=str,
+                   help='maximum size of the volume store, e.g. 50G; least recently used volumes are evicted. Also '
+                        'read from $SOM_VOLUME_STORE_SIZE. [no limit]')
+    p.add_argument('--profile', action='store_true',
+                   help='profile the split with cProfile and take tracemalloc snapshots at stage boundaries')
+    p.add_argument('--profile-dir', metavar='<str>', type=str,
+                   help='directory for the profile artifacts; implies --profile [<output_dir>/profile]')
+    p.add_argument('--profile-lines', action='store_true',
+                   help='also time each line of the known hot functions (read_chunks, write_chunks, z_compress_ct, '
+                        'save_cut). Slows the split down.')
+    p.add_argument('--profile-upload', action='store_true',
+                   help='attach the profile artifacts to the hotel scan record in XNAT as a PROFILE_<timestamp> '
+                        'resource')
 
     kwargs = vars(p.parse_args())
 
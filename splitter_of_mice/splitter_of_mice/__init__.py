@@ -1,3 +1,5 @@
 from image_classes import BaseImage, SubImage, PETImage, CTImage, DicomImage
 from rectangle import Rect
 from splitter import SoM
+from result_cache import ResultCache
+from instrumentation import StageReport, add_hook, remove_hook
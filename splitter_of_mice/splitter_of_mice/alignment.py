@@ -0,0 +1,143 @@
+"""
+In-plane alignment of the PET and CT images of a hotel session by phase correlation of their axial projections.
+
+Both projections are resampled onto one grid in mm (geometry.Geometry) covering the PET field of view, at most
+GRID_SIZE pixels across, standardized and windowed. The peak of the inverse FFT of their normalized cross-power
+spectrum, weighted by a Gaussian low-pass (LOW_PASS) so that fine detail present in only one modality (the CT bed,
+noise) does not outweigh the animals, gives the offset of the CT relative to the PET, refined to a fraction of a grid
+pixel by a parabola through the peak and its neighbours. Offsets with a weak peak (peak to sidelobe ratio below
+MIN_PSR) or larger than MAX_OFFSET of the field of view are rejected, so a failed alignment leaves the header geometry
+unchanged.
+"""
+import logging
+
+import numpy as np
+from scipy import ndimage
+
+from instrumentation import instrumented
+
+# logging
+logger = logging.getLogger(__name__)
+
+# maximum number of pixels across the common grid
+GRID_SIZE = 128
+# standard deviation of the low-pass weighting of the cross-power spectrum, in cycles per grid pixel
+LOW_PASS = 0.15
+# minimum peak to sidelobe ratio: height of the correlation peak above the mean of the rest of the correlation, in
+# standard deviations (about 5 for unrelated images)
+MIN_PSR = 8.
+# half width in grid pixels of the peak, excluded from the sidelobe
+PEAK_RADIUS = 5
+# maximum offset, as a fraction of the field of view
+MAX_OFFSET = 0.25
+
+
+def axial_projection(image):
+    """
+    Sum of a loaded image over z (and frames), as float64
+    """
+    img = image.img_data
+    return np.sum(img, axis=(0, 3) if img.ndim == 4 else 0, dtype='float64')
+
+
+def common_grid(geometry):
+    """
+    Centers in mm of the pixels of a grid of at most GRID_SIZE pixels across covering the field of view of geometry,
+    and its pixel size
+    """
+    lo, hi = geometry.origin, geometry.origin + geometry.shape * geometry.step
+    lo, hi = np.minimum(lo, hi), np.maximum(lo, hi)
+    step = max(float(np.max(np.abs(geometry.step))), float(np.max(hi - lo)) / GRID_SIZE)
+    return [np.arange(lo[k] + step / 2, hi[k], step) for k in range(2)], step
+
+
+def resample(projection, geometry, centers, step):
+    """
+    Projection sampled at the (x, y) grid centers in mm, smoothed to the grid pixel size first
+    """
+    sigma = [max(0., 0.5 * (step / abs(s) - 1)) for s in geometry.step]
+    if max(sigma) > 0:
+        projection = ndimage.gaussian_filter(projection, sigma)
+    # pixel index coordinates of the centers
+    coordinates = [(c - geometry.origin[k]) / geometry.step[k] - 0.5 for k, c in enumerate(centers)]
+    grid = np.meshgrid(*coordinates, indexing='ij')
+    return ndimage.map_coordinates(projection, grid, order=1, mode='constant', cval=0.)
+
+
+def standardized(im):
+    im = im - im.mean()
+    std = im.std()
+    return im / std if std > 0 else im
+
+
+def peak_offset(r, index, axis):
+    """
+    Sub-pixel position of the peak of r along axis, from a parabola through the peak and its neighbours
+    """
+    n = r.shape[axis]
+    before, after = list(index), list(index)
+    before[axis], after[axis] = (index[axis] - 1) % n, (index[axis] + 1) % n
+    a, b, c = r[tuple(before)], r[index], r[tuple(after)]
+    denominator = a - 2 * b + c
+    delta = 0.5 * (a - c) / denominator if denominator != 0 else 0.
+    shift = index[axis] + float(np.clip(delta, -0.5, 0.5))
+    return shift - n if shift > n / 2 else shift
+
+
+def sidelobe_ratio(r, index):
+    sidelobe = np.ones(r.shape, dtype=bool)
+    rows = np.arange(index[0] - PEAK_RADIUS, index[0] + PEAK_RADIUS + 1) % r.shape[0]
+    columns = np.arange(index[1] - PEAK_RADIUS, index[1] + PEAK_RADIUS + 1) % r.shape[1]
+    sidelobe[np.ix_(rows, columns)] = False
+    std = r[sidelobe].std()
+    return float((r[index] - r[sidelobe].mean()) / std) if std > 0 else 0.
+
+
+def phase_correlation(a, b):
+    """
+    (shift, psr) of b relative to a, where b(p) ~ a(p - shift), in pixels per axis, and the peak to sidelobe ratio
+    """
+    window = np.outer(np.hanning(a.shape[0]), np.hanning(a.shape[1]))
+    fa = np.fft.rfft2(standardized(a) * window)
+    fb = np.fft.rfft2(standardized(b) * window)
+    cross = np.conj(fa) * fb
+    magnitude = np.abs(cross)
+    fy, fx = np.fft.fftfreq(a.shape[0])[:, None], np.fft.rfftfreq(a.shape[1])[None]
+    weights = np.exp(-(fx ** 2 + fy ** 2) / (2 * LOW_PASS ** 2))
+    cross *= weights / np.maximum(magnitude, magnitude.max() * 1e-6)
+    r = np.fft.irfft2(cross, s=a.shape)
+    index = np.unravel_index(int(np.argmax(r)), r.shape)
+    return np.array([peak_offset(r, index, axis) for axis in range(2)]), sidelobe_ratio(r, index)
+
+
+@instrumented('alignment')
+def estimate_offset(pet_projection, pet_geometry, ct_projection, ct_geometry):
+    """
+    (x, y) offset in mm of the CT relative to the PET, i.e. what is at m mm in the PET is at m + offset mm in the
+    CT, and the peak to sidelobe ratio of the correlation. The offset is None if the alignment is not trusted.
+    """
+    centers, step = common_grid(pet_geometry)
+    pet = resample(pet_projection, pet_geometry, centers, step)
+    ct = resample(ct_projection, ct_geometry, centers, step)
+    shift, psr = phase_correlation(pet, ct)
+    offset = shift * step
+
+    fov = np.array([len(c) for c in centers]) * step
+    if psr < MIN_PSR or np.any(np.abs(offset) > MAX_OFFSET * fov):
+        logger.warning(f'PET/CT alignment rejected: offset {offset.round(2).tolist()} mm, peak to sidelobe {psr:.1f}')
+        return None, psr
+    logger.info(f'PET/CT alignment: offset {offset.round(2).tolist()} mm, peak to sidelobe {psr:.1f}')
+    return offset, psr
+
+
+def align(pet_image, pet_geometry, ct_image, ct_geometry, pet_projection=None, ct_projection=None):
+    """
+    The PET geometry shifted so that its boxes map onto the CT as the images align, or unchanged if the alignment
+    is rejected. The axial projections are computed only if not given.
+    """
+    if pet_projection is None:
+        pet_projection = axial_projection(pet_image)
+    if ct_projection is None:
+        ct_projection = axial_projection(ct_image)
+    offset, _ = estimate_offset(pet_projection, pet_geometry, ct_projection, ct_geometry)
+    return pet_geometry if offset is None else pet_geometry.shifted(offset)
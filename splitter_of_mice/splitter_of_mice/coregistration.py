@@ -0,0 +1,110 @@
+"""
+Coregistration of the PET and CT cuts of a hotel session.
+
+The boxes of both modalities are placed in the common physical frame of the session (geometry.session_geometries).
+Every PET box is scored against every CT box at once, with cost
+
+    (1 - IoU) + distance between the box centers / diagonal of the field of view
+
+and the PET and CT cuts are paired by the assignment of least total cost (Hungarian algorithm), so the pairing does
+not depend on the quadrant names given to the cuts by each splitter and works for any number of animals.
+
+A CT cut left over by the assignment that overlaps a paired PET box is a part of the same animal detected as a
+separate region, and is merged into that pair. The PET and CT cuts of a pair are both the smallest box holding the
+boxes of the pair, in mm, in the pixels of each image. The result of match_cuts is a mapping, one entry per PET cut:
+
+    {'pet': 0, 'ct': [2, 3], 'iou': 0.81}
+
+with the indices of the CT cuts paired with PET cut 0 (empty if there are none) and the IoU of its first CT cut.
+"""
+import logging
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+from geometry import boxes, union
+
+# logging
+logger = logging.getLogger(__name__)
+
+# a pair whose boxes are further apart than this (in IoU) is logged as suspicious
+MIN_IOU = 0.1
+
+
+def iou_matrix(a, b):
+    """
+    Intersection over union of each box in a with each box in b, as an (len(a), len(b)) array
+    """
+    lt = np.maximum(a[:, None, :2], b[None, :, :2])
+    rb = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    intersection = np.prod(np.clip(rb - lt, 0, None), axis=2)
+    area_a = np.prod(a[:, 2:] - a[:, :2], axis=1)
+    area_b = np.prod(b[:, 2:] - b[:, :2], axis=1)
+    union = area_a[:, None] + area_b[None, :] - intersection
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+
+def center_distance_matrix(a, b):
+    ca, cb = (a[:, :2] + a[:, 2:]) / 2, (b[:, :2] + b[:, 2:]) / 2
+    return np.linalg.norm(ca[:, None] - cb[None, :], axis=2)
+
+
+def match_cuts(pet_boxes, ct_boxes, fov_diagonal):
+    """
+    Pair the PET and CT boxes, given in the same physical frame, and return the mapping described in the module
+    docstring
+    """
+    iou = iou_matrix(pet_boxes, ct_boxes)
+    cost = (1 - iou) + center_distance_matrix(pet_boxes, ct_boxes) / fov_diagonal
+    rows, cols = linear_sum_assignment(cost)
+
+    mapping = [{'pet': i, 'ct': [], 'iou': 0.} for i in range(len(pet_boxes))]
+    for i, j in zip(rows, cols):
+        mapping[i]['ct'].append(int(j))
+        mapping[i]['iou'] = float(iou[i, j])
+
+    # a leftover CT cut overlapping a paired PET box is part of the same animal
+    leftover = sorted(set(range(len(ct_boxes))) - set(cols.tolist()))
+    for j in leftover:
+        i = int(np.argmax(iou[:, j])) if len(pet_boxes) else None
+        if i is None or iou[i, j] == 0 or not mapping[i]['ct']:
+            logger.info(f'CT cut {j} does not overlap any PET cut and is dropped')
+            continue
+        mapping[i]['ct'].append(j)
+
+    for entry in mapping:
+        if entry['ct'] and entry['iou'] < MIN_IOU:
+            logger.warning(f"PET cut {entry['pet']} and CT cut {entry['ct'][0]} paired with IoU {entry['iou']:.2f}")
+    return mapping
+
+
+def coregister_cuts(pet_cuts, ct_cuts, pet_geometry, ct_geometry):
+    """
+    Pair the PET and CT cuts ({'desc', 'rect'}) of one hotel session, given the geometries of both images in a
+    common frame, and return the coregistered PET cuts, CT cuts and the mapping of match_cuts.
+
+    Both cuts of a pair take the desc of the PET cut so the cuts of one animal are given to the same subject. A PET
+    cut with no CT cut is used for both. Nothing is changed in place.
+    """
+    pet_boxes = pet_geometry.to_mm(boxes([c['rect'] for c in pet_cuts]))
+    ct_boxes = ct_geometry.to_mm(boxes([c['rect'] for c in ct_cuts]))
+    mapping = match_cuts(pet_boxes, ct_boxes, ct_geometry.fov_diagonal())
+
+    coregistered_pet, coregistered_ct = [], []
+    for entry in mapping:
+        cut = pet_cuts[entry['pet']]
+        label = cut['rect'].label
+        matched = sorted(entry['ct'])
+        if not matched:
+            logger.warning(f"No CT cut found for PET cut {cut['desc']}; using the PET cut for both")
+        elif len(matched) > 2:
+            # if we have more than 2 cuts in a given region we have a real problem
+            logger.error(f"Too many sessions within the region {cut['desc']}. Could not combine them.")
+            raise Exception(f"Too many sessions within the region {cut['desc']}")
+
+        box = union(np.concatenate([pet_boxes[entry['pet']:entry['pet'] + 1], ct_boxes[matched]]))
+        ct_label = ct_cuts[matched[0]]['rect'].label if matched else label
+        coregistered_ct.append({'desc': cut['desc'], 'rect': ct_geometry.to_rect(box, label=ct_label)})
+        coregistered_pet.append({'desc': cut['desc'], 'rect': pet_geometry.to_rect(box, label=label)})
+
+    return coregistered_pet, coregistered_ct, mapping
@@ -0,0 +1,113 @@
+"""
+Writers for cuts in formats read by analysis tools, written next to the Inveon or DICOM split images.
+
+- 'nii' / 'nii.gz': NIfTI-1, with an affine mapping voxels to mm from the voxel size and the position of the cut in
+  the hotel image (axes are the array axes of the image, not patient orientation). The stored values and the scale
+  factor are kept when all frames share one scale factor, otherwise the scaled values are written as float32.
+- 'npz': compressed NumPy archive with one array per frame (frame_0000, ...), so that a single frame can be read
+  without decompressing the others, plus the scale factor of each frame, the voxel size, the origin and the affine.
+"""
+import logging
+import os
+import zipfile
+
+import nibabel as nib
+import numpy as np
+
+from instrumentation import instrumented
+
+# logging
+logger = logging.getLogger(__name__)
+
+FORMATS = ('nii', 'nii.gz', 'npz')
+
+
+def check_formats(formats):
+    unknown = [f for f in formats if f not in FORMATS]
+    if unknown:
+        raise ValueError(f'Unknown output format(s) {", ".join(unknown)}; use {", ".join(FORMATS)}')
+    return tuple(formats)
+
+
+def cut_affine(cut):
+    """
+    Affine from (x, y, z) voxel indices of the cut to mm in the hotel image
+    """
+    dz, dy, dx = cut.voxel_size()
+    z0, y0, x0 = cut.origin()
+    affine = np.diag([dx, dy, dz, 1.])
+    affine[:3, 3] = x0 * dx, y0 * dy, z0 * dz
+    return affine
+
+
+def output_path(cut, outdir, extension):
+    return os.path.join(outdir, os.path.splitext(os.path.basename(cut.out_filename))[0] + '.' + extension)
+
+
+@instrumented('write_nifti')
+def write_nifti(cut, outdir, compressed=True):
+    data = cut.img_data
+    factors = cut.frame_scale_factors()
+    slope = None
+    if factors is not None and np.ptp(factors) > 0:
+        data = cut.apply_scale(data).astype('float32')
+    elif factors is not None:
+        slope = float(factors[0])
+
+    # NIfTI axes are x, y, z, t; for a C ordered (z, y, x, t) array this is a Fortran ordered view
+    data = np.transpose(data, (2, 1, 0, 3))
+    if data.shape[-1] == 1:
+        data = data[..., 0]
+
+    affine = cut_affine(cut)
+    img = nib.Nifti1Image(data, affine)
+    img.set_qform(affine, code=1)
+    img.set_sform(affine, code=1)
+    if slope is not None:
+        img.header.set_slope_inter(slope, 0.)
+
+    frame_duration = getattr(cut.params, 'frame_duration', None)
+    if data.ndim == 4 and frame_duration is not None and len(frame_duration):
+        img.header.set_zooms(img.header.get_zooms()[:3] + (float(frame_duration[0]),))
+    img.header.set_xyzt_units('mm', 'sec')
+
+    path = output_path(cut, outdir, 'nii.gz' if compressed else 'nii')
+    nib.save(img, path)
+    return path
+
+
+@instrumented('write_npz')
+def write_npz(cut, outdir):
+    data = cut.img_data
+    nframes = data.shape[-1]
+    factors = cut.frame_scale_factors()
+    arrays = {
+        'scale_factor': np.ones(nframes) if factors is None else np.asarray(factors),
+        'voxel_size': np.asarray(cut.voxel_size(), dtype='float64'),
+        'origin': np.asarray(cut.origin()),
+        'affine': cut_affine(cut),
+    }
+
+    # written one frame at a time, as np.savez_compressed would need them all in memory
+    path = output_path(cut, outdir, 'npz')
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+        for name, array in arrays.items():
+            with zf.open(name + '.npy', 'w') as f:
+                np.lib.format.write_array(f, array, allow_pickle=False)
+        for frame in range(nframes):
+            with zf.open(f'frame_{frame:04d}.npy', 'w', force_zip64=True) as f:
+                np.lib.format.write_array(f, np.ascontiguousarray(data[..., frame]), allow_pickle=False)
+    return path
+
+
+def write_cut(cut, outdir, output_format):
+    """
+    Write a cut in one of FORMATS to outdir and return the path of the file
+    """
+    check_formats([output_format])
+    if output_format == 'npz':
+        path = write_npz(cut, outdir)
+    else:
+        path = write_nifti(cut, outdir, compressed=output_format == 'nii.gz')
+    logger.debug(f'Wrote {path}')
+    return path
@@ -0,0 +1,167 @@
+"""
+Physical geometry of the axial plane of the hotel images of a session: the map between the pixels of a Rect (x and y
+of a Rect are axes 1 and 2 of the image) and mm in the scanner frame, so that PET and CT boxes can be compared and
+shared exactly.
+
+Along each axis a pixel coordinate p (0 at the edge of the first pixel) is at origin + p * step mm, with the pixel
+size from the header (pixel_size of Inveon images, PixelSpacing of DICOM images). DICOM images are placed by their
+ImagePositionPatient and ImageOrientationPatient, so a PET and CT in the same frame of reference overlay exactly
+whatever their fields of view; images without a position (Inveon) are centered on the scanner axis. Flips made by
+BaseImage.rotate_on_axis are followed.
+"""
+import logging
+
+import numpy as np
+
+from rectangle import Rect
+
+# logging
+logger = logging.getLogger(__name__)
+
+
+def boxes(rects):
+    """
+    (n, 4) array of the corners (left, top, right, bottom) of rects, in increasing order
+    """
+    bb = np.array([[r.xlt, r.ylt, r.xrb, r.yrb] for r in rects], dtype=float).reshape(-1, 4)
+    return ordered(bb)
+
+
+def ordered(bb):
+    return np.concatenate([np.minimum(bb[..., :2], bb[..., 2:]), np.maximum(bb[..., :2], bb[..., 2:])], axis=-1)
+
+
+def union(bb):
+    """
+    Smallest box holding all boxes of an (n, 4) array
+    """
+    return np.concatenate([bb[:, :2].min(axis=0), bb[:, 2:].max(axis=0)])
+
+
+class Geometry:
+    """
+    Map between the pixels of the axial plane of an image and mm in the scanner frame
+    """
+
+    def __init__(self, shape, pixel_size, origin=None, axes=None):
+        self.shape = np.array(shape[:2], dtype=float)
+        self.step = np.array(pixel_size, dtype=float)
+        # mm of pixel coordinate 0 along each axis; the center of the field of view is at 0 mm if not positioned
+        self.positioned = origin is not None
+        self.origin = -self.shape * self.step / 2 if origin is None else np.array(origin, dtype=float)
+        # components of the patient frame along the two axes (DICOM only)
+        self.axes = axes
+
+    def __repr__(self):
+        return f'Geometry(shape={self.shape.tolist()}, step={self.step.tolist()}, origin={self.origin.tolist()})'
+
+    def to_mm(self, bb):
+        """
+        Boxes (..., 4) in pixels to boxes in mm
+        """
+        bb = np.asarray(bb, dtype=float)
+        return ordered(np.tile(self.origin, 2) + bb * np.tile(self.step, 2))
+
+    def to_pixels(self, bb):
+        """
+        Boxes (..., 4) in mm to boxes in (fractional) pixels
+        """
+        bb = np.asarray(bb, dtype=float)
+        return ordered((bb - np.tile(self.origin, 2)) / np.tile(self.step, 2))
+
+    def to_rect(self, box, label=None):
+        """
+        Rect of the pixels of a box in mm, within the image
+        """
+        bb = np.clip(self.to_pixels(box), 0, np.tile(self.shape, 2))
+        return Rect(bb=[int(round(v)) for v in bb], label=label)
+
+    def fov_diagonal(self):
+        return float(np.hypot(*(self.shape * np.abs(self.step))))
+
+    def flipped(self, axis):
+        """
+        The geometry of the image flipped along axis 0 (x) or 1 (y)
+        """
+        origin, step = self.origin.copy(), self.step.copy()
+        origin[axis] += self.shape[axis] * step[axis]
+        step[axis] = -step[axis]
+        flipped = Geometry(self.shape, step, origin, self.axes)
+        flipped.positioned = self.positioned
+        return flipped
+
+    def shifted(self, offset):
+        """
+        The geometry moved by an (x, y) offset in mm
+        """
+        shifted = Geometry(self.shape, self.step, self.origin + np.asarray(offset, dtype=float), self.axes)
+        shifted.positioned = self.positioned
+        return shifted
+
+    def centered(self):
+        """
+        The geometry with the center of the field of view at 0 mm, keeping the direction of each axis
+        """
+        return Geometry(self.shape, self.step)
+
+
+def from_position(shape, pixel_size, position):
+    """
+    Geometry of a DICOM image from the (ImagePositionPatient, ImageOrientationPatient) of its first plane. Rows
+    (axis 1) run along the column direction cosines and columns (axis 2) along the row direction cosines.
+    """
+    ipp, iop = np.array(position[0]), np.array(position[1])
+    cosines = [iop[3:6], iop[0:3]]
+    axes = tuple(int(np.argmax(np.abs(c))) for c in cosines)
+    if axes[0] == axes[1]:
+        return None
+    # the position is the center of the first pixel
+    step = np.array([pixel_size[k] * cosines[k][axes[k]] for k in range(2)])
+    origin = np.array([ipp[axes[k]] for k in range(2)]) - step / 2
+    return Geometry(shape, step, origin, axes)
+
+
+def image_geometry(image, fov=None):
+    """
+    Geometry of a loaded image, or None if it has no pixel size. fov is the (x, y) field of view in mm taken for an
+    image without a pixel size.
+    """
+    shape = image.img_data.shape[1:3]
+    try:
+        pixel_size = image.voxel_size()[1:3]
+    except Exception as e:
+        if fov is None:
+            return None
+        logger.debug(f'No pixel size for {image.filename} ({e}); taking a field of view of {fov} mm')
+        pixel_size = np.asarray(fov, dtype=float) / np.asarray(shape, dtype=float)
+
+    geometry = None
+    position = image.plane_position()
+    if position is not None:
+        geometry = from_position(shape, pixel_size, position)
+    if geometry is None:
+        geometry = Geometry(shape, pixel_size)
+
+    # a rotation about one axis flips the other two
+    for axis in image.rotation_history:
+        for k in (0, 1):
+            if k + 1 != axis:
+                geometry = geometry.flipped(k)
+    return geometry
+
+
+def session_geometries(*images):
+    """
+    Geometries of the images of one session in a common frame. Images without a pixel size are taken to cover the
+    field of view of the first image with one (or all the same field of view if none has). Unless all images are
+    positioned in the same patient frame, all are centered on the scanner axis.
+    """
+    geometries = [image_geometry(image) for image in images]
+    known = [g for g in geometries if g is not None]
+    fov = known[0].shape * np.abs(known[0].step) if known else (1., 1.)
+    geometries = [g if g is not None else image_geometry(image, fov) for g, image in zip(geometries, images)]
+
+    if not all(g.positioned and g.axes == geometries[0].axes for g in geometries):
+        geometries = [g.centered() for g in geometries]
+    logger.debug(f'Session geometries: {geometries}')
+    return geometries
@@ -2,25 +2,30 @@
 This module contains the classes used to define the image to be cut.
 """
 
+import contextlib
 import copy
 import gc
 import glob
+import io
 import logging
 import ntpath
 import os
-import shutil
-import struct
-import tempfile
 import uuid
 import warnings
 import zipfile
 
 import numpy as np
 import pydicom
+from pydicom import config
+from pydicom.dataelem import DataElement
 from pydicom.dataset import Dataset
 from pydicom.sequence import Sequence
 from datetime import datetime
 
+import memory_budget
+import volume_store
+from scratch import ScratchSpace
+
 # logging
 logger = logging.getLogger(__name__)
 
@@ -34,6 +39,18 @@ def try_rm_file(path):
         logger.error('Failed to remove file: {}'.format(os.path.split(path)[1]))
 
 
+def pixel_dtype(ds):
+    '''
+    numpy data type of the native PixelData of a dataset, from BitsAllocated, PixelRepresentation and the byte order
+    of the transfer syntax
+    '''
+    file_meta = getattr(ds, 'file_meta', None)
+    transfer_syntax = getattr(file_meta, 'TransferSyntaxUID', None)
+    byte_order = '>' if transfer_syntax is not None and not transfer_syntax.is_little_endian else '<'
+    kind = 'i' if ds.PixelRepresentation == 1 else 'u'
+    return np.dtype(f'{byte_order}{kind}{ds.BitsAllocated // 8}')
+
+
 # classes
 class Params:
 
@@ -66,8 +83,10 @@ class BaseImage:
         self.scale_factor = None
         self.scaled = None
         self.bpp = None  # bytes per pixel
+        self.scratch = None  # ScratchSpace of the tempfiles of the image
         self.tempdir = None
-        self.data_lim = 10 ** 7  # 10 MB
+        self.checksum = None  # input_checksum of the source files, if computed for the volume store
+        self.data_lim = 10 ** 7  # 10 MB, I/O chunk size without a memory budget
         self.rotation_history = []
         self.image_format = '.img'
         self.zip_outputs = []
@@ -83,6 +102,21 @@ class BaseImage:
         ]
         self.colors = [x for x in self.all_colors]
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.unload_image()
+
+    def get_scratch(self):
+        '''
+        scratch space of the image, created on first use
+        '''
+        if self.scratch is None:
+            self.scratch = ScratchSpace()
+            self.tempdir = self.scratch.path
+        return self.scratch
+
     def center_on_zeros(self, mat, xdim, ydim):
         if len(mat.shape) != 2:
             raise ValueError('Wrong shape matrix in center_on_zeros')
@@ -106,8 +140,8 @@ class BaseImage:
         return fillmat
 
     def submemmap(self, ix, data):
-        if self.tempdir is None:
-            raise ValueError('self.tempdir is None in self.sub_memmap.')
+        if self.scratch is None:
+            raise ValueError('self.scratch is None in self.sub_memmap.')
 
         found_filename = False
         while not found_filename:
@@ -118,7 +152,7 @@ class BaseImage:
             found_filename = not os.path.exists(img_temp_name)
             ix += 1
 
-        dfile = np.memmap(img_temp_name, mode='w+', dtype='float32', shape=self.img_data.shape)
+        dfile = self.scratch.memmap(os.path.basename(img_temp_name), 'float32', self.img_data.shape)
 
         # center cut on parent image dimensions
         dz, dy, dx, df = data.shape
@@ -197,7 +231,8 @@ class BaseImage:
         - can do range of frames now; maybe implement list of frames
         - same for z-dimension
         - does not support selection over x,y dimensions
-        - returns scaled image data;
+        - keeps the data type stored in the file; scale_factor holds the scale factor of each frame and is
+        applied lazily, see apply_scale(). With unscaled=True the data is never scaled;
         - planes and frames should both be tuples corresponding to the range of planes and frames to be
         returned from the image data;
         - defaults to all data;
@@ -208,33 +243,26 @@ class BaseImage:
 
         def read_chunks(ifr):
             '''
-            Trying to read data in chunks to handle HiResCt images
+            Read data straight into the image in chunks to handle HiResCt images, sized to the memory budget
             '''
             to_read = bpp * matsize
-            read_lim = self.data_lim
+            read_lim = memory_budget.chunk_size(self.data_lim) // bpp * bpp
             # print('Will read {0} {1}MB chunks.'.format(to_read/read_lim,int(read_lim/10**6)))
             ix = 0
-            while to_read > read_lim:
+            while to_read > 0:
                 # print('Reading new chunk; {}MB left'.format(int(to_read/10**6)))
-                nbytes = read_lim
-                npixels = int(nbytes / bpp)
-                chunk = np.array(struct.unpack(sf * npixels, img_file.read(nbytes)))
-                imgmat[ifr][ix:ix + npixels] = chunk
-                to_read -= read_lim
+                nbytes = min(read_lim, to_read)
+                npixels = nbytes // bpp
+                if img_file.readinto(imgmat[ifr - fr1, ix:ix + npixels]) != nbytes:
+                    raise ValueError('Unexpected end of image file {}'.format(self.filepath))
+                to_read -= nbytes
                 ix += npixels
 
-            # print('Reading new chunk; {}MB left'.format(int(to_read/10**6)))
-            nbytes = to_read
-            npixels = int(nbytes / bpp)
-            chunk = np.array(struct.unpack(sf * npixels, img_file.read(nbytes)))
-            imgmat[ifr][ix:ix + npixels] = chunk
-
         x, y, z, fs = self.params.x_dimension, self.params.y_dimension, self.params.z_dimension, self.params.total_frames
         print('File dimensions: ({},{},{},{})'.format(x, y, z, fs))
         ps = self.params
 
-        if self.tempdir is None:
-            self.tempdir = tempfile.mkdtemp()
+        self.get_scratch()
 
         if plane_range is None:
             if ps.z_dimension > 1:
@@ -330,48 +358,68 @@ class BaseImage:
         self.bpp = bpp
         sf = self.struct_flags[ps.data_type]
 
-        # read data from file
-        print('Reading microPET image data...')
-
-        img_file = open(self.filepath, 'rb')
         matsize = ps.x_dimension * ps.y_dimension * nplanes
         pl_offset = pl[0] * (ps.x_dimension * ps.y_dimension)
 
-        # make tempfile for whole image
-        img_temp_name = os.path.join(self.tempdir, '{}.dat'.format(self.filename.split('.')[0]))
-        imgmat = np.memmap(img_temp_name, mode='w+', dtype='float32', shape=(nframes, matsize))
-
-        for ifr in frames:
-            fr_offset = ifr * (ps.x_dimension * ps.y_dimension * ps.z_dimension)
-            img_file.seek(bpp * (fr_offset + pl_offset))
-            read_chunks(ifr)
-        imgmat = imgmat.swapaxes(0, 1)
-        img_file.close()
+        # frames in the file data type, in memory or in a tempfile if over the memory budget
+        imgmat = memory_budget.allocate((nframes, matsize), sf, self.scratch,
+                                        '{}.dat'.format(self.filename.split('.')[0]), 'Inveon load')
+
+        if volume_store.store_dir is not None:
+            self.checksum = volume_store.checksum(self.filepath)
+        volume = volume_store.open_volume(self.checksum)
+        if volume is not None and (volume.shape != (ps.z_dimension, ps.y_dimension, ps.x_dimension, ps.total_frames)
+                                   or volume.dtype != np.dtype(sf)):
+            logger.warning('Ignoring volume store entry {} of a different shape or data type'.format(volume.path))
+            volume = None
+
+        if volume is not None:
+            print('Reading microPET image data from the volume store...')
+            for ifr in frames:
+                volume.read(ifr, pl1, pl2 + 1, out=imgmat[ifr - fr1].reshape(nplanes, ps.y_dimension, ps.x_dimension))
+        else:
+            # read data from file
+            print('Reading microPET image data...')
+            img_file = open(self.filepath, 'rb')
+            for ifr in frames:
+                fr_offset = ifr * (ps.x_dimension * ps.y_dimension * ps.z_dimension)
+                img_file.seek(bpp * (fr_offset + pl_offset))
+                read_chunks(ifr)
+            img_file.close()
+
+        # frames are stored one after another; a view with frames last
+        self.img_data = np.moveaxis(imgmat.reshape(nframes, nplanes, ps.y_dimension, ps.x_dimension), 0, -1)
+
+        # only whole volumes are stored, so that any range can be loaded from them
+        if volume is None and nplanes == ps.z_dimension and nframes == ps.total_frames:
+            volume_store.put_volume(self.checksum, self.img_data)
 
-        # scale data
         if unscaled:
-            self.img_data = imgmat
+            self.scale_factor = None
             self.scaled = False
         else:
-            imgmat = imgmat.reshape(nplanes, ps.x_dimension, ps.y_dimension, nframes)
-            if multi_plane and (not multi_frame):
-                imgmat = imgmat[0:nplanes, :, :, 0]
-                self.scale_factor = ps.scale_factor[fr1]
-            elif (not multi_plane) and multi_frame:
-                imgmat = imgmat[0, :, :, 0:nframes]
-                self.scale_factor = ps.scale_factor[fr1:fr2 + 1]
-            elif (not multi_plane) and (not multi_frame):
-                imgmat = imgmat[0, :, :, 0]
-                self.scale_factor = ps.scale_factor[fr1]
-            else:
-                imgmat = imgmat[0:nplanes, :, :, 0:nframes]
-                self.scale_factor = ps.scale_factor[fr1:fr2 + 1]
-            imgmat = imgmat * self.scale_factor
-            self.img_data = imgmat.reshape(nplanes, ps.y_dimension, ps.x_dimension, nframes)
+            self.scale_factor = ps.scale_factor[fr1:fr2 + 1] if multi_frame else ps.scale_factor[fr1]
             self.scaled = True
 
         return
 
+    def frame_scale_factors(self):
+        '''
+        scale factor of each frame of img_data as a float64 array, or None if the data is not scaled
+        '''
+        if not self.scaled:
+            return None
+        return np.broadcast_to(np.asarray(self.scale_factor, dtype='float64'), (self.img_data.shape[-1],))
+
+    def apply_scale(self, data, frame=None):
+        '''
+        scaled values of data taken from img_data: either with all frames on the last axis, or of a single frame
+        '''
+        factors = self.frame_scale_factors()
+        if factors is None:
+            return data
+        return data * (factors if frame is None else factors[frame])
+
     def save_cut(self, index, path, zip=False):
         def zip_cut(img_file, hdr_file, zip_file):
             with zipfile.ZipFile(zip_file, 'w') as zfile:
@@ -409,31 +457,20 @@ class BaseImage:
 
         def write_chunks(data, dfile):
             '''
-            Trying to read data in chunks to handle HiResCt images
+            Write data (z, y, x, frames) frame after frame, in chunks of whole planes sized to the memory budget.
+            The data is in the file data type, so chunks are copied as they are.
             '''
             if self.bpp is None:
                 raise ValueError('self.bpp not defined in self.save_cuts')
             bpp = self.bpp
 
-            total_pixels = len(data)
-            bytes_to_write = total_pixels * bpp
-            write_lim = self.data_lim
-            print('Will write {0} {1}MB chunks.'.format(bytes_to_write / write_lim, int(write_lim / 10 ** 6)))
-            ix = 0
-            while bytes_to_write > write_lim:
-                print('Writing new chunk; {}MB left'.format(int(bytes_to_write / 10 ** 6)))
-                nbytes = write_lim
-                npixels = int(nbytes / bpp)
-                chunk = data[ix:ix + npixels]
-                dfile.write(struct.pack(npixels * sf, *chunk))
-                bytes_to_write -= write_lim
-                ix += npixels
-
-            print('Writing new chunk; {}MB left'.format(int(bytes_to_write / 10 ** 6)))
-            nbytes = bytes_to_write
-            npixels = int(nbytes / bpp)
-            chunk = data[ix:ix + npixels]
-            dfile.write(struct.pack(npixels * sf, *chunk))
+            nplanes, ny, nx, nframes = data.shape
+            write_lim = memory_budget.chunk_size(self.data_lim)
+            step = max(1, write_lim // (ny * nx * bpp))
+            print('Will write {0} {1}MB chunks.'.format(data.size * bpp / write_lim, int(write_lim / 10 ** 6)))
+            for ifr in range(nframes):
+                for p in range(0, nplanes, step):
+                    dfile.write(np.ascontiguousarray(data[p:p + step, :, :, ifr], dtype=sf).tobytes())
             return
 
         print('Saving files...')
@@ -526,23 +563,10 @@ class BaseImage:
         with open(os.path.join(path, cut_hdr_name), 'w') as hf:
             hf.write(cut_hdr_str)
 
-        out_data = cut_img.img_data
+        out_data = cut_img.img_data.reshape(cut_img.zdim, cut_img.ydim, cut_img.xdim, cut_img.nframes)
         # print('out_data.shape',out_data.shape)
 
-        out_data = out_data.reshape(cut_img.xdim * cut_img.ydim * cut_img.zdim, cut_img.nframes)
-
-        if self.scaled:
-            inv = lambda x: 1 / x
-            v_inv = np.vectorize(inv)
-            inv_scale_factor = v_inv(self.scale_factor)
-            out_data = out_data * inv_scale_factor
-
-        # prepare data to write out
-        out_data = out_data.swapaxes(0, 1).flatten()
-
-        # make sure data is int if it is supposed to be
-        if sf in ['i', 'B', 'h']:
-            out_data = out_data.astype(int)
+        # frames are written one after another, with the scale factors of the header unchanged
         print('writing microPET image to ', os.path.join(path, cut_filename))
         with open(os.path.join(path, cut_filename), 'wb') as dfile:
             write_chunks(out_data, dfile)
@@ -580,7 +604,7 @@ class BaseImage:
             del cut
 
             if self.tempdir is None:
-                self.tempdir = tempfile.mkdtemp()
+                continue
 
             fp = os.path.join(self.tempdir, fn)
             if os.path.exists(fp):
@@ -593,10 +617,29 @@ class BaseImage:
         self.clean_cuts()
         self.img_data = None
         gc.collect()
-        if self.tempdir:
-            shutil.rmtree(self.tempdir)
+        if self.scratch is not None:
+            self.scratch.close()
+        self.scratch = None
         self.tempdir = None
 
+    def voxel_size(self):
+        '''
+        (z, y, x) size of a voxel in mm, from the pixel size in the header; PET planes span the axial field of view
+        '''
+        ps = self.params
+        dz = ps.pixel_size
+        if self.type == 'pet':
+            axial_fov = ps.axial_blocks * ps.axial_crystals_per_block * ps.axial_crystal_pitch + ps.axial_crystal_pitch
+            dz = axial_fov / ps.z_dimension
+        return dz, ps.pixel_size, ps.pixel_size
+
+    def plane_position(self):
+        '''
+        (ImagePositionPatient, ImageOrientationPatient) of the first plane, or None if the header has no position and
+        the image is centered on the scanner axis
+        '''
+        return None
+
     def get_axis(self, axis):
         '''
         converts axis x,y,z to 2,1,0 for use with numpy
@@ -627,11 +670,11 @@ class BaseImage:
         f1, f2 = tuple(self.frame_range)
         if n not in range(f1, f2 + 1):
             raise IndexError('Specified frame {0} is not in loaded range {1}'.format(n, self.frame_range))
-        return self.img_data[:, :, :, f1 - n]
+        return self.apply_scale(self.img_data[:, :, :, n - f1], n - f1)
 
     def collapse_frame(self, axis, frame=None, method='sum'):
         if frame is None:
-            matrix = self.img_data
+            matrix = self.apply_scale(self.img_data)
         else:
             matrix = self.get_frame(frame)
         ax = self.get_axis(axis)
@@ -641,9 +684,9 @@ class BaseImage:
 
     def collapse_over_frames(self, method, matrix=None):
         if matrix is None:
-            matrix = self.img_data
+            matrix = self.apply_scale(self.img_data)
         self.check_collapse_method(method)
-        return getattr(self.img_data, method)(axis=3)
+        return getattr(matrix, method)(axis=3)
 
     def rotate_on_axis(self, axis, log=False):
         self.check_data()
@@ -684,6 +727,7 @@ class SubImage(BaseImage):
         self.frame_range = parent_image.frame_range
         self.plane_range = parent_image.plane_range
         self.scaled = parent_image.scaled
+        self.scale_factor = parent_image.scale_factor
         self.cut_coords = cut_coords
         shape = self.img_data.shape
         self.zdim, self.ydim, self.xdim, self.nframes = shape
@@ -714,6 +758,16 @@ class SubImage(BaseImage):
 
         self.metadata = metadata
 
+    def voxel_size(self):
+        return self.parent_image.voxel_size()
+
+    def origin(self):
+        '''
+        (z, y, x) index of the first voxel of the cut in the parent image
+        '''
+        (row, _), (column, _) = self.cut_coords  # ranges over axes 1 and 2 of the parent image
+        return (self.plane_range or [0])[0], row, column
+
 
 class PETImage(BaseImage):
 
@@ -818,6 +872,8 @@ class DicomImage(BaseImage):
         self.plane_range = None
         self.frame_range = None
         self.qc_outputs = None
+        # also write the .dcm files of zipped cuts to <path>/<index>; otherwise they are only written to the zip
+        self.loose_files = False
 
         if os.path.isdir(filepath):
             self.filename = f'{os.path.basename(filepath)}.dcm'
@@ -834,6 +890,18 @@ class DicomImage(BaseImage):
 
     def load_image_from_dir(self, **kwargs):
         logger.debug(f'Loading dicom images from directory {self.filepath}')
+        if volume_store.store_dir is not None:
+            self.checksum = volume_store.checksum(self.filepath)
+        volume = volume_store.open_volume(self.checksum)
+        if volume is not None:
+            # the decoded slices, the modality and the file order of an earlier load of the same files
+            self.dicom_files = [os.path.join(self.filepath, f) for f in volume.meta['dicom_files']]
+            self.modality = volume.meta['modality']
+            self.img_data = memory_budget.allocate(volume.shape, volume.dtype, self.get_scratch(),
+                                                   f'{os.path.basename(self.filepath)}.dat', 'DICOM load')
+            volume.read(0, out=self.img_data[..., 0])
+            return
+
         # Get all the .dcm files in the filepath
         self.dicom_files = glob.glob(os.path.join(self.filepath, '*.dcm'))
 
@@ -851,11 +919,38 @@ class DicomImage(BaseImage):
         # Sort dicom files by InstanceNumber
         self.dicom_files.sort(key=lambda x: pydicom.dcmread(x).InstanceNumber)
 
-        # Load each image file into a single ndarray
-        img_data = np.stack([pydicom.dcmread(dicom_file).pixel_array for dicom_file in self.dicom_files])
-        img_data = img_data[..., np.newaxis]
+        # Load each image file into a single ndarray, filled slice by slice; a memmap if over the memory budget
+        first = pydicom.dcmread(self.dicom_files[0]).pixel_array
+        shape = (len(self.dicom_files),) + first.shape + (1,)
+        img_data = memory_budget.allocate(shape, first.dtype, self.get_scratch(),
+                                          f'{os.path.basename(self.filepath)}.dat', 'DICOM load')
+        img_data[0, ..., 0] = first
+        for i, dicom_file in enumerate(self.dicom_files[1:], 1):
+            img_data[i, ..., 0] = pydicom.dcmread(dicom_file).pixel_array
         self.img_data = img_data
 
+        volume_store.put_volume(self.checksum, img_data, modality=self.modality,
+                                dicom_files=[os.path.basename(f) for f in self.dicom_files])
+
+    def voxel_size(self):
+        '''
+        (z, y, x) size of a voxel in mm, from the pixel spacing and the distance between the first two slices
+        '''
+        ds = pydicom.dcmread(self.dicom_files[0] if self.dicom_files else self.filepath, stop_before_pixels=True)
+        dy, dx = (float(v) for v in ds.PixelSpacing)
+        dz = float(getattr(ds, 'SliceThickness', None) or dy)
+        if self.dicom_files and len(self.dicom_files) > 1:
+            ds2 = pydicom.dcmread(self.dicom_files[1], stop_before_pixels=True)
+            if 'ImagePositionPatient' in ds and 'ImagePositionPatient' in ds2:
+                dz = float(np.linalg.norm(np.subtract(ds2.ImagePositionPatient, ds.ImagePositionPatient))) or dz
+        return dz, dy, dx
+
+    def plane_position(self):
+        ds = pydicom.dcmread(self.dicom_files[0] if self.dicom_files else self.filepath, stop_before_pixels=True)
+        if 'ImagePositionPatient' not in ds or 'ImageOrientationPatient' not in ds:
+            return None
+        return [float(v) for v in ds.ImagePositionPatient], [float(v) for v in ds.ImageOrientationPatient]
+
     def load_image_from_file(self):
         logger.debug(f'Loading dicom image from file {self.filepath}')
         ds = pydicom.dcmread(self.filepath)
@@ -870,87 +965,114 @@ class DicomImage(BaseImage):
         study_instance_uid = self.x667_uuid()
         series_instance_uid = self.x667_uuid()
 
-        for idx, dicom_file in enumerate(self.dicom_files):
-            original_ds = pydicom.dcmread(dicom_file)
-            split_ds = copy.deepcopy(original_ds)
-
-            # Update metadata
-            metadata = self.cuts[index].metadata
-
-            split_ds.ImageType = ['DERIVED', 'PRIMARY', 'SPLIT']
-            split_ds.DerivationDescription = 'Original volume split into equal subvolumes for each patient'
-            split_ds.DerivationImageSequence = self.derive_image_sequence(
-                copy.deepcopy(split_ds.SOPClassUID),
-                copy.deepcopy(split_ds.SOPInstanceUID)
-            )
-            split_ds.SourcePatientGroupIdentificationSequence = self.derive_source_patient_group(
-                copy.deepcopy(split_ds.PatientID)
-            )
-
-            split_ds.StudyInstanceUID = study_instance_uid
-            split_ds.SeriesInstanceUID = series_instance_uid
-
-            split_ds.SOPInstanceUID = self.x667_uuid()
-            split_ds.file_meta.MediaStorageSOPInstanceUID = split_ds.SOPInstanceUID
-
-            split_ds.StorageMediaFileSetUID = series_instance_uid
-
-            if metadata is not None:
-                if 'StudyInstanceUID' in metadata:
-                    split_ds.StudyInstanceUID = metadata['StudyInstanceUID']
-                if 'PatientID' in metadata:
-                    split_ds.PatientID = metadata['PatientID']
-                    patient_id = metadata['PatientID']
-                if 'PatientName' in metadata:
-                    split_ds.PatientName = metadata['PatientName']
-                if 'PatientWeight' in metadata:
-                    split_ds.PatientWeight = metadata['PatientWeight']
-                if 'PatientOrientation' in metadata:
-                    split_ds.PatientOrientation = metadata['PatientOrientation']
-                if 'PatientComments' in metadata:
-                    split_ds.PatientComments = metadata['PatientComments']
-
-                if split_ds.Modality == 'PT' and 'RadiopharmaceuticalInformationSequence' in split_ds:
-                    start_date = metadata.get('RadiopharmaceuticalStartDate', split_ds.AcquisitionDate or None)
-                    start_time = metadata.get('RadiopharmaceuticalStartTime')
-                    if start_date and start_time:
-                        split_ds.RadiopharmaceuticalInformationSequence[0].RadiopharmaceuticalStartDateTime = f'{start_date}{start_time}'
-                    if 'RadionuclideTotalDose' in metadata:
-                        split_ds.RadiopharmaceuticalInformationSequence[0].RadionuclideTotalDose = metadata['RadionuclideTotalDose']
-
-            if 'SeriesDescription' in split_ds and split_ds.SeriesDescription:
-                split_ds.SeriesDescription += f' split {patient_id}'
-            else:
-                split_ds.SeriesDescription = f'split {patient_id}'
-
-            # Update PixelData
-            split_ds.PixelData = self.cuts[index].img_data[idx, :, :, 0].tobytes()
-            split_ds.Rows, split_ds.Columns = self.cuts[index].img_data[idx, :, :, 0].shape
-
-            # Check if path exists, if not create it
-            if not os.path.exists(path):
-                os.makedirs(path)
-
-            if not os.path.exists(os.path.join(path, f'{index}')):
-                os.makedirs(os.path.join(path, f'{index}'))
-
-            # Save the file
-            filename = f'{split_ds.SOPInstanceUID}.dcm'
-            split_ds.save_as(os.path.join(path, f'{index}', filename))
-
-        if zip:
-            logger.debug(f'Zipping dicom cut {index} to {path}...')
-
-            zip_filepath = os.path.join(path, f'{index}.zip')
-
-            with zipfile.ZipFile(zip_filepath, 'w') as zip_file:
-                for dcm_file in glob.glob(os.path.join(path, f'{index}', '*.dcm')):
-                    zip_file.write(dcm_file, os.path.relpath(dcm_file, path))
-
+        template = pydicom.dcmread(self.dicom_files[0], stop_before_pixels=True)
+        slices = self.encode_cut(index, template)
+        rows, columns = self.cuts[index].img_data.shape[1:3]
+
+        # each dataset is serialized once and written to the zip and/or the cut directory
+        write_files = self.loose_files or not zip
+        os.makedirs(os.path.join(path, f'{index}') if write_files else path, exist_ok=True)
+        zip_filepath = os.path.join(path, f'{index}.zip')
+        buffer = io.BytesIO()
+
+        def remove_partial_zip(exc_type, exc, traceback):
+            # a truncated archive must not be picked up for upload
+            if exc_type is not None and os.path.exists(zip_filepath):
+                os.remove(zip_filepath)
+
+        with contextlib.ExitStack() as stack:
+            zip_file = None
+            if zip:
+                # pushed first so that it runs after the archive is closed
+                stack.push(remove_partial_zip)
+                zip_file = stack.enter_context(zipfile.ZipFile(zip_filepath, 'w'))
+
+            for idx, dicom_file in enumerate(self.dicom_files):
+                original_ds = pydicom.dcmread(dicom_file)
+                split_ds = copy.deepcopy(original_ds)
+
+                # Update metadata
+                metadata = self.cuts[index].metadata
+
+                split_ds.ImageType = ['DERIVED', 'PRIMARY', 'SPLIT']
+                split_ds.DerivationDescription = 'Original volume split into equal subvolumes for each patient'
+                split_ds.DerivationImageSequence = self.derive_image_sequence(
+                    copy.deepcopy(split_ds.SOPClassUID),
+                    copy.deepcopy(split_ds.SOPInstanceUID)
+                )
+                split_ds.SourcePatientGroupIdentificationSequence = self.derive_source_patient_group(
+                    copy.deepcopy(split_ds.PatientID)
+                )
+
+                split_ds.StudyInstanceUID = study_instance_uid
+                split_ds.SeriesInstanceUID = series_instance_uid
+
+                split_ds.SOPInstanceUID = self.x667_uuid()
+                split_ds.file_meta.MediaStorageSOPInstanceUID = split_ds.SOPInstanceUID
+
+                split_ds.StorageMediaFileSetUID = series_instance_uid
+
+                if metadata is not None:
+                    if 'StudyInstanceUID' in metadata:
+                        split_ds.StudyInstanceUID = metadata['StudyInstanceUID']
+                    if 'PatientID' in metadata:
+                        split_ds.PatientID = metadata['PatientID']
+                        patient_id = metadata['PatientID']
+                    if 'PatientName' in metadata:
+                        split_ds.PatientName = metadata['PatientName']
+                    if 'PatientWeight' in metadata:
+                        split_ds.PatientWeight = metadata['PatientWeight']
+                    if 'PatientOrientation' in metadata:
+                        split_ds.PatientOrientation = metadata['PatientOrientation']
+                    if 'PatientComments' in metadata:
+                        split_ds.PatientComments = metadata['PatientComments']
+
+                    if split_ds.Modality == 'PT' and 'RadiopharmaceuticalInformationSequence' in split_ds:
+                        start_date = metadata.get('RadiopharmaceuticalStartDate', split_ds.AcquisitionDate or None)
+                        start_time = metadata.get('RadiopharmaceuticalStartTime')
+                        if start_date and start_time:
+                            split_ds.RadiopharmaceuticalInformationSequence[0].RadiopharmaceuticalStartDateTime = f'{start_date}{start_time}'
+                        if 'RadionuclideTotalDose' in metadata:
+                            split_ds.RadiopharmaceuticalInformationSequence[0].RadionuclideTotalDose = metadata['RadionuclideTotalDose']
+
+                if 'SeriesDescription' in split_ds and split_ds.SeriesDescription:
+                    split_ds.SeriesDescription += f' split {patient_id}'
+                else:
+                    split_ds.SeriesDescription = f'split {patient_id}'
+
+                # Update PixelData; pydicom only validates bytes, but writes any buffer
+                split_ds['PixelData'] = DataElement(0x7FE00010, split_ds['PixelData'].VR, slices[idx],
+                                                    validation_mode=config.IGNORE)
+                split_ds.Rows, split_ds.Columns = rows, columns
+
+                # Save the file
+                filename = os.path.join(f'{index}', f'{split_ds.SOPInstanceUID}.dcm')
+                buffer.seek(0)
+                buffer.truncate()
+                split_ds.save_as(buffer)
+                with buffer.getbuffer() as data:
+                    if zip_file is not None:
+                        zip_file.writestr(filename, data)
+                    if write_files:
+                        with open(os.path.join(path, filename), 'wb') as f:
+                            f.write(data)
+
+        if zip_file is not None:
             self.zip_outputs.append((patient_id, zip_filepath))
 
             logger.debug(f'Zip file saved to {zip_filepath}')
 
+    def encode_cut(self, index, template):
+        '''
+        PixelData of each slice of a cut: the cut is copied once into a contiguous buffer of the pixel data type of
+        the template dataset, and each slice is a memoryview of it
+        '''
+        data = self.cuts[index].img_data[..., 0]
+        buffer = np.empty(data.shape, dtype=pixel_dtype(template))
+        buffer[...] = data
+        raw = buffer.reshape(len(buffer), -1).view(np.uint8)
+        return [memoryview(plane) for plane in raw]
+
     def reset_zip_outputs(self):
         self.zip_outputs = []
 
@@ -0,0 +1,216 @@
+"""
+Stage level instrumentation of the splitter.
+
+Functions that implement a stage of a split are wrapped with @instrumented('name'), and blocks of code with
+"with stage('name'):". When no hook is registered this costs one check of a list. Each registered hook is called
+with a StageRecord when a stage ends; StageReport is a hook that aggregates the records into a JSON report and a
+Prometheus textfile.
+
+    report = StageReport()
+    add_hook(report)
+    ...split...
+    remove_hook(report)
+    report.write_json('stages.json', project='P', experiment='E')
+
+Stages may nest (e.g. z_compress_pet is also called by qc_image) and each reports its inclusive cost. CPU time,
+bytes read / written and peak memory are measured for the whole process, so stages running concurrently on other
+threads (e.g. uploads) are included in each other's figures. The peak memory of the process (ru_maxrss) is a
+high-water mark over its lifetime: a stage reports it as process_peak_rss_bytes, and how far the stage raised it as
+peak_rss_growth_bytes, which is zero for a stage that stayed below an earlier peak.
+"""
+import functools
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+
+# logging
+logger = logging.getLogger(__name__)
+
+StageRecord = namedtuple('StageRecord', ['stage', 'thread', 'wall', 'cpu', 'read_bytes', 'write_bytes',
+                                         'peak_rss_bytes', 'peak_rss_growth_bytes', 'error'])
+
+hooks = []
+
+
+def add_hook(hook):
+    """
+    Register a callable that receives a StageRecord each time a stage ends
+    """
+    hooks.append(hook)
+
+
+def remove_hook(hook):
+    if hook in hooks:
+        hooks.remove(hook)
+
+
+def io_counters():
+    """
+    Bytes read and written by the process through read/write system calls (Linux only, otherwise zeros)
+    """
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def peak_rss():
+    """
+    Peak resident set size of the process in bytes since it started
+    """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+@contextmanager
+def stage(name):
+    if not hooks:
+        yield
+        return
+
+    read_bytes, write_bytes = io_counters()
+    peak_before = peak_rss()
+    wall, cpu = time.perf_counter(), time.process_time()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        read_after, write_after = io_counters()
+        peak_after = peak_rss()
+        record = StageRecord(name, threading.current_thread().name, wall, cpu, read_after - read_bytes,
+                             write_after - write_bytes, peak_after, peak_after - peak_before, error)
+        for hook in list(hooks):
+            try:
+                hook(record)
+            except Exception as e:
+                logger.warning(f'Instrumentation hook {hook} failed: {e}')
+
+
+def instrumented(name):
+    """
+    Decorator recording each call of a function as a stage
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not hooks:
+                return function(*args, **kwargs)
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class StageReport:
+    """
+    Hook aggregating the stage records of a split: number of calls, errors, total wall and CPU time, bytes read and
+    written, the peak RSS of the process reached by the end of each stage and the largest rise of that peak during
+    one call of the stage
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = OrderedDict()
+        self.started = time.time()
+
+    def __call__(self, record):
+        with self.lock:
+            totals = self.stages.setdefault(record.stage, {'calls': 0, 'errors': 0, 'wall_seconds': 0.,
+                                                           'cpu_seconds': 0., 'read_bytes': 0, 'write_bytes': 0,
+                                                           'process_peak_rss_bytes': 0,
+                                                           'peak_rss_growth_bytes': 0})
+            totals['calls'] += 1
+            totals['errors'] += record.error is not None
+            totals['wall_seconds'] += record.wall
+            totals['cpu_seconds'] += record.cpu
+            totals['read_bytes'] += record.read_bytes
+            totals['write_bytes'] += record.write_bytes
+            totals['process_peak_rss_bytes'] = max(totals['process_peak_rss_bytes'], record.peak_rss_bytes)
+            totals['peak_rss_growth_bytes'] = max(totals['peak_rss_growth_bytes'], record.peak_rss_growth_bytes)
+
+    def to_dict(self, **labels):
+        with self.lock:
+            stages = {name: {**totals, 'wall_seconds': round(totals['wall_seconds'], 6),
+                             'cpu_seconds': round(totals['cpu_seconds'], 6)}
+                      for name, totals in self.stages.items()}
+        return {
+            **labels,
+            'started': self.started,
+            'duration_seconds': round(time.time() - self.started, 6),
+            'peak_rss_bytes': peak_rss(),
+            'stages': stages,
+        }
+
+    def write_json(self, path, **labels):
+        write_atomic(path, json.dumps(self.to_dict(**labels), indent=2))
+
+    def to_prometheus(self, **labels):
+        """
+        The report in the Prometheus text exposition format, e.g. for the node exporter textfile collector
+        """
+        report = self.to_dict()
+        common = ','.join(f'{key}="{escape_label(value)}"' for key, value in labels.items())
+
+        def label_set(**extra):
+            extra = ','.join(f'{key}="{escape_label(value)}"' for key, value in extra.items())
+            label_pairs = ','.join(part for part in (common, extra) if part)
+            return '{' + label_pairs + '}' if label_pairs else ''
+
+        metrics = [
+            ('calls_total', 'counter', 'Number of times the stage ran', 'calls'),
+            ('errors_total', 'counter', 'Number of times the stage raised an exception', 'errors'),
+            ('wall_seconds_total', 'counter', 'Wall clock time spent in the stage', 'wall_seconds'),
+            ('cpu_seconds_total', 'counter', 'Process CPU time spent in the stage', 'cpu_seconds'),
+            ('read_bytes_total', 'counter', 'Bytes read by the process during the stage', 'read_bytes'),
+            ('write_bytes_total', 'counter', 'Bytes written by the process during the stage', 'write_bytes'),
+            ('process_peak_rss_bytes', 'gauge', 'Peak resident memory of the process since it started, as of the end '
+             'of the stage; cumulative, not specific to the stage', 'process_peak_rss_bytes'),
+            ('peak_rss_growth_bytes', 'gauge', 'Largest rise of the peak resident memory of the process during one '
+             'run of the stage', 'peak_rss_growth_bytes'),
+        ]
+
+        lines = []
+        for suffix, metric_type, description, key in metrics:
+            name = f'splitter_of_mice_stage_{suffix}'
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} {metric_type}']
+            lines += [f'{name}{label_set(stage=stage_name)} {totals[key]}'
+                      for stage_name, totals in report['stages'].items()]
+
+        lines += ['# HELP splitter_of_mice_duration_seconds Duration of the split',
+                  '# TYPE splitter_of_mice_duration_seconds gauge',
+                  f'splitter_of_mice_duration_seconds{label_set()} {report["duration_seconds"]}',
+                  '# HELP splitter_of_mice_peak_rss_bytes Peak resident memory of the process since it started',
+                  '# TYPE splitter_of_mice_peak_rss_bytes gauge',
+                  f'splitter_of_mice_peak_rss_bytes{label_set()} {report["peak_rss_bytes"]}']
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path, **labels):
+        write_atomic(path, self.to_prometheus(**labels))
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def write_atomic(path, text):
+    # scrapers must never read a partially written file
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+    with os.fdopen(fd, 'w') as f:
+        f.write(text)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
@@ -10,8 +10,13 @@ This software may not be reproduced, copied, or distributed without written perm
 
 import argparse
 import logging
+import os
 import sys
 
+import memory_budget
+import scratch
+import volume_store
+from profiling import Profiler
 from splitter import SoM
 
 
@@ -41,6 +46,11 @@ if __name__ == "__main__":
     p.add_argument('--dicom', action='store_true', help='input file/folder is DICOM')
     p.add_argument('--log-level', metavar='<str>', type=str, help='log level [INFO | DEBUG]', default='INFO')
     p.add_argument('-z', action='store_true', help='Zip each split image')
+    p.add_argument('--qc-bundle', action='store_true',
+                   help='with -q, write the QC snapshots as <out_dir>/qc/qc_bundle.zip: WebP images at thumbnail, '
+                        'medium and full resolution and a manifest.json of the cut boxes')
+    p.add_argument('--keep-dicom-files', action='store_true',
+                   help='with -z, also write the .dcm files of each split DICOM image to <out_dir>/<index>')
     p.add_argument('--remove-bed', action='store_true',
                    help='Attempt to remove the bed from CT images to improve animal detection')
     p.add_argument('--pet-img-size', metavar='<int>', type=int, nargs=2,
@@ -49,6 +59,30 @@ if __name__ == "__main__":
     p.add_argument('--ct-img-size', metavar='<int>', type=int, nargs=2,
                    help='Desired size of split CT images as a (height, width) tuple. Helpful for keeping the same '
                         'image size across multiple scans.')
+    p.add_argument('--output-formats', metavar='<str>', type=str, nargs='+', choices=('nii', 'nii.gz', 'npz'),
+                   help='also write each split image as NIfTI (nii, nii.gz) and/or a compressed NumPy archive (npz)')
+    p.add_argument('--max-memory', metavar='<size>', type=str,
+                   help='memory budget, e.g. 4G or 1500M (a plain number is MB). Also read from $SOM_MAX_MEMORY. '
+                        '[no limit]')
+    p.add_argument('--scratch-dir', metavar='<str>', type=str,
+                   help='directory for the tempfiles of the image, e.g. on a local NVMe disk or tmpfs. Also read '
+                        'from $SOM_SCRATCH_DIR. [system temp directory]')
+    p.add_argument('--scratch-quota', metavar='<size>', type=str,
+                   help='maximum size of the tempfiles, e.g. 20G. Also read from $SOM_SCRATCH_QUOTA. [no limit]')
+    p.add_argument('--volume-store-dir', metavar='<str>', type=str,
+                   help='directory of loaded image volumes, stored compressed by input checksum so that splitting '
+                        'the same image again does not decode it again. Also read from $SOM_VOLUME_STORE. '
+                        '[no store]')
+    p.add_argument('--volume-store-size', metavar='<size>', type=str,
+                   help='maximum size of the volume store, e.g. 50G. Also read from $SOM_VOLUME_STORE_SIZE. '
+                        '[no limit]')
+    p.add_argument('--profile', action='store_true',
+                   help='profile the split with cProfile and take tracemalloc snapshots at stage boundaries')
+    p.add_argument('--profile-dir', metavar='<str>', type=str,
+                   help='directory for the profile artifacts; implies --profile [<out_dir>/profile]')
+    p.add_argument('--profile-lines', action='store_true',
+                   help='also time each line of the known hot functions (read_chunks, write_chunks, z_compress_ct, '
+                        'save_cut). Slows the split down.')
 
     a = p.parse_args()
 
@@ -62,9 +96,35 @@ if __name__ == "__main__":
           format(a.mod, a.file_path, a.out_dir, a.n, a.t, a.m, a.p, a.q)
     )
 
-    sys.exit(SoM(a.file_path, modality=a.mod, dicom=a.dicom).split_mice(a.out_dir,
-                                                                        num_anim=a.n, sep_thresh=a.t, margin=a.m,
-                                                                        minpix=a.p, output_qc=a.q, suffix_map=a.sm,
-                                                                        zip=a.z, remove_bed=a.remove_bed,
-                                                                        pet_img_size=a.pet_img_size,
-                                                                        ct_img_size=a.ct_img_size))
+    if a.pet_img_size or a.ct_img_size:
+        logging.warning('--pet-img-size and --ct-img-size are no longer supported and are ignored')
+
+    if a.max_memory is not None:
+        memory_budget.set_max_memory(a.max_memory)
+    if a.scratch_dir is not None:
+        scratch.set_scratch_root(a.scratch_dir)
+    if a.scratch_quota is not None:
+        scratch.set_scratch_quota(a.scratch_quota)
+    if a.volume_store_dir is not None:
+        volume_store.set_store_dir(a.volume_store_dir, a.volume_store_size)
+
+    profiler = None
+    if a.profile or a.profile_dir:
+        profiler = Profiler(a.profile_dir or os.path.join(a.out_dir, 'profile'), line_trace=a.profile_lines)
+        profiler.start()
+
+    try:
+        som = SoM(a.file_path, modality=a.mod, dicom=a.dicom)
+        som.outdir = a.out_dir
+        som.qc_bundle = a.qc_bundle
+        if a.dicom and som.pi is not None:
+            som.pi.loose_files = a.keep_dicom_files
+        os.makedirs(a.out_dir, exist_ok=True)
+        exit_code = som.split_mice(num_anim=a.n, sep_thresh=a.t, margin=a.m, minpix=a.p, output_qc=a.q,
+                                   suffix_map=a.sm, zip=a.z, remove_bed=a.remove_bed,
+                                   output_formats=a.output_formats)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+
+    sys.exit(exit_code)
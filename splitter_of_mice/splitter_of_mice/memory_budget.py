@@ -0,0 +1,108 @@
+"""
+Process wide memory budget for splitting.
+
+The budget is set with set_max_memory() (the --max-memory option of the entry points) or the SOM_MAX_MEMORY
+environment variable, e.g. '4G' or '1500M'; a plain number is taken as MB. Without a budget the splitter behaves as
+before. With a budget, I/O chunk sizes follow the memory still available and large arrays that would not fit are
+created as memmaps in the scratch space of the image instead. Each time the budget forces such a slower path it is
+logged and recorded in slow_paths.
+"""
+import logging
+import os
+import resource
+import sys
+
+import numpy as np
+
+# logging
+logger = logging.getLogger(__name__)
+
+ENV_VAR = 'SOM_MAX_MEMORY'
+
+MIN_CHUNK = 2 ** 20  # 1 MB
+MAX_CHUNK = 2 ** 28  # 256 MB
+
+UNITS = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+
+# (what, bytes) for each time the budget forced a slower path
+slow_paths = []
+
+
+def parse_size(value):
+    """
+    Bytes in a size such as '4G', '1500M', '2048' (MB) or an int (bytes). None or '' means no limit.
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+
+    value = str(value).strip().upper().rstrip('B')
+    if value and value[-1] in UNITS:
+        return int(float(value[:-1]) * UNITS[value[-1]])
+    return int(float(value) * UNITS['M'])
+
+
+max_memory = parse_size(os.environ.get(ENV_VAR))
+
+
+def set_max_memory(value):
+    global max_memory
+    max_memory = parse_size(value)
+    if max_memory is not None:
+        logger.info(f'Memory budget: {max_memory / 2 ** 20:.0f} MB')
+
+
+def current_rss():
+    """
+    Resident set size of the process in bytes
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def available():
+    """
+    Bytes that may still be allocated under the budget, or None without a budget
+    """
+    if max_memory is None:
+        return None
+    return max(0, max_memory - current_rss())
+
+
+def fits(nbytes):
+    free = available()
+    return free is None or nbytes <= free
+
+
+def chunk_size(default):
+    """
+    Bytes to read or write at a time: default without a budget, otherwise an eighth of the memory still available
+    """
+    free = available()
+    if free is None:
+        return default
+    return int(min(MAX_CHUNK, max(MIN_CHUNK, free // 8)))
+
+
+def report_slow_path(what, nbytes):
+    slow_paths.append((what, int(nbytes)))
+    logger.warning(f'Memory budget of {max_memory / 2 ** 20:.0f} MB exceeded by {what} '
+                   f'({nbytes / 2 ** 20:.0f} MB needed, {available() / 2 ** 20:.0f} MB available). '
+                   f'Using a slower, disk backed path.')
+
+
+def allocate(shape, dtype, scratch, name, what):
+    """
+    np.empty(shape, dtype), or a memmap in the ScratchSpace scratch if the array does not fit in the budget
+    """
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    if fits(nbytes):
+        return np.empty(shape, dtype=dtype)
+
+    report_slow_path(what, nbytes)
+    return scratch.memmap(name, dtype, shape)
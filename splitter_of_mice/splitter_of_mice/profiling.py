@@ -0,0 +1,192 @@
+"""
+Profiling of a split, for diagnosing slow sessions after the fact.
+
+Profiler collects, for the thread that starts it:
+- cProfile statistics (cprofile.prof, and the top functions by cumulative time in cprofile.txt)
+- optionally a line level trace of the known hot functions (line_profile.txt)
+- tracemalloc snapshots at the end of the first call of each instrumented stage and at the end of the split
+  (tracemalloc_*.snapshot, summarised in tracemalloc.txt)
+
+All artifacts are written to one directory.
+"""
+import cProfile
+import io
+import linecache
+import logging
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+
+from instrumentation import add_hook, remove_hook
+
+# logging
+logger = logging.getLogger(__name__)
+
+# functions traced line by line with line_trace=True
+HOT_FUNCTIONS = ('read_chunks', 'write_chunks', 'z_compress_ct', 'save_cut')
+
+
+class LineTracer:
+    """
+    Time spent on each line of the given functions, measured with sys.settrace. Only frames of the traced functions
+    pay the tracing cost.
+    """
+
+    def __init__(self, function_names=HOT_FUNCTIONS):
+        self.function_names = set(function_names)
+        self.package_dir = os.path.dirname(os.path.abspath(__file__))
+        self.lines = defaultdict(lambda: [0, 0.])  # (filename, function, line) -> [hits, seconds]
+        self.previous_tracer = None
+
+    def start(self):
+        self.previous_tracer = sys.gettrace()
+        sys.settrace(self.trace_calls)
+
+    def stop(self):
+        sys.settrace(self.previous_tracer)
+
+    def trace_calls(self, frame, event, arg):
+        code = frame.f_code
+        if event != 'call' or code.co_name not in self.function_names or \
+                not code.co_filename.startswith(self.package_dir):
+            return None
+
+        last = [None, 0.]
+
+        def trace_lines(frame, event, arg):
+            now = time.perf_counter()
+            if last[0] is not None:
+                record = self.lines[(code.co_filename, code.co_name, last[0])]
+                record[0] += 1
+                record[1] += now - last[1]
+            if event == 'line':
+                last[0] = frame.f_lineno
+            elif event == 'return':
+                last[0] = None
+            last[1] = time.perf_counter()
+            return trace_lines
+
+        return trace_lines
+
+    def write(self, path):
+        by_function = defaultdict(list)
+        for (filename, function, line), (hits, seconds) in self.lines.items():
+            by_function[(filename, function)].append((line, hits, seconds))
+
+        with open(path, 'w') as f:
+            for (filename, function), lines in sorted(by_function.items(), key=lambda i: -sum(l[2] for l in i[1])):
+                total = sum(seconds for _, _, seconds in lines)
+                f.write(f'{function} ({os.path.basename(filename)}): {total:.4f} s\n')
+                f.write(f'{"line":>6} {"hits":>10} {"seconds":>10} {"%":>6}  source\n')
+                for line, hits, seconds in sorted(lines):
+                    source = linecache.getline(filename, line).rstrip()
+                    f.write(f'{line:>6} {hits:>10} {seconds:>10.4f} {100 * seconds / total if total else 0:>6.1f}  '
+                            f'{source}\n')
+                f.write('\n')
+
+
+class Profiler:
+    """
+    Profile the code run between start() and stop() (or inside a with block) and write the artifacts to profile_dir
+    """
+
+    def __init__(self, profile_dir, line_trace=False, memory=True, frames=10):
+        self.profile_dir = profile_dir
+        self.profile = cProfile.Profile()
+        self.line_tracer = LineTracer() if line_trace else None
+        self.memory = memory
+        self.frames = frames
+        self.snapshots = []
+        self.snapshot_stages = set()
+        self.thread = None
+        self.started_tracemalloc = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        self.thread = threading.current_thread()
+
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.frames)
+                self.started_tracemalloc = True
+            add_hook(self.stage_ended)
+
+        if self.line_tracer is not None:
+            self.line_tracer.start()
+        self.profile.enable()
+
+    def stop(self):
+        """
+        Stop profiling and write the artifacts. Returns the paths of the files written.
+        """
+        self.profile.disable()
+        if self.line_tracer is not None:
+            self.line_tracer.stop()
+
+        if self.memory:
+            remove_hook(self.stage_ended)
+            self.take_snapshot('end')
+            if self.started_tracemalloc:
+                tracemalloc.stop()
+
+        return self.write()
+
+    def stage_ended(self, record):
+        # only the profiled thread, and only the first call of each stage, to bound the cost
+        if threading.current_thread() is self.thread and record.stage not in self.snapshot_stages:
+            self.snapshot_stages.add(record.stage)
+            self.take_snapshot(record.stage)
+
+    def take_snapshot(self, label):
+        current, peak = tracemalloc.get_traced_memory()
+        self.snapshots.append((label, current, peak, tracemalloc.take_snapshot()))
+
+    def write(self):
+        paths = []
+
+        path = os.path.join(self.profile_dir, 'cprofile.prof')
+        self.profile.dump_stats(path)
+        paths.append(path)
+
+        stream = io.StringIO()
+        pstats.Stats(self.profile, stream=stream).sort_stats('cumulative').print_stats(50)
+        path = os.path.join(self.profile_dir, 'cprofile.txt')
+        with open(path, 'w') as f:
+            f.write(stream.getvalue())
+        paths.append(path)
+
+        if self.line_tracer is not None:
+            path = os.path.join(self.profile_dir, 'line_profile.txt')
+            self.line_tracer.write(path)
+            paths.append(path)
+
+        if self.snapshots:
+            summary_path = os.path.join(self.profile_dir, 'tracemalloc.txt')
+            with open(summary_path, 'w') as summary:
+                for index, (label, current, peak, snapshot) in enumerate(self.snapshots):
+                    name = re.sub(r'\W', '_', label)
+                    path = os.path.join(self.profile_dir, f'tracemalloc_{index:02d}_{name}.snapshot')
+                    snapshot.dump(path)
+                    paths.append(path)
+
+                    summary.write(f'After {label}: {current / 1024 ** 2:.1f} MB traced, '
+                                  f'peak {peak / 1024 ** 2:.1f} MB\n')
+                    for stat in snapshot.statistics('lineno')[:10]:
+                        summary.write(f'    {stat}\n')
+                    summary.write('\n')
+            paths.append(summary_path)
+
+        logger.info(f'Profile written to {self.profile_dir}')
+        return paths
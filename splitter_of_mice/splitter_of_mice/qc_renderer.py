@@ -0,0 +1,313 @@
+"""
+Rendering of the QC snapshots of a split: the axial projection of the hotel image with the detected regions and
+cut boxes, the middle sagittal slice of each cut, and one snapshot per cut combining both.
+
+Each snapshot is composed in a single preallocated uint8 RGB array, the boxes are drawn into it directly and the
+files are encoded concurrently. Percentiles are taken from one partial sort of the image. The snapshots are pixel
+for pixel those of the original PIL based rendering; only the PNG compression level differs.
+
+The snapshots are written as PNG files, or as a QC bundle: a single qc_bundle.zip holding each snapshot at several
+resolutions (LEVELS), in WebP where PIL supports it, with a manifest.json of the files, sizes and cut boxes:
+
+    {"version": 1, "modality": "PET", "format": "webp",
+     "levels": [{"name": "thumbnail", "max_size": 128}, {"name": "medium", "max_size": 512},
+                {"name": "full", "max_size": null}],
+     "images": {"split_qc": {"files": {"thumbnail": "thumbnail/split_qc.webp", ...},
+                             "sizes": {"thumbnail": [128, 37], ...}}, "qc_lt": {...}, ...},
+     "cuts": [{"label": 1, "desc": "lt", "name": "lt", "color": "lightblue", "image": "qc_lt",
+               "axial_box": [x0, y0, x1, y1], "sagittal_box": [x0, y0, x1, y1]}, ...]}
+
+Boxes are inclusive pixel coordinates in the full resolution split_qc image.
+"""
+import io
+import json
+import logging
+import os
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import skimage
+from PIL import Image, ImageColor, features
+
+from instrumentation import instrumented
+
+# logging
+logger = logging.getLogger(__name__)
+
+COLOR_MAP = {
+    'l': 'lightblue',
+    'r': 'red',
+    'ctr': 'violet',
+    'lb': 'violet',
+    'rb': 'lightgreen',
+    'lt': 'lightblue',
+    'rt': 'red'
+}
+
+# line width, label overlay opacity and percentile clipped from the range of each modality
+STYLES = {
+    'PET': {'linwid': 1, 'alpha': 0.1, 'pct': 5, 'zoom': 3},
+    'CT': {'linwid': 3, 'alpha': 0.3, 'pct': 2, 'zoom': 1},
+}
+
+# threads encoding image files; None for one per CPU
+PNG_WORKERS = None
+# zlib level of the PNG files; 3 encodes QC snapshots about twice as fast as PIL's default of 6 for ~10% more bytes
+PNG_COMPRESS_LEVEL = 3
+
+# resolutions of the QC bundle: name and maximum width or height (None for the full resolution)
+LEVELS = (('thumbnail', 128), ('medium', 512), ('full', None))
+BUNDLE_NAME = 'qc_bundle.zip'
+MANIFEST_NAME = 'manifest.json'
+WEBP_QUALITY = 80
+
+# worker rendering the QC snapshots of background QC, created on first use
+executor = None
+executor_lock = threading.Lock()
+
+
+def percentiles(im, pcts):
+    """
+    np.percentile(im, pcts) with linear interpolation, from a single partial sort of the values
+    """
+    flat = np.ravel(im)
+    n = flat.size
+    indices = [(n - 1) * (p / 100) for p in pcts]
+    below = [int(np.floor(i)) for i in indices]
+    above = [min(b + 1, n - 1) for b in below]
+    part = np.partition(flat, sorted(set(below + above)))
+
+    values = []
+    for i, b, a in zip(indices, below, above):
+        lo, hi, t = part[b], part[a], i - b
+        diff = hi - lo
+        # as numpy's lerp, exact at both ends
+        values.append(hi - diff * (1 - t) if t >= 0.5 else lo + diff * t)
+    return values
+
+
+def standardize_range(im, pct=5, ignore_min=False):
+    """
+    im clipped to its pct and 100 - pct percentiles (or 0 with ignore_min) and scaled to 0..255. im is not modified.
+    """
+    low, high = percentiles(im, (pct, 100 - pct))
+    mn = 0 if ignore_min else low
+    mx = high
+    # clipped values keep the data type of the image
+    im1 = np.clip(im, mn, mx).astype(im.dtype, copy=False)
+    logger.debug(f'min,max,rng: {mn}, {mx}, {mx - mn}')
+    return ((im1 - mn) / (mx - mn)) * 255
+
+
+def to_uint8(im):
+    """
+    Gray levels of a float image as PIL converts them: truncated and clipped to 0..255
+    """
+    return np.clip(np.nan_to_num(np.asarray(im, dtype='float32')), 0, 255).astype('uint8')
+
+
+def draw_box(arr, x0, y0, x1, y1, color, width=1):
+    """
+    Outline of the box with corners (x0, y0) and (x1, y1) (inclusive, x along columns) drawn inwards with the given
+    line width, as PIL's ImageDraw.rectangle for boxes of at least twice the line width
+    """
+    h, w = arr.shape[:2]
+    # PIL truncates the coordinates
+    x0, y0, x1, y1 = int(x0), int(y0), int(x1), int(y1)
+
+    def fill(r0, r1, c0, c1):
+        r0, r1, c0, c1 = max(r0, 0), min(r1, h - 1), max(c0, 0), min(c1, w - 1)
+        if r0 <= r1 and c0 <= c1:
+            arr[r0:r1 + 1, c0:c1 + 1] = color
+
+    fill(y0, min(y0 + width - 1, y1), x0, x1)
+    fill(max(y1 - width + 1, y0), y1, x0, x1)
+    fill(y0, y1, x0, min(x0 + width - 1, x1))
+    fill(y0, y1, max(x1 - width + 1, x0), x1)
+
+
+def stack(images):
+    """
+    Gray (h, w) or RGB (h, w, 3) uint8 images side by side, top aligned on black, in one new RGB array
+    """
+    arr = np.zeros((max(im.shape[0] for im in images), sum(im.shape[1] for im in images), 3), dtype='uint8')
+    offset = 0
+    for im in images:
+        h, w = im.shape[:2]
+        arr[:h, offset:offset + w] = im if im.ndim == 3 else im[..., None]
+        offset += w
+    return arr
+
+
+def zoomed(arr, zoom):
+    im = Image.fromarray(arr)
+    if zoom != 1:
+        w, h = im.size
+        im = im.resize((w * zoom, h * zoom), resample=Image.BILINEAR)
+    return im
+
+
+def encode(im, fp, image_format):
+    if image_format == 'webp':
+        im.save(fp, 'webp', quality=WEBP_QUALITY)
+    else:
+        im.save(fp, 'png', compress_level=PNG_COMPRESS_LEVEL)
+    return fp
+
+
+def run_concurrently(function, items):
+    """
+    [function(*item) for item in items], on up to PNG_WORKERS threads
+    """
+    items = list(items)
+    workers = min(len(items), PNG_WORKERS or os.cpu_count() or 1)
+    if workers <= 1:
+        return [function(*item) for item in items]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return [future.result() for future in [pool.submit(function, *item) for item in items]]
+
+
+def save_png(images):
+    """
+    Encode {path: PIL image} as PNG files, concurrently
+    """
+    run_concurrently(encode, [(im, path, 'png') for path, im in images.items()])
+
+
+def level_size(size, max_size):
+    w, h = size
+    if max_size is None or max(w, h) <= max_size:
+        return w, h
+    scale = max_size / max(w, h)
+    return max(1, round(w * scale)), max(1, round(h * scale))
+
+
+def save_bundle(path, img_type, images, cuts):
+    """
+    Write {name: full resolution PIL image} at each resolution of LEVELS and a manifest of the images and cuts into
+    a single zip file
+    """
+    image_format = 'webp' if features.check('webp') else 'png'
+    manifest = {
+        'version': 1,
+        'modality': img_type,
+        'format': image_format,
+        'levels': [{'name': level, 'max_size': max_size} for level, max_size in LEVELS],
+        'images': {},
+        'cuts': cuts,
+    }
+
+    jobs = []
+    for name, im in images.items():
+        entry = manifest['images'][name] = {'files': {}, 'sizes': {}}
+        for level, max_size in LEVELS:
+            size = level_size(im.size, max_size)
+            scaled = im if size == im.size else im.resize(size, resample=Image.BILINEAR, reducing_gap=2.0)
+            entry['files'][level] = f'{level}/{name}.{image_format}'
+            entry['sizes'][level] = list(size)
+            jobs.append((entry['files'][level], scaled))
+
+    encoded = run_concurrently(lambda name, im: (name, encode(im, io.BytesIO(), image_format).getvalue()), jobs)
+
+    # the images are compressed already
+    tmp_path = path + '.tmp'
+    with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_STORED) as zf:
+        zf.writestr(MANIFEST_NAME, json.dumps(manifest, indent=2))
+        for name, data in encoded:
+            zf.writestr(name, data)
+    os.replace(tmp_path, path)
+
+
+def submit(*args, **kwargs):
+    """
+    Run render_qc(*args, **kwargs) on the background QC worker and return a future for its result. Snapshots are
+    rendered one split at a time, in the order they were submitted.
+    """
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='qc')
+    return executor.submit(render_qc, *args, **kwargs)
+
+
+@instrumented('qc_render')
+def render_qc(projection, img_type, labels, rects_dict, sag_ims, outdir, desc_map=None, bundle=False):
+    """
+    Write the QC snapshots of a split to <outdir>/qc, as PNG files or a QC bundle, and return the combined snapshot
+    as a PIL image.
+
+    projection is the axial projection of the hotel image (normalized to 0..1 for PET, as returned by z_compress_ct
+    for CT), labels the label image of the detected regions, rects_dict the cuts ({'rect', 'desc'}) and sag_ims the
+    middle sagittal slice of each cut, in the same order.
+    """
+    style = STYLES[img_type]
+    desc_map = desc_map or {}
+    linwid = style['linwid']
+
+    if img_type == 'CT':
+        projection = standardize_range(projection, pct=style['pct'])
+        projection /= np.max(projection)
+
+    # sort the cuts by label
+    cuts = sorted(zip(rects_dict, sag_ims), key=lambda c: c[0]['rect'].label)
+    colors = [COLOR_MAP.get(rd['desc'], 'yellow') for rd, _ in cuts]
+    inks = [ImageColor.getrgb(c) for c in colors]
+
+    axial = np.uint8(255 * skimage.color.label2rgb(labels, image=projection, bg_label=0, alpha=style['alpha'],
+                                                   colors=colors))
+    sags = [to_uint8(standardize_range(sag, pct=style['pct'])) for _, sag in cuts]
+
+    qc_dir = os.path.join(outdir, 'qc')
+    os.makedirs(qc_dir, exist_ok=True)
+    outputs = {}
+
+    zoom = style['zoom']
+    manifest_cuts = []
+
+    # one snapshot per cut: its part of the axial projection next to its sagittal slice
+    for (rd, _), sag, color in zip(cuts, sags, colors):
+        arr = stack([rd['rect'].subimage(axial), np.swapaxes(sag, 0, 1)])
+        name = 'qc_' + desc_map.get(rd['desc'], rd['desc'])
+        outputs[name] = zoomed(arr, zoom)
+        manifest_cuts.append({'label': int(rd['rect'].label), 'desc': rd['desc'], 'name': name[3:], 'color': color,
+                              'image': name})
+
+    # the projection with the box of each cut, next to the sagittal slices of all cuts with boxes of the same colors
+    ah, aw = axial.shape[:2]
+    sh = max((sag.shape[0] for sag in sags), default=0)
+    sw = sum(sag.shape[1] for sag in sags)
+    arr = np.zeros((max(ah, sh), aw + sw, 3), dtype='uint8')
+    arr[:ah, :aw] = axial
+    ax_view, sag_view = arr[:ah, :aw], arr[:sh, aw:]
+
+    def full_box(x0, y0, x1, y1):
+        return [int(x0) * zoom, int(y0) * zoom, (int(x1) + 1) * zoom - 1, (int(y1) + 1) * zoom - 1]
+
+    off = 0
+    for (rd, _), sag, ink, cut in zip(cuts, sags, inks, manifest_cuts):
+        r = rd['rect']
+        draw_box(ax_view, r.ylt, r.xlt, r.yrb, r.xrb, ink, linwid)
+        sag_view[:sag.shape[0], off:off + sag.shape[1]] = sag[..., None]
+        cut['axial_box'] = full_box(r.ylt, r.xlt, r.yrb, r.xrb)
+        cut['sagittal_box'] = full_box(aw + off, 0, aw + off + sag.shape[1] - 1, sag.shape[0] - 1)
+        off += sag.shape[1]
+    off = 0
+    for sag, ink in zip(sags, inks):
+        draw_box(sag_view, off, 0, off + sag.shape[1] - 1, sag.shape[0] - 1, ink, linwid)
+        off += sag.shape[1]
+
+    qc_im = zoomed(arr, zoom)
+    outputs['split_qc'] = qc_im
+
+    if bundle:
+        path = os.path.join(qc_dir, BUNDLE_NAME)
+        logger.info(f'writing {path}')
+        save_bundle(path, img_type, outputs, manifest_cuts)
+    else:
+        paths = {os.path.join(qc_dir, name + '.png'): im for name, im in outputs.items()}
+        for path in paths:
+            logger.info(f'writing {path}')
+        save_png(paths)
+    return qc_im
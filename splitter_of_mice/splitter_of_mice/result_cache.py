@@ -0,0 +1,130 @@
+"""
+Local cache of animal detection results, so that re-running a split with different output parameters (e.g. a new
+margin) does not repeat the projection, thresholding and labelling of the hotel image.
+"""
+import glob
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from collections import namedtuple
+
+import numpy as np
+
+# logging
+logger = logging.getLogger(__name__)
+
+# Format of the cache entries, part of every key so that entries of an older format are not read
+VERSION = 2
+
+# Stand-in for skimage's RegionProperties with the attributes used by SoM.split_coords
+Region = namedtuple('Region', ['label', 'bbox', 'area'])
+
+
+def input_checksum(filepath, block_size=2 ** 24):
+    """
+    SHA-256 over the content of an input image: a DICOM directory (every .dcm file, in name order) or an Inveon
+    .img file together with its .hdr
+    """
+    if os.path.isdir(filepath):
+        files = sorted(glob.glob(os.path.join(filepath, '*.dcm')))
+    else:
+        files = [filepath] + ([filepath + '.hdr'] if os.path.exists(filepath + '.hdr') else [])
+
+    sha = hashlib.sha256()
+    for file in files:
+        sha.update(os.path.basename(file).encode())
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                sha.update(block)
+    return sha.hexdigest()
+
+
+class ResultCache:
+    """
+    Directory of detection results keyed by input checksum, modality and detection parameters.
+
+    Each entry is a single .npz file holding the axial projection shown in QC, the label image, the detected regions and any
+    extra values needed to resume the split (e.g. compensated thresholds). The total size of the directory is kept
+    under max_size bytes by evicting the least recently used entries.
+    """
+
+    def __init__(self, cache_dir, max_size=2 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(*parts, **params):
+        description = json.dumps({'version': VERSION, 'parts': parts, 'params': params}, sort_keys=True,
+                                 default=str)
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.npz')
+
+    def get_detection(self, key):
+        path = self.path(key)
+        if not os.path.exists(path):
+            logger.debug(f'Detection cache miss: {key}')
+            return None
+
+        try:
+            with np.load(path) as entry:
+                regions = [Region(int(label), tuple(int(b) for b in bbox), float(area))
+                           for label, bbox, area in zip(entry['region_labels'], entry['region_bboxes'],
+                                                        entry['region_areas'])]
+                detection = {
+                    'projection': entry['projection'],
+                    'labels': entry['labels'],
+                    'regions': regions,
+                    **json.loads(str(entry['info']))
+                }
+        except Exception as e:
+            logger.warning(f'Discarding unreadable detection cache entry {path}: {e}')
+            os.remove(path)
+            return None
+
+        # mark as recently used
+        os.utime(path)
+        logger.info(f'Detection cache hit: {key}')
+        return detection
+
+    def put_detection(self, key, projection, labels, regions, **info):
+        regions = [Region(int(r.label), tuple(int(b) for b in r.bbox), float(r.area)) for r in regions]
+
+        # write to a temporary file first so concurrent readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f,
+                     projection=np.asarray(projection),
+                     labels=np.asarray(labels),
+                     region_labels=np.array([r.label for r in regions], dtype=np.int64),
+                     region_bboxes=np.array([r.bbox for r in regions], dtype=np.int64).reshape(-1, 4),
+                     region_areas=np.array([r.area for r in regions], dtype=np.float64),
+                     info=np.array(json.dumps(info, default=float)))
+        os.replace(tmp_path, self.path(key))
+        logger.debug(f'Detection cached: {key}')
+
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for path in glob.glob(os.path.join(self.cache_dir, '*.npz')):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            logger.debug(f'Evicting detection cache entry {path}')
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
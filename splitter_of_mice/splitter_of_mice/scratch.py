@@ -0,0 +1,207 @@
+"""
+Scratch space for the tempfiles (memmaps) of loaded images.
+
+Each image gets a ScratchSpace, a directory under the scratch root that is removed when the space is closed, at the
+end of a with block, at interpreter exit or when the process is terminated by SIGTERM. A memmap created with
+ScratchSpace.memmap() is deleted as soon as the last array using it is garbage collected. Processes killed outright
+(e.g. by the OOM killer) cannot clean up, so each directory records its owner and directories of processes that are
+no longer running are swept when the first space of a process is created.
+
+The root defaults to the system temp directory and can be moved to a faster or larger disk (local NVMe, tmpfs) with
+set_scratch_root() or $SOM_SCRATCH_DIR. Allocations fail with ENOSPC before anything is written if the disk would be
+left with less than MIN_FREE bytes, or if the process would exceed the quota (set_scratch_quota() or
+$SOM_SCRATCH_QUOTA, e.g. '20G').
+"""
+import errno
+import logging
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import weakref
+
+import numpy as np
+
+import memory_budget
+
+# logging
+logger = logging.getLogger(__name__)
+
+ROOT_ENV_VAR = 'SOM_SCRATCH_DIR'
+QUOTA_ENV_VAR = 'SOM_SCRATCH_QUOTA'
+PREFIX = 'som_'
+OWNER_FILE = '.owner'
+MIN_FREE = 2 ** 28  # 256 MB
+
+scratch_root = os.environ.get(ROOT_ENV_VAR) or None
+scratch_quota = memory_budget.parse_size(os.environ.get(QUOTA_ENV_VAR))
+
+lock = threading.Lock()
+live_spaces = weakref.WeakSet()
+installed = False
+
+
+def set_scratch_root(path):
+    global scratch_root
+    scratch_root = path or None
+    if scratch_root is not None:
+        os.makedirs(scratch_root, exist_ok=True)
+
+
+def set_scratch_quota(value):
+    global scratch_quota
+    scratch_quota = memory_budget.parse_size(value)
+
+
+def get_scratch_root():
+    return scratch_root or tempfile.gettempdir()
+
+
+def owner():
+    return f'{socket.gethostname()} {os.getpid()}'
+
+
+def is_running(pid):
+    if os.name == 'nt':
+        return True  # os.kill would terminate the process; never sweep on Windows
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def sweep(root=None):
+    """
+    Remove the scratch directories left under root by processes of this host that are no longer running
+    """
+    root = root or get_scratch_root()
+    host = socket.gethostname()
+    try:
+        entries = os.listdir(root)
+    except OSError:
+        return []
+
+    removed = []
+    for entry in entries:
+        path = os.path.join(root, entry)
+        if not entry.startswith(PREFIX) or not os.path.isdir(path):
+            continue
+        try:
+            with open(os.path.join(path, OWNER_FILE)) as f:
+                owner_host, pid = f.read().split()
+        except (OSError, ValueError):
+            continue
+        if owner_host == host and not is_running(int(pid)):
+            shutil.rmtree(path, ignore_errors=True)
+            removed.append(path)
+
+    if removed:
+        logger.info(f'Removed {len(removed)} scratch directories left by stopped processes from {root}')
+    return removed
+
+
+def used_bytes():
+    with lock:
+        return sum(space.allocated for space in list(live_spaces))
+
+
+def check_space(directory, nbytes):
+    if scratch_quota is not None and used_bytes() + nbytes > scratch_quota:
+        raise OSError(errno.ENOSPC, f'Scratch quota of {scratch_quota / 2 ** 20:.0f} MB exceeded allocating '
+                                    f'{nbytes / 2 ** 20:.0f} MB')
+    free = shutil.disk_usage(directory).free
+    if free - nbytes < MIN_FREE:
+        raise OSError(errno.ENOSPC, f'Not enough free space in {directory} to allocate {nbytes / 2 ** 20:.0f} MB '
+                                    f'({free / 2 ** 20:.0f} MB free)')
+
+
+def close_all():
+    for space in list(live_spaces):
+        space.close()
+
+
+def on_sigterm(signum, frame):
+    close_all()
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
+
+
+def install_cleanup():
+    """
+    Close all spaces on SIGTERM, unless the process already handles SIGTERM itself (it then exits through the
+    normal path), and sweep the spaces left by stopped processes
+    """
+    global installed
+    with lock:
+        if installed:
+            return
+        installed = True
+
+    if threading.current_thread() is threading.main_thread() and \
+            signal.getsignal(signal.SIGTERM) in (signal.SIG_DFL, None):
+        signal.signal(signal.SIGTERM, on_sigterm)
+    sweep()
+
+
+class ScratchSpace:
+    """
+    A scratch directory with reference counted memmaps
+    """
+
+    def __init__(self, root=None, prefix=PREFIX):
+        install_cleanup()
+        root = root or get_scratch_root()
+        os.makedirs(root, exist_ok=True)
+        self.path = tempfile.mkdtemp(prefix=prefix, dir=root)
+        with open(os.path.join(self.path, OWNER_FILE), 'w') as f:
+            f.write(owner())
+        self.sizes = {}  # file name -> bytes, for the memmaps still in use
+        self.closed = False
+        # also removes the directory if the space is garbage collected or still open at exit
+        self.finalizer = weakref.finalize(self, shutil.rmtree, self.path, ignore_errors=True)
+        live_spaces.add(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def allocated(self):
+        return sum(self.sizes.values())
+
+    def memmap(self, name, dtype, shape):
+        """
+        A new memmap in the space, deleted once no array uses it any more
+        """
+        if self.closed:
+            raise ValueError(f'Scratch space {self.path} is closed')
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        check_space(self.path, nbytes)
+
+        path = os.path.join(self.path, name)
+        mm = np.memmap(path, mode='w+', dtype=dtype, shape=tuple(shape))
+        self.sizes[name] = nbytes
+        weakref.finalize(mm, self.release, name)
+        return mm
+
+    def release(self, name):
+        self.sizes.pop(name, None)
+        try:
+            os.remove(os.path.join(self.path, name))
+        except OSError:
+            pass  # already removed with the space, or still mapped (Windows)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.sizes.clear()
+        self.finalizer()
+        live_spaces.discard(self)
@@ -4,16 +4,18 @@ Implementation of splitting of hotel image into individual mouse images.
 import logging
 
 import numpy as np
-import skimage
 import os
-from PIL import Image, ImageDraw
 from skimage import measure, filters
 from skimage.measure import label
 from skimage.morphology import disk
 from skimage.morphology import (erosion, dilation)
 
+import cut_writers
+import qc_renderer
 from image_classes import PETImage, CTImage, DicomImage, SubImage
+from instrumentation import instrumented, stage
 from rectangle import Rect
+from result_cache import input_checksum
 
 #  logging
 logger = logging.getLogger(__name__)
@@ -49,6 +51,24 @@ class SoM:
         self.scan_time = None
         self.outdir = None
         self.original_number_cuts = None
+        self.zip = False
+        # formats of cut_writers written next to the split images, e.g. ('nii.gz',)
+        self.output_formats = ()
+        # called with (subject, zip file path) each time a zipped cut has been written
+        self.on_cut_written = None
+        # called with the subject of each cut once the cuts have been added to the image, before any is written
+        self.on_cuts_added = None
+        # optional ResultCache of detection results
+        self.cache = None
+        self.checksum = None
+        self.detection_key = None
+        # axial projection computed by the split, reused for the QC snapshots
+        self.projection = None
+        # render the QC snapshots on a background worker; qc_future is set to the future of the snapshots
+        self.background_qc = False
+        self.qc_future = None
+        # write the QC snapshots as a single qc_bundle.zip of qc_renderer instead of PNG files
+        self.qc_bundle = False
 
     @staticmethod
     def load_image_ex(file, modality):
@@ -76,6 +96,7 @@ class SoM:
             return None, None
 
     @staticmethod
+    @instrumented('load_image')
     def load_image(file, modality=None, dicom=False, **kwargs):
         if dicom:
             try:
@@ -118,11 +139,15 @@ class SoM:
         return pi, detect_mod
 
     @staticmethod
+    @instrumented('z_compress_pet')
     def z_compress_pet(pi):
         n = 12
         img = pi.img_data
         if len(img.shape) == 3:
             imgz = np.squeeze(np.sum(img, axis=0))
+        elif len(img.shape) == 4 and pi.scaled:
+            # scale the sum over z of each frame rather than the whole image
+            imgz = np.squeeze(np.sum(pi.apply_scale(np.sum(img, axis=0, dtype='float64')), axis=-1))
         elif len(img.shape) == 4:
             imgz = np.squeeze(np.sum(img, axis=(0, 3)))
         else:
@@ -132,17 +157,18 @@ class SoM:
         return im
 
     @staticmethod
+    @instrumented('z_compress_ct')
     def z_compress_ct(pi, thresh, binary=True):
         img = pi.img_data
         sh = img.shape
         nsl = sh[0]
 
         if not binary:
-            return np.squeeze(img[int(nsl / 2), :, :])
+            return np.squeeze(SoM.scale_slice(pi, img[int(nsl / 2), :, :]))
 
         sl = np.zeros((sh[1], sh[2])).astype('float32')
         for z in range(nsl):
-            slm = np.squeeze(img[z, :, :])
+            slm = np.squeeze(SoM.scale_slice(pi, img[z, :, :]))
             if binary:
                 slm = np.where(slm > thresh, 1, 0)
             sl += slm
@@ -150,10 +176,15 @@ class SoM:
         sl /= float(nsl)
         return sl / float(nsl)
 
+    @staticmethod
+    def scale_slice(pi, slm):
+        # an axial slice keeps the frames axis of 4-D images
+        return pi.apply_scale(slm) if len(pi.img_data.shape) == 4 else slm
+
     def split_mice(self, num_anim=None,
                    sep_thresh=None, margin=None, minpix=None, output_qc=False,
                    suffix_map=None, zip=False, remove_bed=False, dicom_metadata=None,
-                   coregister_cuts=None):
+                   coregister_cuts=None, output_formats=None):
 
         if suffix_map is not None:
             for s in suffix_map.split(','):
@@ -161,6 +192,10 @@ class SoM:
                 if len(mp) < 2: continue
                 if mp[0] in d.keys(): d[mp[0]] = mp[1]
 
+        self.zip = zip
+        if output_formats is not None:
+            self.output_formats = cut_writers.check_formats(output_formats)
+
         if self.modality == 'PET' or self.modality == 'PT':
             margin = 4 if margin is None else margin
             minpix = 200 if minpix is None else minpix
@@ -177,6 +212,7 @@ class SoM:
             return -1
 
     @staticmethod
+    @instrumented('detect_animals')
     def detect_animals(im, thresh):
         blobs = im > thresh
         (blobs_labels, num) = measure.label(blobs, return_num=True, background=0)
@@ -204,6 +240,7 @@ class SoM:
             rect.yrb = img.shape[1]
 
     @staticmethod
+    @instrumented('split_coords')
     def split_coords(img, valid_reg):
         ims = []
         out_boxes = []
@@ -296,6 +333,7 @@ class SoM:
         return out_boxes
 
     @staticmethod
+    @instrumented('remove_bed')
     def remove_bed(img):
         logger.info('Removing bed')
         footprint = disk(10)
@@ -304,6 +342,7 @@ class SoM:
         return dilated
 
     @staticmethod
+    @instrumented('add_cuts_to_image')
     def add_cuts_to_image(im, boxes, dicom_metadata=None):
 
         ims = []
@@ -333,9 +372,20 @@ class SoM:
         return ims
 
     @staticmethod
-    def write_images(pi, outdir, zip=False):
+    def write_images(pi, outdir, zip=False, on_cut_written=None, output_formats=()):
         for ind in range(len(pi.cuts)):
-            pi.save_cut(ind, f"{outdir}/", zip=zip)
+            SoM.write_cut(pi, ind, outdir, zip=zip, on_cut_written=on_cut_written, output_formats=output_formats)
+
+    @staticmethod
+    @instrumented('write_images')
+    def write_cut(pi, index, outdir, zip=False, on_cut_written=None, output_formats=()):
+        num_zip_outputs = len(pi.zip_outputs)
+        pi.save_cut(index, f"{outdir}/", zip=zip)
+        for output_format in output_formats:
+            cut_writers.write_cut(pi.cuts[index], outdir, output_format)
+        if on_cut_written is not None:
+            for subject, zip_file_path in pi.zip_outputs[num_zip_outputs:]:
+                on_cut_written(subject, zip_file_path)
 
     def split_mice_ct(self, outdir, num_anim=None,
                       sep_thresh=0.99, margin=20, minpix=3300, output_qc=False,
@@ -350,47 +400,58 @@ class SoM:
 
         logger.debug(f"num_anim={num_anim}, sep_thresh={sep_thresh}, margin={margin}, minpix={minpix}")
 
-        imz = SoM.z_compress_ct(self.pi, 50, False)
-        # Automatic thresholding for dicom images
-        thresh = None
-
-        if self.pi.image_format == 'dicom':
-            thresh = filters.threshold_li(imz)
-            logger.info(f"Li thresholding for dicom images: {thresh}")
+        detection = self.cached_detection(num_anim=num_anim, minpix=minpix, bed_removal=bed_removal,
+                                          coregister_cuts=coregister_cuts)
+        if detection is not None:
+            imz, self.blobs_labels, rects = detection['projection'], detection['labels'], detection['regions']
+            self.projection = imz
         else:
-            thresh = filters.threshold_otsu(imz)
-            logger.info(f"OTSU thresholding for microPET images: {thresh}")
-
-        if bed_removal:
-            imz = SoM.remove_bed(imz)
-
-        self.blobs_labels, num = SoM.detect_animals(imz, thresh)
-        rects = SoM.get_valid_regs(self.blobs_labels)
-
-        if num_anim is not None and len(rects) != num_anim:
-            logger.info(f"split_mice_ct detected {len(rects)} regions, expected {num_anim}, attempting to compensate")
-
-            attempts = 0
-            while len(rects) < num_anim and attempts < 4:
-                # if you have greater than num_anim, then split_coords will merge rects within the same quadrant
-                # only need to adjust the threshold if you have less than num_anim
-                attempts += 1
-                logger.info(f"Compensation attempt {attempts}")
-                logger.info(f"Current threshold: {thresh}")
-                thresh += thresh * 0.1
-                logger.info(f"New threshold: {thresh}")
-                self.blobs_labels, num = SoM.detect_animals(imz, thresh)
-                rects = SoM.get_valid_regs(self.blobs_labels)
+            imz = SoM.z_compress_ct(self.pi, 50, False)
+            self.projection = imz
+            # Automatic thresholding for dicom images
+            thresh = None
+
+            if self.pi.image_format == 'dicom':
+                thresh = filters.threshold_li(imz)
+                logger.info(f"Li thresholding for dicom images: {thresh}")
+            else:
+                thresh = filters.threshold_otsu(imz)
+                logger.info(f"OTSU thresholding for microPET images: {thresh}")
 
-            if len(rects) != num_anim:
-                if not coregister_cuts:
-                    logger.error('Compensation failed. Unable to detect the expected number of regions.')
-                    self.pi.clean_cuts()
-                    self.pi.unload_image()
-                    return 1
-                else:
-                    #we're going to keep going and hope that it gets fixed during coregistration
-                    logger.debug('Compensation failed. Unable to detect the expected number of regions. Waiting for coregistration to fix.')
+            if bed_removal:
+                imz = SoM.remove_bed(imz)
+
+            self.blobs_labels, num = SoM.detect_animals(imz, thresh)
+            rects = SoM.get_valid_regs(self.blobs_labels)
+
+            if num_anim is not None and len(rects) != num_anim:
+                logger.info(f"split_mice_ct detected {len(rects)} regions, expected {num_anim}, attempting to compensate")
+
+                attempts = 0
+                with stage('compensation'):
+                    while len(rects) < num_anim and attempts < 4:
+                        # if you have greater than num_anim, then split_coords will merge rects within the same quadrant
+                        # only need to adjust the threshold if you have less than num_anim
+                        attempts += 1
+                        logger.info(f"Compensation attempt {attempts}")
+                        logger.info(f"Current threshold: {thresh}")
+                        thresh += thresh * 0.1
+                        logger.info(f"New threshold: {thresh}")
+                        self.blobs_labels, num = SoM.detect_animals(imz, thresh)
+                        rects = SoM.get_valid_regs(self.blobs_labels)
+
+                if len(rects) != num_anim:
+                    if not coregister_cuts:
+                        logger.error('Compensation failed. Unable to detect the expected number of regions.')
+                        self.pi.clean_cuts()
+                        self.pi.unload_image()
+                        return 1
+                    else:
+                        #we're going to keep going and hope that it gets fixed during coregistration
+                        logger.debug('Compensation failed. Unable to detect the expected number of regions. Waiting for coregistration to fix.')
+
+            # the projection before bed removal is cached, so that a cache hit renders the same QC
+            self.cache_detection(self.projection, rects)
 
         self.cuts = SoM.split_coords(imz, rects)
 
@@ -412,115 +473,194 @@ class SoM:
 
         logger.debug(f"num_anim={num_anim}, sep_thresh={sep_thresh}, margin={margin}, minpix={minpix}")
 
-        imz = SoM.z_compress_pet(self.pi)
-        self.blobs_labels, num = SoM.detect_animals(imz, SoM.sep_thresh * np.mean(imz))
-        self.original_number_cuts = num
-
-        if num_anim is not None:
-            if num < num_anim:
-                logger.info('split_mice detected less regions ({}) than indicated animals({}), attempting to compensate'.
-                      format(num, num_anim))
-                while num < num_anim and self.sep_thresh < 1:
-                    self.sep_thresh += 0.01
-                    self.blobs_labels, num = SoM.detect_animals(imz, SoM.sep_thresh * np.mean(imz))
-                if num < num_anim:
-                    if not coregister_cuts:
-                        logger.error('Compensation failed. We cannot find enough regions.')
-                        self.pi.clean_cuts()
-                        self.pi.unload_image()
-                        return 1
-                    else:
-                        #we're going to keep going and hope that it gets fixed during coregistration
-                        logger.debug('Compensation failed. We cannot find enough regions. Waiting for coregistration to fix.')
-            rects = measure.regionprops(self.blobs_labels)
-            if num > num_anim:
-                rects.sort(key=lambda p: p.area, reverse=True)
-                rects = rects[:num_anim]
+        detection = self.cached_detection(num_anim=num_anim, sep_thresh=SoM.sep_thresh, minpix=minpix,
+                                          coregister_cuts=coregister_cuts)
+        if detection is not None:
+            imz, self.blobs_labels, rects = detection['projection'], detection['labels'], detection['regions']
+            self.original_number_cuts = detection['original_number_cuts']
+            self.sep_thresh = detection['sep_thresh']
         else:
-            rects = SoM.get_valid_regs(self.blobs_labels)
-            if len(rects) > 4:
-                logger.info('detected {}>4 regions, attempting to compensate'.format(len(rects)))
-                inc = self.minpix * 0.1
-                while len(rects) > 4:
-                    self.minpix += inc
-                    rects = SoM.get_valid_regs(self.blobs_labels)
+            imz = SoM.z_compress_pet(self.pi)
+            self.blobs_labels, num = SoM.detect_animals(imz, SoM.sep_thresh * np.mean(imz))
+            self.original_number_cuts = num
+
+            if num_anim is not None:
+                if num < num_anim:
+                    logger.info('split_mice detected less regions ({}) than indicated animals({}), attempting to compensate'.
+                          format(num, num_anim))
+                    with stage('compensation'):
+                        while num < num_anim and self.sep_thresh < 1:
+                            self.sep_thresh += 0.01
+                            self.blobs_labels, num = SoM.detect_animals(imz, SoM.sep_thresh * np.mean(imz))
+                    if num < num_anim:
+                        if not coregister_cuts:
+                            logger.error('Compensation failed. We cannot find enough regions.')
+                            self.pi.clean_cuts()
+                            self.pi.unload_image()
+                            return 1
+                        else:
+                            #we're going to keep going and hope that it gets fixed during coregistration
+                            logger.debug('Compensation failed. We cannot find enough regions. Waiting for coregistration to fix.')
+                rects = measure.regionprops(self.blobs_labels)
+                if num > num_anim:
+                    rects.sort(key=lambda p: p.area, reverse=True)
+                    rects = rects[:num_anim]
+            else:
+                rects = SoM.get_valid_regs(self.blobs_labels)
+                if len(rects) > 4:
+                    logger.info('detected {}>4 regions, attempting to compensate'.format(len(rects)))
+                    inc = self.minpix * 0.1
+                    with stage('compensation'):
+                        while len(rects) > 4:
+                            self.minpix += inc
+                            rects = SoM.get_valid_regs(self.blobs_labels)
+
+            self.cache_detection(imz, rects, original_number_cuts=self.original_number_cuts,
+                                 sep_thresh=self.sep_thresh)
+
         self.cuts = SoM.split_coords(imz, rects)
+        self.projection = imz
 
         if not coregister_cuts:
             self.complete_cut_process(dicom_metadata, output_qc)
 
         return 0
 
+    def cached_detection(self, **params):
+        """
+        Look up the detection result for this image and the given detection parameters. Returns None if there is no
+        cache or no entry; otherwise a dict with 'projection', 'labels', 'regions' and the values given to
+        cache_detection.
+        """
+        if self.cache is None:
+            return None
+
+        if self.checksum is None:
+            self.checksum = self.pi.checksum or input_checksum(self.filename)
+
+        self.detection_key = self.cache.key('detection', self.checksum, modality=self.modality,
+                                            rotation_history=self.pi.rotation_history, **params)
+        return self.cache.get_detection(self.detection_key)
+
+    def cache_detection(self, projection, regions, **info):
+        if self.cache is None or self.detection_key is None:
+            return
+        self.cache.put_detection(self.detection_key, projection, self.blobs_labels, regions, **info)
+
+    def use_reference_cuts(self, cuts, zip=False, min_share=0.2, min_total=0.5):
+        """
+        Take cuts detected on another scan of the session, already mapped to this image, instead of detecting the
+        animals here. Only the z projections are computed, and checked: the mass above background inside each cut must
+        be at least min_share of an equal share and the cuts together must hold at least min_total of it. The CT is
+        checked on all slices, the fraction above the tissue threshold with the bed removed as in split_mice_ct, rather
+        than on the single slice kept for QC. Returns False, leaving the splitter unchanged, if the check fails.
+        """
+        if self.modality == 'CT':
+            imz = SoM.z_compress_ct(self.pi, 50, False)
+            checked = SoM.remove_bed(SoM.z_compress_ct(self.pi, 50))
+        else:
+            imz = checked = SoM.z_compress_pet(self.pi)
+        mass = np.clip(checked - np.median(checked), 0, None)
+        total = float(mass.sum())
+
+        labels = np.zeros(imz.shape, dtype='int32')
+        inside = []
+        for index, cut in enumerate(cuts):
+            r = cut['rect']
+            inside.append(float(mass[r.xlt:r.xrb, r.ylt:r.yrb].sum()))
+            labels[r.xlt:r.xrb, r.ylt:r.yrb] = r.label if r.label is not None else index + 1
+
+        if not cuts or total <= 0 or min(inside) < min_share * total / len(cuts) or sum(inside) < min_total * total:
+            shares = [round(m / total, 3) if total > 0 else 0. for m in inside]
+            logger.warning(f'Reference cuts do not fit {self.pi.filename}: share of mass in each cut {shares}')
+            return False
+
+        self.zip = zip
+        self.cuts = cuts
+        self.projection = imz
+        self.blobs_labels = labels
+        self.original_number_cuts = len(cuts)
+        return True
+
+    @staticmethod
+    def cut_subject(cut):
+        """
+        Subject (PatientID of the hotel metadata) a cut is written for, or None
+        """
+        metadata = getattr(cut, 'metadata', None)
+        return metadata.get('PatientID') if isinstance(metadata, dict) else None
+
     def complete_cut_process(self, dicom_metadata, output_qc):
-        SoM.add_cuts_to_image(self.pi, self.cuts, dicom_metadata)
+        SoM.complete_cut_processes([self], dicom_metadata, output_qc)
+
+    @staticmethod
+    def complete_cut_processes(splitters, dicom_metadata, output_qc):
+        """
+        Add, write and QC the cuts of several splitters, e.g. the PET and CT of one hotel, or all scans of a
+        session. The cuts are written in turn, one cut of each splitter at a time, with the cuts of one subject
+        together, so that all outputs for an animal are ready as early as possible.
+        """
+        for splitter in splitters:
+            SoM.add_cuts_to_image(splitter.pi, splitter.cuts, dicom_metadata)
+            if splitter.on_cuts_added is not None:
+                splitter.on_cuts_added([SoM.cut_subject(cut) for cut in splitter.pi.cuts])
 
         # write the images.
-        if self.outdir is not None:
-            SoM.write_images(self.pi, self.outdir, zip=zip)
+        num_cuts = max(len(splitter.pi.cuts) for splitter in splitters)
+        writes = [(splitter, index) for index in range(num_cuts) for splitter in splitters
+                  if splitter.outdir is not None and index < len(splitter.pi.cuts)]
+        first_write = {}
+        for position, (splitter, index) in enumerate(writes):
+            subject = SoM.cut_subject(splitter.pi.cuts[index])
+            first_write.setdefault(position if subject is None else subject, position)
+        order = [first_write.get(SoM.cut_subject(splitter.pi.cuts[index]), position)
+                 for position, (splitter, index) in enumerate(writes)]
+        for _, (splitter, index) in sorted(zip(order, writes), key=lambda w: w[0]):
+            SoM.write_cut(splitter.pi, index, splitter.outdir, zip=splitter.zip,
+                          on_cut_written=splitter.on_cut_written, output_formats=splitter.output_formats)
 
         if output_qc:
-            im = SoM.qc_image(self.pi, self.blobs_labels, self.cuts, self.outdir)
+            for splitter in splitters:
+                qc = SoM.qc_image(splitter.pi, splitter.blobs_labels, splitter.cuts, splitter.outdir,
+                                  projection=splitter.projection, background=splitter.background_qc,
+                                  bundle=splitter.qc_bundle)
+                if splitter.background_qc:
+                    splitter.qc_future = qc
 
 
     @staticmethod
-    def get_sag_image(img_data):
+    def get_sag_image(img_data, scale_factors=None):
         sh = img_data.shape
         if len(sh) < 4:
             return np.squeeze(img_data[:, np.int32(sh[1] / 2), :])
-        else:
+        elif scale_factors is None:
             return np.squeeze(img_data[:, np.int32(sh[1] / 2), :, np.int32(sh[3] / 2)])
+        else:
+            frame = np.int32(sh[3] / 2)
+            return np.squeeze(img_data[:, np.int32(sh[1] / 2), :, frame]) * scale_factors[frame]
 
     @staticmethod
     def standardize_range(im, ignore_min=False, pct=5):
-        mx = np.percentile(im, 100 - pct)
-        mn = 0 if ignore_min else np.percentile(im, pct)
-        im1 = im
-        im1[im > mx] = mx
-        im1[im < mn] = mn
-        rng = mx - mn
-        logger.debug(f'min,max,rng: {mn}, {mx}, {rng}')
-        im1 = ((im1 - mn) / rng) * 255
-        logger.debug(f'min_new,max_new: {np.min(im1)}, {np.max(im1)}')
-        return im1
-
-    @staticmethod
-    def combine_images(images, mode='horizontal'):
-        widths, heights = zip(*(i.size for i in images))
-        if mode == 'horizontal':
-            total_width, max_height = sum(widths), max(heights)
-            new_im = Image.new('RGB', (total_width, max_height))
-            x_offset = 0
-            for im in images:
-                new_im.paste(im, (x_offset, 0))
-                x_offset += im.size[0]
-            return new_im
-        else:
-            total_height = sum(heights)
-            max_width = max(widths)
-            new_im = Image.new('RGB', (max_width, total_height))
-            y_offset = 0
-            for im in images:
-                new_im.paste(im, (0, y_offset))
-                y_offset += im.size[1]
-            return new_im
+        return qc_renderer.standardize_range(im, pct=pct, ignore_min=ignore_min)
 
     @staticmethod
-    def qc_image(pi, labels, rects_dict, outdir):
+    @instrumented('qc_image')
+    def qc_image(pi, labels, rects_dict, outdir, projection=None, background=False, bundle=False):
+        """
+        Write the QC snapshots of a split. projection is the axial projection computed by the split, if available
+        (z_compress_pet for PET, z_compress_ct without bed removal for CT); otherwise it is computed again.
+
+        With background=True the snapshots are rendered on the background QC worker from copies of the projection,
+        labels and sagittal slices, so the image may be unloaded meanwhile, and a future of the snapshot is returned.
+        With bundle=True the snapshots are written as a QC bundle (qc_renderer.save_bundle) instead of PNG files.
+        """
         if isinstance(pi, PETImage) or (isinstance(pi, DicomImage) and (pi.modality == 'PT' or pi.modality == 'PET')):
-            imz = SoM.z_compress_pet(pi)
+            imz = SoM.z_compress_pet(pi) if projection is None else projection
             img_type = 'PET'
-            imz /= np.max(imz)
-            linwid = 1
-            alpha = 0.1
-            pct = 5
+            imz = imz / np.max(imz)
         elif isinstance(pi, CTImage) or (isinstance(pi, DicomImage) and pi.modality == 'CT'):
-            imz = SoM.z_compress_ct(pi, SoM.sep_thresh, binary=False)
+            imz = SoM.z_compress_ct(pi, SoM.sep_thresh, binary=False) if projection is None else projection
             img_type = 'CT'
-            pct = 2
-            imz = SoM.standardize_range(imz, pct=pct)
-            imz /= np.max(imz)
-            linwid = 3
-            alpha = 0.3
         elif isinstance(pi, DicomImage):
             logger.error(f"QC not supported for dicom modality: {pi.modality}")
             return
@@ -532,81 +672,13 @@ class SoM:
             logger.info('qc_image: unknown image type')
             return
 
-        color_map = {
-            'l': 'lightblue',
-            'r': 'red',
-            'ctr': 'violet',
-            'lb': 'violet',
-            'rb': 'lightgreen',
-            'lt': 'lightblue',
-            'rt': 'red'
-        }
-
-        # sort rects_dict by label
-        rects_dict = sorted(rects_dict, key=lambda k: k['rect'].label)
-
-        colors = [color_map[rd['desc']] if rd['desc'] in color_map else 'yellow' for rd in rects_dict]
-        imz_qc_arr = np.uint8(255 * skimage.color.label2rgb(labels, image=imz, bg_label=0, alpha=alpha, colors=colors))
-        imz_qc = Image.fromarray(imz_qc_arr).convert('RGB')
-
-        # make individual axial images.
-        ax_ims_pil, ax_ims_lbl = [], []
-
-        d = ImageDraw.Draw(imz_qc)
-
-        for i in range(0, len(rects_dict)):
-            rd = rects_dict[i]
-            r = rd['rect']
-            im0 = r.subimage(imz_qc_arr)  # logger.info('axial subimage ',i,', ',im0.shape)
-            ax_ims_pil += [Image.fromarray(im0).convert('RGB')]
-            ax_ims_lbl += [rd['desc']]
-            logger.info(ax_ims_lbl)
-            d.rectangle(((r.ylt, r.xlt), (r.yrb, r.xrb)), outline=colors[i], width=linwid)
-
-        sag_ims = [SoM.get_sag_image(pi.cuts[i].img_data) for i in range(len(pi.cuts))]
-        sag_ims_pil = []
-        for i, im in zip(range(0, len(rects_dict)), sag_ims):
-            im1 = SoM.standardize_range(im, pct=pct)
-            imp = Image.fromarray(im1).convert('RGB')
-            sag_ims_pil += [imp]
-            # code to combine axial and sagittal images, and save subimage.
-            individual_qc_im = SoM.combine_images(
-                [ax_ims_pil[i], Image.fromarray(np.swapaxes(im1, 0, 1)).convert('RGB')])
-            if img_type == 'PET':
-                w, h = individual_qc_im.size
-                individual_qc_im = individual_qc_im.resize((w * 3, h * 3), resample=Image.BILINEAR)
-            fnamei = outdir + '/qc/' + 'qc_' + SoM.desc_map[ax_ims_lbl[i]] + '.png'
-
-            if not os.path.exists(f"{outdir}/qc"):
-                os.makedirs(f"{outdir}/qc")
-
-            logger.info(f"writing {fnamei}")
-            # create the file if it doesn't exist
-            open(fnamei, 'a').close()
-            individual_qc_im.save(fnamei, 'png')
-
-        si_dims = [sag_ims[0].shape]
-        sag_im = SoM.combine_images(sag_ims_pil)
-        d1 = ImageDraw.Draw(sag_im)
-        off = 0
-        for i in range(len(sag_ims)):
-            sh = sag_ims[i].shape
-            d1.rectangle([off, 0, off + sh[1] - 1, sh[0] - 1], outline=colors[i], width=linwid)
-            off += sh[1]
-
-        fname = outdir + '/qc/' + 'split_qc.png'
-
-        if not os.path.exists(f"{outdir}/qc"):
-            os.makedirs(f"{outdir}/qc")
-
-        qc_im = SoM.combine_images([imz_qc, sag_im])
-        if img_type == 'PET':
-            w, h = qc_im.size
-            qc_im = qc_im.resize((w * 3, h * 3), resample=Image.BILINEAR)
-        logger.info(f"writing {fname}")
-        qc_im.save(fname, 'png')
-
+        sag_ims = [np.array(SoM.get_sag_image(pi.cuts[i].img_data, pi.cuts[i].frame_scale_factors()))
+                   for i in range(len(pi.cuts))]
         pi.qc_outputs = f'{outdir}/qc'
 
-        return qc_im
+        if background:
+            return qc_renderer.submit(np.array(imz), img_type, np.array(labels), list(rects_dict), sag_ims, outdir,
+                                      desc_map=dict(SoM.desc_map), bundle=bundle)
+        return qc_renderer.render_qc(imz, img_type, labels, rects_dict, sag_ims, outdir, desc_map=SoM.desc_map,
+                                     bundle=bundle)
         # end of SoM class
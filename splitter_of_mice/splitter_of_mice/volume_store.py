@@ -0,0 +1,242 @@
+"""
+Persistent store of loaded hotel volumes, so that splitting the same images again (a re-run, a new margin, QC
+regeneration) does not repeat the conversion of the source files.
+
+The store is a directory set with set_store_dir() (the --volume-store option of the entry points) or the
+SOM_VOLUME_STORE environment variable; without it images are always read from their source files. Each volume is
+kept in a directory named after the checksum of its source files (result_cache.input_checksum) and holds:
+
+    index.json  shape (z, y, x, frames), data type, planes per slab, offset and length of each chunk and any extra
+                values needed to open the image without its source files being decoded again (e.g. the sorted DICOM
+                file names)
+    chunks.bin  the chunks one after another, each a slab of planes of one frame compressed with zlib
+
+so any slab of any frame can be read without decompressing the rest. Entries are written to a temporary directory
+and renamed into place, so concurrent readers never see a partial entry. The path, size and modification time of
+each source file are mapped to its checksum, so re-opening unchanged files does not hash them again. The total
+size of the store is kept under max_size bytes by evicting the least recently used volumes.
+"""
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import zlib
+
+import numpy as np
+
+import memory_budget
+from result_cache import input_checksum
+
+# logging
+logger = logging.getLogger(__name__)
+
+ENV_VAR = 'SOM_VOLUME_STORE'
+SIZE_ENV_VAR = 'SOM_VOLUME_STORE_SIZE'
+INDEX_FILE = 'index.json'
+CHUNKS_FILE = 'chunks.bin'
+SOURCES_DIR = 'sources'
+CHUNK_SIZE = 2 ** 22  # 4 MB of uncompressed planes per chunk
+COMPRESSION_LEVEL = 1
+VERSION = 1
+
+store_dir = os.environ.get(ENV_VAR) or None
+max_size = memory_budget.parse_size(os.environ.get(SIZE_ENV_VAR))
+
+
+def set_store_dir(path, size=None):
+    """
+    Use the store in directory path (None disables it), limited to size, e.g. '20G' (a plain number is MB)
+    """
+    global store_dir, max_size
+    store_dir = path or None
+    if size is not None:
+        max_size = memory_budget.parse_size(size)
+    if store_dir is not None:
+        os.makedirs(os.path.join(store_dir, SOURCES_DIR), exist_ok=True)
+        logger.info(f'Volume store: {store_dir}')
+
+
+def source_files(filepath):
+    if os.path.isdir(filepath):
+        return sorted(glob.glob(os.path.join(filepath, '*.dcm')))
+    return [filepath] + ([filepath + '.hdr'] if os.path.exists(filepath + '.hdr') else [])
+
+
+def source_key(filepath):
+    """
+    Key of the path, size and modification time of the source files of an image
+    """
+    sha = hashlib.sha256(os.path.abspath(filepath).encode())
+    for file in source_files(filepath):
+        stat = os.stat(file)
+        sha.update(f'{os.path.basename(file)} {stat.st_size} {stat.st_mtime_ns}'.encode())
+    return sha.hexdigest()
+
+
+def checksum(filepath):
+    """
+    input_checksum of an image, remembered in the store for as long as its source files are unchanged
+    """
+    if store_dir is None:
+        return input_checksum(filepath)
+
+    path = os.path.join(store_dir, SOURCES_DIR, source_key(filepath))
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        pass
+
+    value = input_checksum(filepath)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as f:
+        f.write(value)
+    os.replace(tmp_path, path)
+    return value
+
+
+def slab_planes(shape, dtype):
+    """
+    Number of planes per chunk
+    """
+    z, y, x = shape[:3]
+    return int(max(1, min(z, CHUNK_SIZE // max(1, y * x * np.dtype(dtype).itemsize))))
+
+
+class Volume:
+    """
+    A volume in the store, opened for random access to slabs of planes
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            index = json.load(f)
+        if index.get('version') != VERSION:
+            raise ValueError(f'Unsupported volume store version {index.get("version")} in {path}')
+        self.shape = tuple(index['shape'])
+        self.dtype = np.dtype(index['dtype'])
+        self.planes = index['planes']
+        self.chunks = index['chunks']  # [frame][slab] -> [offset, length]
+        self.meta = index['meta']
+
+    def read(self, frame, z0=0, z1=None, out=None):
+        """
+        Planes z0 to z1 (exclusive) of a frame as a (z, y, x) array, read into out if given
+        """
+        z1 = self.shape[0] if z1 is None else z1
+        if out is None:
+            out = np.empty((z1 - z0,) + self.shape[1:3], dtype=self.dtype)
+        plane_size = self.shape[1] * self.shape[2]
+
+        with open(os.path.join(self.path, CHUNKS_FILE), 'rb') as f:
+            for slab in range(z0 // self.planes, (z1 - 1) // self.planes + 1):
+                offset, length = self.chunks[frame][slab]
+                f.seek(offset)
+                data = np.frombuffer(zlib.decompress(f.read(length)), dtype=self.dtype)
+                s0 = slab * self.planes
+                lo, hi = max(z0, s0), min(z1, s0 + len(data) // plane_size)
+                out[lo - z0:hi - z0] = data[(lo - s0) * plane_size:(hi - s0) * plane_size].reshape(
+                    (hi - lo,) + self.shape[1:3])
+        return out
+
+
+def entry_path(key):
+    return os.path.join(store_dir, key)
+
+
+def open_volume(key):
+    """
+    The Volume stored under key, or None without a store or entry
+    """
+    if store_dir is None or key is None:
+        return None
+    path = entry_path(key)
+    if not os.path.exists(os.path.join(path, INDEX_FILE)):
+        logger.debug(f'Volume store miss: {key}')
+        return None
+
+    try:
+        volume = Volume(path)
+    except Exception as e:
+        logger.warning(f'Discarding unreadable volume store entry {path}: {e}')
+        shutil.rmtree(path, ignore_errors=True)
+        return None
+
+    # mark as recently used
+    os.utime(path)
+    logger.info(f'Volume store hit: {key}')
+    return volume
+
+
+def put_volume(key, data, **meta):
+    """
+    Store a (z, y, x, frames) array under key, with meta values saved in the index. Does nothing without a store.
+    """
+    if store_dir is None or key is None or os.path.exists(entry_path(key)):
+        return
+
+    shape = data.shape
+    planes = slab_planes(shape, data.dtype)
+    tmp_path = tempfile.mkdtemp(suffix='.tmp', dir=store_dir)
+    try:
+        chunks = []
+        offset = 0
+        with open(os.path.join(tmp_path, CHUNKS_FILE), 'wb') as f:
+            for frame in range(shape[3]):
+                frame_chunks = []
+                for z0 in range(0, shape[0], planes):
+                    slab = np.ascontiguousarray(data[z0:z0 + planes, :, :, frame])
+                    compressed = zlib.compress(slab, COMPRESSION_LEVEL)
+                    f.write(compressed)
+                    frame_chunks.append([offset, len(compressed)])
+                    offset += len(compressed)
+                chunks.append(frame_chunks)
+
+        index = {
+            'version': VERSION,
+            'shape': list(shape),
+            'dtype': data.dtype.str,
+            'planes': planes,
+            'chunks': chunks,
+            'meta': meta,
+        }
+        with open(os.path.join(tmp_path, INDEX_FILE), 'w') as f:
+            json.dump(index, f)
+        os.rename(tmp_path, entry_path(key))
+    except OSError as e:
+        # stored by another process in the meantime, or out of space; the store is only an optimization
+        logger.warning(f'Could not store volume {key}: {e}')
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        return
+
+    logger.info(f'Volume stored: {key} ({offset / 2 ** 20:.0f} MB compressed, '
+                f'{data.nbytes / 2 ** 20:.0f} MB uncompressed)')
+    evict()
+
+
+def evict():
+    if max_size is None:
+        return
+
+    entries = []
+    for path in glob.glob(os.path.join(store_dir, '*', INDEX_FILE)):
+        path = os.path.dirname(path)
+        try:
+            size = os.path.getsize(os.path.join(path, CHUNKS_FILE))
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            continue
+        entries.append((mtime, size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        logger.debug(f'Evicting volume store entry {path}')
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
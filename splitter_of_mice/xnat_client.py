@@ -0,0 +1,132 @@
+"""
+Asynchronous execution of XNAT REST calls for the hotel splitter wrapper (run.py).
+"""
+import asyncio
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# imported the way the splitter imports it, so that stage hooks registered by run.py see both
+from instrumentation import stage
+
+logger = logging.getLogger(__name__)
+
+
+def pooled_session(auth, max_workers=4):
+    """
+    New requests Session with one pooled connection per worker thread of an AsyncXnatClient. The pool is mounted once,
+    when the session is made, so that a session reused by several clients (batch mode) keeps its connections.
+    """
+    session = requests.Session()
+    session.auth = auth
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class AsyncXnatClient:
+    """
+    Runs blocking XNAT calls on a background asyncio event loop so the splitter can keep working while
+    requests are in flight.
+
+    Calls are plain functions whose first two arguments are a requests Session and the XNAT server URL, such as
+    the helpers in run.py. Each call returns a concurrent.futures.Future; call result() on it to wait for the
+    response and re-raise any exception. The shared Session is used from a small thread pool, so the existing
+    authentication and connection reuse are kept; make it with pooled_session to pool one connection per worker.
+
+    Status updates are sent in the order they are queued. Uploads queued under the same key (the subject) are sent
+    one after another, while uploads for different keys run concurrently.
+    """
+
+    def __init__(self, session, server, max_workers=4):
+        self.session = session
+        self.server = server
+        self.max_workers = max_workers
+        self.pending = []
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='xnat')
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(self.executor)
+        self.thread = threading.Thread(target=self.loop.run_forever, name='xnat-event-loop', daemon=True)
+        self.thread.start()
+
+        self.locks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    async def _call(self, fn, *args, **kwargs):
+        call = functools.partial(self._timed_call, fn, *args, **kwargs)
+        return await self.loop.run_in_executor(None, call)
+
+    def _timed_call(self, fn, *args, **kwargs):
+        with stage(f'xnat_{fn.__name__}'):
+            return fn(self.session, self.server, *args, **kwargs)
+
+    async def _call_in_order(self, key, fn, *args, **kwargs):
+        # Locks are only touched from the event loop thread, and asyncio.Lock wakes waiters in FIFO order
+        lock = self.locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            return await self._call(fn, *args, **kwargs)
+
+    def _schedule(self, coro):
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        self.pending.append(future)
+        return future
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Schedule fn(session, server, *args, **kwargs) and return a future for its result
+        """
+        logger.debug(f'Scheduling XNAT call {fn.__name__}')
+        return self._schedule(self._call(fn, *args, **kwargs))
+
+    def submit_ordered(self, key, fn, *args, **kwargs):
+        """
+        Like submit, but calls sharing the same key run one at a time in the order they were submitted
+        """
+        logger.debug(f'Scheduling XNAT call {fn.__name__} (key={key})')
+        return self._schedule(self._call_in_order(key, fn, *args, **kwargs))
+
+    def submit_status(self, fn, *args, **kwargs):
+        """
+        Schedule a scan record status update. Status updates never overtake one another.
+        """
+        return self.submit_ordered('__status__', fn, *args, **kwargs)
+
+    def submit_upload(self, subject, fn, *args, **kwargs):
+        """
+        Schedule an upload for a subject. Uploads for the same subject are sent sequentially.
+        """
+        return self.submit_ordered(('__upload__', subject), fn, *args, **kwargs)
+
+    def wait_all(self, futures=None):
+        """
+        Block until the given futures (default: everything submitted so far) finish, then re-raise the first error
+        """
+        futures = list(self.pending if futures is None else futures)
+        wait(futures)
+        for future in futures:
+            future.result()
+
+    def close(self):
+        """
+        Wait for outstanding calls to finish and shut down the event loop. Errors are left on the futures.
+        """
+        if self.loop.is_closed():
+            return
+
+        wait(self.pending)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.executor.shutdown(wait=True)
+        self.pending = []
@@ -0,0 +1,10 @@
+import os
+import sys
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TESTS_DIR)
+
+# the package uses flat imports, as in the container (see Dockerfile); the benchmark phantoms stand in for hotel scans
+sys.path[:0] = [os.path.join(REPO_DIR, 'splitter_of_mice'),
+                os.path.join(REPO_DIR, 'splitter_of_mice', 'splitter_of_mice'),
+                os.path.join(REPO_DIR, 'benchmarks')]
@@ -0,0 +1,37 @@
+import os
+
+import pytest
+
+import phantoms
+from image_classes import DicomImage
+from splitter import SoM
+
+
+def test_dicom_save_cut_removes_partial_zip(tmp_path, monkeypatch):
+    SoM.desc_map = {'l': 'l', 'r': 'r', 'ctr': 'ctr', 'lb': 'lb', 'rb': 'rb', 'lt': 'lt', 'rt': 'rt'}
+    image = phantoms.write_dicom(str(tmp_path / 'input'), animals=2, matrix=64, slices=8)
+    splitter = SoM(image, modality='PET', dicom=True)
+    assert splitter.split_mice(num_anim=2, coregister_cuts=True) == 0
+    SoM.add_cuts_to_image(splitter.pi, splitter.cuts)
+
+    # fail on the third slice, after the archive has been started
+    derive = DicomImage.derive_image_sequence
+    calls = []
+
+    def failing(self, *args):
+        calls.append(args)
+        if len(calls) == 3:
+            raise RuntimeError('slice failed')
+        return derive(self, *args)
+    monkeypatch.setattr(DicomImage, 'derive_image_sequence', failing)
+
+    outdir = str(tmp_path / 'output')
+    with pytest.raises(RuntimeError):
+        splitter.pi.save_cut(0, outdir, zip=True)
+    assert not os.path.exists(os.path.join(outdir, '0.zip'))
+    assert splitter.pi.zip_outputs == []
+
+    monkeypatch.setattr(DicomImage, 'derive_image_sequence', derive)
+    splitter.pi.save_cut(0, outdir, zip=True)
+    assert [path for _, path in splitter.pi.zip_outputs] == [os.path.join(outdir, '0.zip')]
+    splitter.pi.unload_image()
@@ -0,0 +1,39 @@
+import os
+
+import phantoms
+from result_cache import ResultCache
+from splitter import SoM
+
+
+def split_ct(image, cache, outdir):
+    splitter = SoM(image, modality='CT')
+    splitter.cache = cache
+    splitter.outdir = str(outdir)
+    os.makedirs(splitter.outdir)
+    assert splitter.split_mice(num_anim=2, remove_bed=True, output_qc=True) == 0
+    splitter.pi.unload_image()
+
+    qc_dir = os.path.join(splitter.outdir, 'qc')
+    qc = {}
+    for name in sorted(os.listdir(qc_dir)):
+        with open(os.path.join(qc_dir, name), 'rb') as f:
+            qc[name] = f.read()
+    return qc
+
+
+def test_ct_cache_hit_renders_the_same_qc(tmp_path, monkeypatch):
+    SoM.desc_map = {'l': 'l', 'r': 'r', 'ctr': 'ctr', 'lb': 'lb', 'rb': 'rb', 'lt': 'lt', 'rt': 'rt'}
+    image = phantoms.write_inveon(str(tmp_path / 'ct.img'), animals=2, matrix=256, slices=32, ct=True, data_type=2)
+    cache = ResultCache(str(tmp_path / 'cache'))
+
+    miss = split_ct(image, cache, tmp_path / 'miss')
+
+    # a cache hit skips the detection
+    def not_called(*args, **kwargs):
+        raise AssertionError('detection ran on a cache hit')
+    monkeypatch.setattr(SoM, 'detect_animals', staticmethod(not_called))
+    hit = split_ct(image, cache, tmp_path / 'hit')
+
+    assert miss and list(hit) == list(miss)
+    for name in miss:
+        assert hit[name] == miss[name], f'{name} differs between the cache miss and hit'
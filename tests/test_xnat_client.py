@@ -0,0 +1,78 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from xnat_client import AsyncXnatClient, pooled_session
+
+
+class MockXnat(BaseHTTPRequestHandler):
+    """
+    Records the path and the start and end time of each request, answering after the delay given in the path
+    """
+    requests = []
+    lock = threading.Lock()
+
+    def do_PUT(self):
+        start = time.perf_counter()
+        time.sleep(float(self.path.rsplit('/', 1)[-1]))
+        with self.lock:
+            self.requests.append((self.path, start, time.perf_counter()))
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    MockXnat.requests = []
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), MockXnat)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def update_status(session, server, number, delay):
+    session.put(f'{server}/status/{number}/{delay}').raise_for_status()
+
+
+def upload(session, server, subject, number, delay):
+    session.put(f'{server}/upload/{subject}/{number}/{delay}').raise_for_status()
+
+
+def intervals(prefix):
+    return [(start, end) for path, start, end in sorted(MockXnat.requests, key=lambda r: r[1])
+            if path.startswith(prefix)]
+
+
+def test_status_updates_are_sent_in_order(server):
+    with AsyncXnatClient(pooled_session(None), server) as xnat:
+        # the first updates are the slowest, so they would finish last if they were sent concurrently
+        futures = [xnat.submit_status(update_status, number, 0.05 * (4 - number)) for number in range(5)]
+        xnat.wait_all(futures)
+
+    assert [path.split('/')[2] for path, _, _ in MockXnat.requests] == ['0', '1', '2', '3', '4']
+    updates = intervals('/status/')
+    assert all(previous[1] <= following[0] for previous, following in zip(updates, updates[1:]))
+
+
+def test_uploads_are_ordered_per_subject_and_overlap_across_subjects(server):
+    with AsyncXnatClient(pooled_session(None), server) as xnat:
+        futures = [xnat.submit_upload(subject, upload, subject, number, 0.2)
+                   for number in range(2) for subject in ('S0', 'S1')]
+        xnat.wait_all(futures)
+
+    for subject in ('S0', 'S1'):
+        paths = [path for path, _, _ in MockXnat.requests if path.startswith(f'/upload/{subject}/')]
+        assert [path.split('/')[3] for path in paths] == ['0', '1']
+        uploads = intervals(f'/upload/{subject}/')
+        assert uploads[0][1] <= uploads[1][0]
+
+    s0, s1 = intervals('/upload/S0/'), intervals('/upload/S1/')
+    assert any(a[0] < b[1] and b[0] < a[1] for a in s0 for b in s1)